@@ -18,5 +18,9 @@ def compute_cider(
     return coco_eval.eval
 
 
+# postprocess_captioning_generation discards everything after these, so generation can stop there
+CAPTIONING_STOP_STRINGS = ["Output"]
+
+
 def postprocess_captioning_generation(predictions):
     return predictions.split("Output", 1)[0]
@@ -34,6 +34,7 @@ class BaseEvalModel(abc.ABC):
         max_generation_length: int,
         num_beams: int,
         length_penalty: float,
+        stop_strings: List[str] = None,
     ) -> List[str]:
         """Get outputs for a batch of images and text.
 
@@ -46,6 +47,9 @@ class BaseEvalModel(abc.ABC):
                 Defaults to 10.
             num_beams: number of beams to use for beam search. Defaults to 3.
             length_penalty: length penalty for beam search. Defaults to -2.0.
+            stop_strings: optional strings after which the output is discarded
+                by postprocessing, so generation of a sequence may stop once it
+                contains one of them.
 
         Returns:
             List of decoded output strings.
@@ -2,6 +2,7 @@ import argparse
 import importlib
 import json
 import os
+import time
 import uuid
 import random
 from collections import defaultdict
@@ -12,7 +13,11 @@ from sklearn.metrics import roc_auc_score
 import utils
 import math
 
-from coco_metric import compute_cider, postprocess_captioning_generation
+from coco_metric import (
+    CAPTIONING_STOP_STRINGS,
+    compute_cider,
+    postprocess_captioning_generation,
+)
 from eval_datasets import (
     CaptionDataset,
     VQADataset,
@@ -32,7 +37,11 @@ from eval_model import BaseEvalModel
 
 from ok_vqa_utils import postprocess_ok_vqa_generation
 from open_flamingo.src.flamingo import Flamingo
-from vqa_metric import compute_vqa_accuracy, postprocess_vqa_generation
+from vqa_metric import (
+    VQA_STOP_STRINGS,
+    compute_vqa_accuracy,
+    postprocess_vqa_generation,
+)
 
 from open_flamingo.train.distributed import init_distributed_device, world_info_from_env
 
@@ -80,6 +89,12 @@ parser.add_argument(
     action="store_true",
     help="Whether to skip using key-value caching for classification evals, which usually speeds it up.",
 )
+parser.add_argument(
+    "--stop_at_stop_strings",
+    action="store_true",
+    help="Whether to stop generating a caption or VQA answer once it contains a string that postprocessing cuts off "
+    "(e.g. 'Output'). Predictions are unchanged under greedy decoding, but with beam search the chosen beam can differ.",
+)
 parser.add_argument(
     "--classification_prompt_ensembling",
     action="store_true",
@@ -720,11 +735,38 @@ def main():
                     }
                 )
 
+    vision_cache = getattr(utils.unwrap_model(eval_model.model), "vision_cache", None)
+    if vision_cache is not None:
+        print(f"Rank {args.rank} vision feature cache stats: {vision_cache.stats()}")
+    prefix_cache = getattr(utils.unwrap_model(eval_model.model), "prefix_cache", None)
+    if prefix_cache is not None:
+        print(f"Rank {args.rank} prefix cache stats: {prefix_cache.stats()}")
+
     if args.rank == 0 and args.results_file is not None:
         with open(args.results_file, "w") as f:
             json.dump(results, f)
 
 
+def generation_counts(eval_model):
+    """Number of tokens and samples generated so far, if the model counts them."""
+    return (
+        getattr(eval_model, "num_generated_tokens", 0),
+        getattr(eval_model, "num_generated_samples", 0),
+    )
+
+
+def print_generation_stats(args, eval_model, dataset_name, start_time, start_counts):
+    """Print the wall-clock time of an eval's generation loop and the generated tokens per sample."""
+    num_tokens, num_samples = (
+        count - start
+        for count, start in zip(generation_counts(eval_model), start_counts)
+    )
+    message = f"Rank {args.rank} {dataset_name} generation took {time.time() - start_time:.1f}s"
+    if num_samples > 0:
+        message += f", {num_tokens / num_samples:.2f} generated tokens per sample"
+    print(message)
+
+
 def evaluate_captioning(
     args: argparse.Namespace,
     eval_model: BaseEvalModel,
@@ -806,6 +848,7 @@ def evaluate_captioning(
         query_set = utils.get_query_set(train_dataset, args.query_set_size)
 
     utils.random_seed(seed, args.rank)
+    start_time, start_counts = time.time(), generation_counts(eval_model)
     predictions = defaultdict()
     for batch in tqdm(
         test_dataloader,
@@ -847,6 +890,7 @@ def evaluate_captioning(
             max_generation_length=max_generation_length,
             num_beams=num_beams,
             length_penalty=length_penalty,
+            stop_strings=CAPTIONING_STOP_STRINGS if args.stop_at_stop_strings else None,
         )
 
         new_predictions = [
@@ -858,6 +902,8 @@ def evaluate_captioning(
                 "caption": new_predictions[i],
             }
 
+    print_generation_stats(args, eval_model, dataset_name, start_time, start_counts)
+
     # all gather
     all_predictions = [None for _ in range(args.world_size)]
     torch.distributed.all_gather_object(all_predictions, predictions)  # list of dicts
@@ -994,6 +1040,7 @@ def evaluate_vqa(
         query_set = utils.get_query_set(train_dataset, args.query_set_size)
 
     utils.random_seed(seed, args.rank)
+    start_time, start_counts = time.time(), generation_counts(eval_model)
     predictions = []
     for batch in tqdm(
         test_dataloader,
@@ -1040,6 +1087,7 @@ def evaluate_vqa(
             max_generation_length=max_generation_length,
             num_beams=num_beams,
             length_penalty=length_penalty,
+            stop_strings=VQA_STOP_STRINGS if args.stop_at_stop_strings else None,
         )
 
         process_function = (
@@ -1053,6 +1101,8 @@ def evaluate_vqa(
         for new_prediction, sample_id in zip(new_predictions, batch["question_id"]):
             predictions.append({"answer": new_prediction, "question_id": sample_id})
 
+    print_generation_stats(args, eval_model, dataset_name, start_time, start_counts)
+
     # all gather
     all_predictions = [None for _ in range(args.world_size)]
     torch.distributed.all_gather_object(all_predictions, predictions)  # list of lists
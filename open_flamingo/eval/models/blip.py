@@ -72,7 +72,9 @@ class EvalModel(BaseEvalModel):
         max_generation_length: int,
         num_beams: int,
         length_penalty: float,
+        stop_strings: List[str] = None,
     ) -> List[str]:
+        # stop_strings are only an optimization, so BLIP generates up to max_generation_length
         encodings = self.processor.tokenizer(
             batch_text,
             padding="longest",
@@ -6,8 +6,52 @@ from einops import repeat
 
 from open_flamingo.eval.eval_model import BaseEvalModel
 from open_flamingo.src.factory import create_model_and_transforms
+from open_flamingo.src.flamingo_lm import merge_token_embedding_state_dict
 from open_flamingo.eval.utils import unwrap_model, get_autocast, get_cast_dtype
-from transformers.modeling_outputs import CausalLMOutputWithPast
+
+
+class _TrieNode:
+    def __init__(self, token=None, parent=None):
+        self.token = token
+        self.depth = 0 if parent is None else parent.depth + 1
+        # ancestors[d - 1] is the ancestor at depth d, up to the parent
+        self.ancestors = (
+            [] if parent is None or parent.depth == 0 else parent.ancestors + [parent]
+        )
+        self.children = {}  # token -> child
+        self.class_indices = []  # classes whose tokens end at this node
+        self.index = None  # position in its level of ClassNameTrie.levels
+
+
+class ClassNameTrie:
+    """
+    Token trie over tokenized class names, for scoring class names with shared prefixes together.
+    levels[d - 1] lists the nodes at depth d that have children, i.e. whose tokens need a forward pass
+    to score the next token.
+    """
+
+    def __init__(self, class_tokens: List[List[int]]):
+        self.root = _TrieNode()
+        for class_idx, tokens in enumerate(class_tokens):
+            node = self.root
+            for token in tokens:
+                if token not in node.children:
+                    node.children[token] = _TrieNode(token, node)
+                node = node.children[token]
+            node.class_indices.append(class_idx)
+
+        self.levels = []
+        level = [n for n in self.root.children.values() if len(n.children) > 0]
+        while len(level) > 0:
+            for index, node in enumerate(level):
+                node.index = index
+            self.levels.append(level)
+            level = [
+                child
+                for node in level
+                for child in node.children.values()
+                if len(child.children) > 0
+            ]
 
 
 class EvalModel(BaseEvalModel):
@@ -46,18 +90,50 @@ class EvalModel(BaseEvalModel):
             model_args["lm_path"],
             model_args["lm_tokenizer_path"],
             cross_attn_every_n_layers=int(model_args["cross_attn_every_n_layers"]),
+            # nothing is trained, so keep the language model's own input embeddings
+            freeze_lm_embeddings=True,
         )
         checkpoint = torch.load(model_args["checkpoint_path"], map_location=self.device)
         if "model_state_dict" in checkpoint:
             checkpoint = checkpoint["model_state_dict"]
             checkpoint = {k.replace("module.", ""): v for k, v in checkpoint.items()}
+        # checkpoints of training with trainable token embeddings hold them split in two
+        merge_token_embedding_state_dict(checkpoint)
         self.model.load_state_dict(checkpoint, strict=False)
         self.model.to(self.device)
         self.model.eval()
         self.tokenizer.padding_side = "left"
 
+        # optionally cache the vision features of repeated images, e.g. in-context demonstrations
+        if "vision_cache_mb" in model_args:
+            self.model.enable_vision_cache(
+                max_bytes=int(float(model_args["vision_cache_mb"]) * 1024**2),
+                cache_latents=True,
+            )
+
+        # optionally cache the past_key_values of repeated prompt prefixes, e.g. in-context demonstrations
+        if "prefix_cache_mb" in model_args:
+            self.model.enable_prefix_cache(
+                max_bytes=int(float(model_args["prefix_cache_mb"]) * 1024**2)
+            )
+
         self.lm_name = model_args["lm_path"].split("/")[-1]
 
+        # optionally, with use_cache, score the class names of get_rank_classifications over a token trie,
+        # using forwards of at most classification_batch_size rows. Off by default: every forward copies the
+        # context past_key_values for each of its rows, which can be slower than the per-class loop
+        self.use_class_name_trie = (
+            str(model_args.get("use_class_name_trie", False)).lower() == "true"
+        )
+        self.classification_batch_size = int(
+            model_args.get("classification_batch_size", 32)
+        )
+        self._class_name_tries = {}
+
+        # generated tokens per sample, see get_outputs
+        self.num_generated_tokens = 0
+        self.num_generated_samples = 0
+
         # autocast
         self.autocast = get_autocast(model_args["precision"])
         self.cast_dtype = get_cast_dtype(model_args["precision"])
@@ -128,9 +204,11 @@ class EvalModel(BaseEvalModel):
         max_generation_length: int,
         num_beams: int,
         length_penalty: float,
+        stop_strings: List[str] = None,
     ) -> List[str]:
         """
         Get generation outputs.
+        Each sequence ends as soon as its output contains one of stop_strings.
         """
         batch_images = self._prepare_images(batch_images)
         input_ids, attention_mask = self._prepare_text(batch_text)
@@ -145,11 +223,21 @@ class EvalModel(BaseEvalModel):
                     max_new_tokens=max_generation_length,
                     num_beams=num_beams,
                     length_penalty=length_penalty,
+                    stop_strings=stop_strings,
+                    tokenizer=self.tokenizer,
                 )
 
         # Extract only the new gnerated tokens
         outputs = outputs[:, len(input_ids[0]) :]
 
+        # count the tokens up to and including the first eos of each sequence
+        is_eos = outputs == unwrap_model(self.model).eoc_token_id
+        num_tokens = torch.where(
+            is_eos.any(dim=1), is_eos.int().argmax(dim=1) + 1, outputs.shape[1]
+        )
+        self.num_generated_tokens += int(num_tokens.sum())
+        self.num_generated_samples += len(outputs)
+
         return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
 
     def get_rank_classifications(
@@ -167,7 +255,22 @@ class EvalModel(BaseEvalModel):
         ctx_input_ids, ctx_attention_mask = self._prepare_text(batch_text)
 
         # Cache the context
-        if use_cache:
+        use_prefix_cache = (
+            use_cache and unwrap_model(self.model).prefix_cache is not None
+        )
+        if use_prefix_cache:
+            # only run the part of the context that is not in the prefix cache;
+            # the context is re-laid out, see Flamingo.prefill
+            with torch.inference_mode():
+                with self.autocast():
+                    precomputed, ctx_attention_mask = unwrap_model(self.model).prefill(
+                        lang_x=ctx_input_ids,
+                        vision_x=batch_images,
+                        attention_mask=ctx_attention_mask,
+                    )
+            precomputed_logits = precomputed.logits
+            precomputed_pkvs = precomputed.past_key_values
+        elif use_cache:
             # reserve the last token in the context for the main forward pass
             self.cache_media(
                 input_ids=ctx_input_ids,
@@ -185,6 +288,17 @@ class EvalModel(BaseEvalModel):
         else:
             precomputed_pkvs = None
 
+        if use_cache and self.use_class_name_trie:
+            overall_probs = self._get_rank_classifications_with_trie(
+                all_class_names,
+                precomputed_logits[:, -1],
+                precomputed_pkvs,
+                ctx_attention_mask,
+                normalize_length,
+            )
+            self.uncache_media()
+            return overall_probs.cpu()
+
         # Loop through class names and get log-likelihoods
         # Note: if all classnames are one token, this code is redundant, since we could
         # get all logits after one pass. However, if there are multi-token classnames,
@@ -214,7 +328,13 @@ class EvalModel(BaseEvalModel):
                 _vision_x = batch_images
             else:
                 _lang_x = classname_tokens
-                _attention_mask = None
+                _attention_mask = torch.cat(
+                    [
+                        ctx_attention_mask,
+                        torch.ones_like(classname_tokens).bool(),
+                    ],
+                    dim=1,
+                )
                 _vision_x = None
 
             # Call forward to get the logits
@@ -253,6 +373,135 @@ class EvalModel(BaseEvalModel):
         overall_probs = torch.vstack(overall_probs).T.cpu()  # shape (B, num_classes)
         return overall_probs
 
+    def _get_rank_classifications_with_trie(
+        self,
+        all_class_names: List[str],
+        ctx_logits: torch.Tensor,
+        ctx_pkvs,
+        ctx_attention_mask: torch.Tensor,
+        normalize_length: bool,
+    ):
+        """
+        Score all class names against a cached context in a few batched forward passes.
+        The class names are arranged in a token trie, so a prefix shared by several class names
+        (e.g. "American") is run once. The trie is processed level by level: each forward runs the tokens of
+        a chunk of trie nodes, each on top of the context past_key_values and the keys / values of its ancestors.
+        Args:
+            ctx_logits: logits of the last context token
+                shape (B, vocab_len)
+            ctx_pkvs: past_key_values of the context
+            ctx_attention_mask: attention mask of the context
+                shape (B, T_ctx)
+        Returns:
+            (B, |all_class_names|) tensor containing the logprobs for each class name.
+        """
+        key = tuple(all_class_names)
+        if key not in self._class_name_tries:
+            self._class_name_tries[key] = ClassNameTrie(
+                [
+                    self.tokenizer(class_name, add_special_tokens=False)["input_ids"]
+                    for class_name in all_class_names
+                ]
+            )
+        trie = self._class_name_tries[key]
+
+        B = ctx_logits.shape[0]
+        lang_encoder = unwrap_model(self.model).lang_encoder
+        layers = lang_encoder._get_decoder_layers()
+        kv_seq_dims = lang_encoder.kv_seq_dims
+        vis_x, media_locations = layers[0].vis_x, layers[0].media_locations
+        class_logprobs = ctx_logits.new_zeros((B, len(all_class_names)))
+        # summed logprobs of the tokens from the root to each node, (B,)
+        node_logprobs = {trie.root: ctx_logits.new_zeros(B)}
+
+        def score_children(node, logprobs):
+            for token, child in node.children.items():
+                node_logprobs[child] = node_logprobs[node] + logprobs[:, token]
+                for class_idx in child.class_indices:
+                    class_logprobs[:, class_idx] = (
+                        node_logprobs[child] / child.depth
+                        if normalize_length
+                        else node_logprobs[child]
+                    )
+
+        score_children(trie.root, torch.log_softmax(ctx_logits, dim=-1))
+
+        # level_kvs[d - 1]: per layer keys / values of the depth d nodes' tokens,
+        # with row i * B + b for node i of the level and sample b
+        level_kvs = []
+        nodes_per_forward = max(1, self.classification_batch_size // B)
+        for depth, nodes in enumerate(trie.levels, start=1):
+            chunk_kvs = []
+            for start in range(0, len(nodes), nodes_per_forward):
+                chunk = nodes[start : start + nodes_per_forward]
+                n = len(chunk)
+                ancestor_rows = [
+                    (
+                        torch.tensor(
+                            [node.ancestors[d].index for node in chunk],
+                            device=ctx_logits.device,
+                        )[:, None]
+                        * B
+                        + torch.arange(B, device=ctx_logits.device)
+                    ).flatten()
+                    for d in range(depth - 1)
+                ]
+                past_key_values = tuple(
+                    tuple(
+                        torch.cat(
+                            [t.repeat(n, *[1] * (t.ndim - 1))]
+                            + [
+                                level_kvs[d][layer_idx][kv_idx][rows]
+                                for d, rows in enumerate(ancestor_rows)
+                            ],
+                            dim=kv_seq_dims[kv_idx],
+                        )
+                        for kv_idx, t in enumerate(layer_past)
+                    )
+                    for layer_idx, layer_past in enumerate(ctx_pkvs)
+                )
+                attention_mask = torch.cat(
+                    [
+                        ctx_attention_mask.repeat(n, 1),
+                        ctx_attention_mask.new_ones((n * B, depth)),
+                    ],
+                    dim=1,
+                )
+                for layer in layers:
+                    layer.condition_vis_x(vis_x.repeat(n, 1, 1, 1))
+                    layer.condition_media_locations(media_locations.repeat(n, 1))
+
+                outputs = self.__call__(
+                    vision_x=None,
+                    lang_x=torch.tensor(
+                        [node.token for node in chunk], device=ctx_logits.device
+                    ).repeat_interleave(B)[:, None],
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                chunk_kvs.append(
+                    tuple(
+                        tuple(
+                            t.narrow(dim, t.shape[dim] - 1, 1)
+                            for t, dim in zip(layer_past, kv_seq_dims)
+                        )
+                        for layer_past in outputs.past_key_values
+                    )
+                )
+                logprobs = torch.log_softmax(outputs.logits[:, -1], dim=-1)
+                for i, node in enumerate(chunk):
+                    score_children(node, logprobs[i * B : (i + 1) * B])
+
+            level_kvs.append(
+                tuple(
+                    tuple(torch.cat(tensors) for tensors in zip(*layers_kv))
+                    for layers_kv in zip(*chunk_kvs)
+                )
+            )
+
+        return class_logprobs
+
     def __call__(
         self,
         lang_x: torch.Tensor,
@@ -264,53 +513,22 @@ class EvalModel(BaseEvalModel):
     ):
         """
         Calls the forward function of the model.
-        Special logic to handle the case if past_key_values is not None:
-            then lang_x is assumed to contain the tokens to be generated
-            *excluding* the tokens already in past_key_values.
-            We then repeatedly call forward, updating the past_key_values.
+        If past_key_values is not None, lang_x is assumed to contain the tokens to be generated
+        *excluding* the tokens already in past_key_values, and attention_mask (if given)
+        covers both the tokens in past_key_values and lang_x.
         """
-        # standard forward pass
-        if past_key_values is None:
-            with torch.inference_mode():
-                with self.autocast():
-                    outputs = self.model(
-                        vision_x=vision_x,
-                        lang_x=lang_x,
-                        attention_mask=attention_mask,
-                        clear_conditioned_layers=clear_conditioned_layers,
-                        past_key_values=past_key_values,
-                        use_cache=use_cache,
-                    )
-            return outputs
-
-        # loop to handle updating past_key_values
-        logits = []
-        for token_idx in range(lang_x.shape[1]):
-            _lang_x = lang_x[:, token_idx].reshape((-1, 1))
-            if attention_mask is not None:
-                _attention_mask = attention_mask[:, token_idx].reshape((-1, 1))
-            else:
-                _attention_mask = None
-
-            with torch.inference_mode():
-                with self.autocast():
-                    outputs = self.model(
-                        vision_x=vision_x,
-                        lang_x=_lang_x,
-                        attention_mask=_attention_mask,
-                        clear_conditioned_layers=False,
-                        past_key_values=past_key_values,
-                        use_cache=True,
-                    )
-
-            past_key_values = outputs.past_key_values
-            logits.append(outputs.logits)
-
-        logits = torch.cat(logits, dim=1)
-        return CausalLMOutputWithPast(
-            logits=logits,
-            past_key_values=past_key_values,
-        )
+        with torch.inference_mode():
+            with self.autocast():
+                outputs = self.model(
+                    vision_x=vision_x,
+                    lang_x=lang_x,
+                    attention_mask=attention_mask,
+                    clear_conditioned_layers=clear_conditioned_layers
+                    and past_key_values is None,
+                    past_key_values=past_key_values,
+                    use_cache=use_cache or past_key_values is not None,
+                )
+        return outputs
 
     def encode_vision_x(self, image_tensor: torch.Tensor):
         unwrap_model(self.model)._encode_vision_x(image_tensor.to(self.device))
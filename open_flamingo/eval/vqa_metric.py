@@ -554,6 +554,11 @@ def compute_vqa_accuracy(result_json_path, question_json_path, annotation_json_p
     return vqaEval.accuracy["overall"]
 
 
+# postprocess_vqa_generation (and postprocess_ok_vqa_generation) discard everything after these,
+# so generation can stop there
+VQA_STOP_STRINGS = ["Question", "Answer", "Short"]
+
+
 def postprocess_vqa_generation(predictions):
     answer = re.split("Question|Answer|Short", predictions, 1)[0]
     answer = re.split(", ", answer, 1)[0]
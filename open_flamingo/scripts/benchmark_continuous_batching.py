@@ -0,0 +1,171 @@
+"""
+Load-generator benchmark of ContinuousBatchingEngine against static batching with Flamingo.generate.
+Synthetic requests (random images, prompt lengths and generation lengths) arrive as a Poisson process;
+reports generated tokens/s and p50 / p99 request latency (arrival to last token) for both.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from open_flamingo import create_model_and_transforms
+from open_flamingo.src.continuous_batching import ContinuousBatchingEngine
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument("--lm_path", default="facebook/opt-1.3b", type=str)
+parser.add_argument("--lm_tokenizer_path", default="facebook/opt-1.3b", type=str)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, default=None)
+parser.add_argument("--num_requests", type=int, default=128)
+parser.add_argument(
+    "--request_rate",
+    type=float,
+    default=float("inf"),
+    help="Mean number of requests arriving per second. Defaults to all requests arriving at once.",
+)
+parser.add_argument("--batch_size", type=int, default=16)
+parser.add_argument("--max_images", type=int, default=3)
+parser.add_argument("--min_prompt_tokens", type=int, default=8)
+parser.add_argument("--max_prompt_tokens", type=int, default=64)
+parser.add_argument("--min_new_tokens", type=int, default=5)
+parser.add_argument("--max_new_tokens", type=int, default=20)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_requests(args, model, vocab_size, image_size):
+    """Random prompts of 1..max_images (<image> + text) chunks with Poisson arrival times."""
+    rng = random.Random(args.seed)
+    text_tokens = [
+        t
+        for t in range(vocab_size)
+        if t not in (model.media_token_id, model.eoc_token_id)
+    ]
+    requests, arrival = [], 0.0
+    for _ in range(args.num_requests):
+        num_images = rng.randint(1, args.max_images)
+        num_tokens = rng.randint(args.min_prompt_tokens, args.max_prompt_tokens)
+        lang_x = [rng.choice(text_tokens) for _ in range(num_tokens)]
+        for i in range(num_images):
+            lang_x.insert(i * num_tokens // num_images, model.media_token_id)
+        if args.request_rate != float("inf"):
+            arrival += rng.expovariate(args.request_rate)
+        requests.append(
+            {
+                "vision_x": torch.randn((1, num_images, 1, 3) + image_size),
+                "lang_x": torch.tensor([lang_x]),
+                "max_new_tokens": rng.randint(args.min_new_tokens, args.max_new_tokens),
+                "arrival": arrival,
+            }
+        )
+    return requests
+
+
+def run_static_batching(model, requests, batch_size, device):
+    """Generate each batch of arrived requests with Flamingo.generate until its longest sequence finishes."""
+    start, pending, results = time.perf_counter(), list(requests), []
+    while pending:
+        now = time.perf_counter() - start
+        if pending[0]["arrival"] > now:
+            time.sleep(pending[0]["arrival"] - now)
+            now = time.perf_counter() - start
+        batch = [r for r in pending[:batch_size] if r["arrival"] <= now]
+        pending = pending[len(batch) :]
+
+        T_txt = max(r["lang_x"].shape[1] for r in batch)
+        T_img = max(r["vision_x"].shape[1] for r in batch)
+        lang_x = torch.full((len(batch), T_txt), model.eoc_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(lang_x, dtype=torch.bool)
+        vision_x = torch.zeros((len(batch), T_img) + batch[0]["vision_x"].shape[2:])
+        for i, r in enumerate(batch):
+            lang_x[i, T_txt - r["lang_x"].shape[1] :] = r["lang_x"][0]
+            attention_mask[i, T_txt - r["lang_x"].shape[1] :] = True
+            vision_x[i, : r["vision_x"].shape[1]] = r["vision_x"][0]
+        with torch.inference_mode():
+            output = model.generate(
+                vision_x.to(device),
+                lang_x.to(device),
+                attention_mask.to(device),
+                max_new_tokens=max(r["max_new_tokens"] for r in batch),
+                num_beams=1,
+            )
+        finish = time.perf_counter() - start
+        for r, row in zip(batch, output[:, T_txt:].tolist()):
+            row = row[: r["max_new_tokens"]]
+            if model.eoc_token_id in row:
+                row = row[: row.index(model.eoc_token_id) + 1]
+            results.append((len(row), finish - r["arrival"]))
+    return results, time.perf_counter() - start
+
+
+def run_continuous_batching(model, requests, batch_size, device):
+    """Admit requests into ContinuousBatchingEngine as they arrive and step it."""
+    engine = ContinuousBatchingEngine(model, max_batch_size=batch_size)
+    start, pending, submitted = time.perf_counter(), list(requests), []
+    while pending or engine.has_unfinished_requests():
+        now = time.perf_counter() - start
+        if pending and not engine.has_unfinished_requests():
+            time.sleep(max(pending[0]["arrival"] - now, 0))
+            now = time.perf_counter() - start
+        while pending and pending[0]["arrival"] <= now:
+            r = pending.pop(0)
+            request = engine.add_request(
+                r["vision_x"].to(device),
+                r["lang_x"].to(device),
+                max_new_tokens=r["max_new_tokens"],
+            )
+            request.arrival_time = start + r["arrival"]
+            submitted.append(request)
+        engine.step()
+    results = [(len(r.output_ids), r.finish_time - r.arrival_time) for r in submitted]
+    return results, time.perf_counter() - start
+
+
+def report(name, results, elapsed):
+    num_tokens = sum(n for n, _ in results)
+    latencies = np.array([latency for _, latency in results])
+    print(
+        f"{name} | {num_tokens / elapsed:.1f} tokens/s | "
+        f"p50 {np.percentile(latencies, 50) * 1000:.0f} ms | "
+        f"p99 {np.percentile(latencies, 99) * 1000:.0f} ms"
+    )
+
+
+def main():
+    args = parser.parse_args()
+    model, image_processor, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+    )
+    if args.checkpoint_path is not None:
+        model.load_state_dict(
+            torch.load(args.checkpoint_path, map_location="cpu"), strict=False
+        )
+    model.to(args.device).eval()
+
+    image_size = model.vision_encoder.image_size
+    image_size = image_size if isinstance(image_size, tuple) else (image_size,) * 2
+    requests = make_requests(args, model, len(tokenizer), image_size)
+
+    # warmup
+    run_static_batching(model, requests[:2], args.batch_size, args.device)
+    print("batching | throughput | latency (arrival to last token)")
+    report(
+        "static",
+        *run_static_batching(model, requests, args.batch_size, args.device),
+    )
+    report(
+        "continuous",
+        *run_continuous_batching(model, requests, args.batch_size, args.device),
+    )
+
+
+if __name__ == "__main__":
+    main()
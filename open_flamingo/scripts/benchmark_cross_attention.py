@@ -0,0 +1,100 @@
+"""
+Benchmark the masked and gathered execution paths of MaskedCrossAttention
+(only_attend_immediate_media=True) as the number of in-context shots grows.
+"""
+import argparse
+import time
+
+import torch
+
+from open_flamingo.src.helpers import ATTENTION_BACKENDS, MaskedCrossAttention
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--shots", nargs="+", default=[0, 4, 8, 16, 32], type=int)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument(
+    "--tokens_per_shot",
+    type=int,
+    default=24,
+    help="Number of text tokens following each <image> token.",
+)
+parser.add_argument("--num_latents", type=int, default=64)
+parser.add_argument("--lang_dim", type=int, default=2048)
+parser.add_argument("--vis_dim", type=int, default=1024)
+parser.add_argument(
+    "--attention_backend", default="eager", type=str, choices=ATTENTION_BACKENDS
+)
+parser.add_argument("--num_iters", type=int, default=10)
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+
+def time_forward(module, *inputs, num_iters=10):
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    module(*inputs)  # warmup
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    sync()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        out = module(*inputs)
+    sync()
+    elapsed = (time.perf_counter() - start) / num_iters
+    peak_memory = (
+        torch.cuda.max_memory_allocated() / 1024**2
+        if torch.cuda.is_available()
+        else float("nan")
+    )
+    return out, elapsed, peak_memory
+
+
+def main():
+    args = parser.parse_args()
+    masked = MaskedCrossAttention(
+        dim=args.lang_dim,
+        dim_visual=args.vis_dim,
+        attention_backend=args.attention_backend,
+    )
+    gathered = MaskedCrossAttention(
+        dim=args.lang_dim,
+        dim_visual=args.vis_dim,
+        attention_backend=args.attention_backend,
+        gather_immediate_media=True,
+    )
+    gathered.load_state_dict(masked.state_dict())
+    masked.to(args.device).eval()
+    gathered.to(args.device).eval()
+
+    print(
+        "shots | T_txt | masked (ms) | gathered (ms) | masked (MB) | gathered (MB) | max diff"
+    )
+    for shot in args.shots:
+        T_img = shot + 1
+        T_txt = T_img * args.tokens_per_shot
+        x = torch.randn(args.batch_size, T_txt, args.lang_dim, device=args.device)
+        media = torch.randn(
+            args.batch_size, T_img, args.num_latents, args.vis_dim, device=args.device
+        )
+        media_locations = torch.zeros(
+            args.batch_size, T_txt, dtype=torch.bool, device=args.device
+        )
+        media_locations[:, :: args.tokens_per_shot] = True
+
+        with torch.inference_mode():
+            out_masked, t_masked, mem_masked = time_forward(
+                masked, x, media, media_locations, num_iters=args.num_iters
+            )
+            out_gathered, t_gathered, mem_gathered = time_forward(
+                gathered, x, media, media_locations, num_iters=args.num_iters
+            )
+        max_diff = (out_masked - out_gathered).abs().max().item()
+        print(
+            f"{shot} | {T_txt} | {t_masked * 1000:.2f} | {t_gathered * 1000:.2f} | "
+            f"{mem_masked:.1f} | {mem_gathered:.1f} | {max_diff:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark EvalModel.get_rank_classifications over the ImageNet class names, scoring the class names
+one at a time (the per-class loop) and over a shared token trie.
+Uses random images and in-context demonstrations; reports samples/s and the max difference of the logprobs.
+
+Model arguments are passed as for evaluate.py, e.g.
+    python benchmark_rank_classification.py --vision_encoder_path ViT-L-14 --vision_encoder_pretrained openai
+        --lm_path anas-awadalla/mpt-1b-redpajama-200b --lm_tokenizer_path anas-awadalla/mpt-1b-redpajama-200b
+        --cross_attn_every_n_layers 1 --checkpoint_path checkpoint.pt --precision amp_bf16 --device 0
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from open_flamingo.eval.classification_utils import IMAGENET_CLASSNAMES
+from open_flamingo.eval.models.open_flamingo import EvalModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--num_batches", type=int, default=2)
+parser.add_argument("--shots", type=int, default=4)
+parser.add_argument("--seed", type=int, default=0)
+
+
+def make_batch(eval_model, batch_size, shots, rng):
+    batch_text, batch_images = [], []
+    for _ in range(batch_size):
+        labels = rng.sample(IMAGENET_CLASSNAMES, shots)
+        batch_text.append(
+            "".join(eval_model.get_imagenet_prompt(label) + "\n" for label in labels)
+            + eval_model.get_imagenet_prompt()
+        )
+        batch_images.append(
+            [
+                Image.fromarray(
+                    np.random.RandomState(rng.randrange(2**31))
+                    .randint(0, 256, (224, 224, 3))
+                    .astype(np.uint8)
+                )
+                for _ in range(shots + 1)
+            ]
+        )
+    return batch_text, batch_images
+
+
+def time_rank_classifications(eval_model, batches):
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    sync()
+    start = time.perf_counter()
+    logprobs = [
+        eval_model.get_rank_classifications(
+            batch_text,
+            batch_images,
+            IMAGENET_CLASSNAMES,
+            use_cache=True,
+            normalize_length=True,
+        )
+        for batch_text, batch_images in batches
+    ]
+    sync()
+    return torch.cat(logprobs), time.perf_counter() - start
+
+
+def main():
+    args, leftovers = parser.parse_known_args()
+    model_args = {
+        leftovers[i].lstrip("-"): leftovers[i + 1] for i in range(0, len(leftovers), 2)
+    }
+    if "device" in model_args:
+        model_args["device"] = int(model_args["device"])
+    eval_model = EvalModel(model_args)
+
+    rng = random.Random(args.seed)
+    batches = [
+        make_batch(eval_model, args.batch_size, args.shots, rng)
+        for _ in range(args.num_batches)
+    ]
+    num_samples = args.batch_size * args.num_batches
+
+    print("scoring | samples/s")
+    eval_model.use_class_name_trie = False
+    loop_logprobs, loop_time = time_rank_classifications(eval_model, batches)
+    print(f"per-class loop | {num_samples / loop_time:.3f}")
+    eval_model.use_class_name_trie = True
+    trie_logprobs, trie_time = time_rank_classifications(eval_model, batches)
+    print(f"trie | {num_samples / trie_time:.3f}")
+    print(f"max abs diff: {(loop_logprobs - trie_logprobs).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark the per-token decode latency of StaticCacheDecoder (eager and torch.compile) against Flamingo.generate.
+Per-token latency is (time to generate N tokens - time to generate 1 token) / (N - 1), so the prompt is excluded.
+By default uses randomly initialized vision weights and a small language model, which is enough to time decoding.
+"""
+import argparse
+import time
+
+import torch
+
+from open_flamingo import create_model_and_transforms
+from open_flamingo.src.static_decoding import StaticCacheDecoder
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vision_encoder_path", default="ViT-B-32", type=str)
+parser.add_argument("--vision_encoder_pretrained", default=None, type=str)
+parser.add_argument("--lm_path", default="facebook/opt-125m", type=str)
+parser.add_argument("--lm_tokenizer_path", default="facebook/opt-125m", type=str)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--batch_size", type=int, default=4)
+parser.add_argument("--num_images", type=int, default=2)
+parser.add_argument("--prompt_tokens", type=int, default=64)
+parser.add_argument("--max_new_tokens", type=int, default=32)
+parser.add_argument(
+    "--compile_mode",
+    default=None,
+    type=str,
+    help="torch.compile mode for the compiled decode step, e.g. reduce-overhead.",
+)
+parser.add_argument("--num_iters", type=int, default=3)
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+
+def time_generate(generate, max_new_tokens, num_iters):
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def timed(num_tokens):
+        sync()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            output = generate(num_tokens)
+        sync()
+        return output, (time.perf_counter() - start) / num_iters
+
+    generate(max_new_tokens)  # warmup, also compiles
+    _, t_first = timed(1)
+    output, t_all = timed(max_new_tokens)
+    return output, (t_all - t_first) / (max_new_tokens - 1)
+
+
+def main():
+    args = parser.parse_args()
+    model, _, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+    )
+    model.to(args.device).eval()
+
+    image_size = model.vision_encoder.image_size
+    image_size = image_size if isinstance(image_size, tuple) else (image_size,) * 2
+    vision_x = torch.randn(
+        (args.batch_size, args.num_images, 1, 3) + image_size, device=args.device
+    )
+    lang_x = torch.randint(
+        0, len(tokenizer) - 2, (args.batch_size, args.prompt_tokens), device=args.device
+    )
+    tokens_per_image = args.prompt_tokens // args.num_images
+    lang_x[:, ::tokens_per_image] = model.media_token_id
+    max_length = args.prompt_tokens + args.max_new_tokens
+
+    # never stop early, so every path generates the same number of tokens
+    def generate_hf(num_tokens):
+        with torch.inference_mode():
+            return model.generate(
+                vision_x,
+                lang_x,
+                max_new_tokens=num_tokens,
+                eos_token_id=-1,
+                num_beams=1,
+            )
+
+    def generate_static(decoder):
+        return lambda num_tokens: decoder.generate(
+            vision_x, lang_x, max_new_tokens=num_tokens, eos_token_id=-1
+        )
+
+    paths = {
+        "Flamingo.generate": generate_hf,
+        "static": generate_static(StaticCacheDecoder(model, max_length)),
+        "static + compile": generate_static(
+            StaticCacheDecoder(model, max_length, compile=True, mode=args.compile_mode)
+        ),
+    }
+    print("path | ms / token | same tokens as Flamingo.generate")
+    reference = None
+    for name, generate in paths.items():
+        output, latency = time_generate(generate, args.max_new_tokens, args.num_iters)
+        if reference is None:
+            reference = output
+        print(f"{name} | {latency * 1000:.2f} | {torch.equal(output, reference)}")
+
+
+if __name__ == "__main__":
+    main()
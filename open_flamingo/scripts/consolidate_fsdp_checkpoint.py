@@ -0,0 +1,80 @@
+"""
+Convert a sharded checkpoint, written by train.py with --fsdp --fsdp_sharded_checkpoint, into the single-file
+checkpoint format that train.py writes without --fsdp_sharded_checkpoint and that the evaluation code loads.
+
+Runs in a single process without GPUs: the shards of every tensor are read into full CPU tensors, so the host
+needs memory for the full model (and, without --model_only, optimizer) state.
+
+Usage:
+    python consolidate_fsdp_checkpoint.py --checkpoint /path/to/run_name/checkpoint_3 --output checkpoint_3.pt
+"""
+import argparse
+import os
+
+import torch
+import torch.distributed.checkpoint as dist_cp
+from torch.distributed.checkpoint._nested_dict import unflatten_state_dict
+from torch.distributed.checkpoint.default_planner import DefaultLoadPlanner
+from torch.distributed.checkpoint.metadata import TensorStorageMetadata
+
+# same as in train/train_utils.py
+SHARDED_CHECKPOINT_EXTRA_STATE = "extra_state.pt"
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="sharded checkpoint directory, e.g. run_name/checkpoint_3",
+)
+parser.add_argument("--output", type=str, required=True, help="output .pt file")
+parser.add_argument(
+    "--model_only",
+    action="store_true",
+    help="only write the model state, e.g. for evaluation",
+)
+
+
+def load_full_state_dict(checkpoint):
+    """Read the shards of a checkpoint directory into a nested state dict of full CPU tensors."""
+    storage_reader = dist_cp.FileSystemReader(checkpoint)
+    metadata = storage_reader.read_metadata()
+    # allocate the full tensors; other values are read as they were saved
+    state_dict = {
+        key: torch.empty(md.size, dtype=md.properties.dtype)
+        if isinstance(md, TensorStorageMetadata)
+        else None
+        for key, md in metadata.state_dict_metadata.items()
+    }
+    dist_cp.load_state_dict(
+        state_dict=state_dict,
+        storage_reader=storage_reader,
+        planner=DefaultLoadPlanner(flatten_state_dict=False),
+        no_dist=True,
+    )
+    if metadata.planner_data is not None:
+        # the nested state dict was flattened to these keys when saving
+        state_dict = unflatten_state_dict(state_dict, metadata.planner_data)
+    return state_dict
+
+
+def main():
+    args = parser.parse_args()
+    state_dict = load_full_state_dict(args.checkpoint)
+    if args.model_only:
+        checkpoint_dict = {"model_state_dict": state_dict["model"]}
+    else:
+        # epoch, step, lr_scheduler_state_dict and rank_states, which hold numpy random number generator states
+        checkpoint_dict = torch.load(
+            os.path.join(args.checkpoint, SHARDED_CHECKPOINT_EXTRA_STATE),
+            map_location="cpu",
+            weights_only=False,
+        )
+        checkpoint_dict["model_state_dict"] = state_dict["model"]
+        checkpoint_dict["optimizer_state_dict"] = state_dict["optim"]
+    torch.save(checkpoint_dict, args.output)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
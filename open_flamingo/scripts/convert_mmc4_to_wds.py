@@ -1,14 +1,25 @@
+"""
+Convert downloaded MMC4 zip shards and images into webdataset shards for training.
+
+Output shard i holds the documents of zip files [i * num_files_per_shard, (i + 1) * num_files_per_shard).
+Each document is a sample with key <zip index>_<line index>, holding the json and one tar member per image:
+the original image file, or with --resize_shorter_side a downscaled JPEG. The json's image_info entries of the
+stored images get an "image_member" field naming their member.
+
+Shards are converted in parallel by --num_workers processes. Completed shards are recorded in progress.jsonl
+in the output directory, so a killed run can be restarted with the same arguments and resumes where it left off.
+"""
 import argparse
 import json
 import os
-import uuid
+import re
 import zipfile
-from PIL import Image
-import base64
 from io import BytesIO
+from multiprocessing import Pool
 
 import braceexpand
 import webdataset as wds
+from PIL import Image
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument(
@@ -31,54 +42,130 @@ arg_parser.add_argument(
     type=int,
     default=1000,
 )
+arg_parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="Number of processes converting shards in parallel.",
+)
+arg_parser.add_argument(
+    "--resize_shorter_side",
+    type=int,
+    default=None,
+    help="If given, store images as JPEGs downscaled to this shorter side instead of the original files.",
+)
+arg_parser.add_argument("--jpeg_quality", type=int, default=95)
 args = arg_parser.parse_args()
 
+PROGRESS_FILE = "progress.jsonl"
 
-def main():
-    os.makedirs(args.output_dir, exist_ok=True)
 
-    doc_shards = list(braceexpand.braceexpand(args.zip_files))
+def load_image_bytes(path):
+    """Returns the bytes and file extension of the image to store."""
+    if args.resize_shorter_side is None:
+        with open(path, "rb") as f:
+            rawbytes = f.read()
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        return rawbytes, extension if re.fullmatch(r"[a-z0-9]+", extension) else "img"
 
-    with wds.ShardWriter(args.output_dir + "/%09d.tar") as sink:
-        for idx in range(len(doc_shards)):
+    img = Image.open(path).convert("RGB")
+    scale = args.resize_shorter_side / min(img.size)
+    if scale < 1:
+        img = img.resize(
+            (round(img.width * scale), round(img.height * scale)), Image.BICUBIC
+        )
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=args.jpeg_quality)
+    return buffered.getvalue(), "jpg"
+
+
+def convert_shard(shard_idx, zip_files):
+    """Write output shard shard_idx from its zip_files, a slice of all zip files. Returns its progress record."""
+    output_path = os.path.join(args.output_dir, f"{shard_idx:09d}.tar")
+    start = shard_idx * args.num_files_per_shard
+    num_samples, num_images = 0, 0
+    # write to a temporary file, so that a killed run never leaves a truncated shard
+    with wds.TarWriter(output_path + ".tmp") as sink:
+        for idx, zip_path in enumerate(zip_files, start=start):
             # Open the ZIP archive and extract the JSON file
-            with zipfile.ZipFile(doc_shards[idx], "r") as zip_file:
+            with zipfile.ZipFile(zip_path, "r") as zip_file:
                 # Assumes the JSON file is the first file in the archive
                 json_filename = zip_file.namelist()[0]
                 with zip_file.open(json_filename, "r") as json_file:
-                    for sample_data in json_file:
+                    for line_idx, sample_data in enumerate(json_file):
                         # get image names from json
                         sample_data = json.loads(sample_data)
-                        image_info = sample_data["image_info"]
-                        image_names = [image["image_name"] for image in image_info]
+                        sample = {"__key__": f"{idx:06d}_{line_idx:06d}"}
 
-                        # Add each image to the tar file
-                        for img_idx, image_name in enumerate(image_names):
+                        # Add each image to the sample as its own tar member
+                        for img_idx, image_info in enumerate(sample_data["image_info"]):
+                            image_name = image_info["image_name"]
                             try:
-                                # load image
-                                img = Image.open(
+                                rawbytes, extension = load_image_bytes(
                                     os.path.join(args.image_dir, str(idx), image_name)
-                                ).convert("RGB")
-                                buffered = BytesIO()
-                                img.save(buffered, format="JPEG")
-                                img_str = base64.b64encode(buffered.getvalue())
-
-                                # convert to base64
-                                sample_data["image_info"][img_idx][
-                                    "image_base64"
-                                ] = img_str.decode("utf-8")
+                                )
                             except FileNotFoundError:
                                 print(
                                     f"Did not find {image_name} downloaded. This can happen if the url is now 404."
                                 )
+                                continue
                             except Exception as e:
                                 print(f"Error processing {image_name}: {e}")
+                                continue
+                            member = f"image{img_idx}.{extension}"
+                            image_info["image_member"] = member
+                            sample[member] = rawbytes
+                            num_images += 1
+
+                        sample["json"] = sample_data
+                        sink.write(sample)
+                        num_samples += 1
+    os.rename(output_path + ".tmp", output_path)
+    return {
+        "shard": os.path.basename(output_path),
+        "shard_idx": shard_idx,
+        "num_samples": num_samples,
+        "num_images": num_images,
+    }
+
+
+def _convert_shard(task):
+    return convert_shard(*task)
+
+
+def main():
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    doc_shards = list(braceexpand.braceexpand(args.zip_files))
+    num_output_shards = -(-len(doc_shards) // args.num_files_per_shard)
+
+    progress_path = os.path.join(args.output_dir, PROGRESS_FILE)
+    progress = []
+    if os.path.exists(progress_path):
+        with open(progress_path, "r") as f:
+            progress = [json.loads(line) for line in f]
+    done = {record["shard_idx"] for record in progress}
+    # each task only carries the zip files of its shard, not the whole list
+    n = args.num_files_per_shard
+    tasks = [
+        (shard_idx, doc_shards[shard_idx * n : (shard_idx + 1) * n])
+        for shard_idx in range(num_output_shards)
+        if shard_idx not in done
+    ]
+    print(f"Converting {len(tasks)} of {num_output_shards} shards")
 
-                        key_str = uuid.uuid4().hex
-                        sink.write({"__key__": key_str, "json": sample_data})
+    with Pool(args.num_workers) as pool, open(progress_path, "a") as progress_file:
+        for record in pool.imap_unordered(_convert_shard, tasks):
+            progress_file.write(json.dumps(record) + "\n")
+            progress_file.flush()
+            progress.append(record)
+            print(
+                f"Wrote {record['shard']} ({len(progress)}/{num_output_shards} shards)"
+            )
 
-            if (idx + 1) % args.num_files_per_shard == 0:
-                sink.next_stream()
+    # sample counts per shard, read by get_dataset_size
+    with open(os.path.join(args.output_dir, "sizes.json"), "w") as f:
+        json.dump({record["shard"]: record["num_samples"] for record in progress}, f)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+"""
+Precompute vision encoder patch tokens, i.e. vision_encoder(images)[1], for LAION or MMC4 webdataset shards,
+so that training with --vision_features runs only the perceiver and skips the frozen vision encoder.
+
+Each input shard is written to a shard of the same name in --output_dir, where the images are replaced by an
+"npy" entry holding the float16 patch tokens of the sample's images, of shape (num_images, v, d):
+    - LAION: {"txt", "npy"} with num_images = 1
+    - MMC4: {"json", "npy"}, where the base64 images in the json are replaced by a "feature_index" into the
+      npy array. MMC4 images of at most MIN_KB are dropped, like in train/data.py.
+Existing output shards are skipped, so an interrupted run can be restarted with the same arguments.
+
+With --pca_dim k, the patch tokens are projected onto their top k principal components to shrink the shards.
+The PCA is fitted on the first --pca_num_images images and saved to <output_dir>/pca.npz; pass it to train.py
+with --vision_features_pca. LAION and MMC4 features must share one PCA: pass --pca_path to reuse an existing
+pca.npz. Random horizontal flips are not applied, since they cannot be applied to precomputed features.
+
+Usage:
+    python precompute_vision_features.py --dataset_type laion --input_shards /path/to/laion/{00000..00999}.tar
+        --output_dir /path/to/laion_features --vision_encoder_path ViT-L-14 --vision_encoder_pretrained openai
+"""
+import argparse
+import base64
+import json
+import os
+from io import BytesIO
+
+import braceexpand
+import numpy as np
+import open_clip
+import torch
+import webdataset as wds
+from PIL import Image
+
+# same as in train/data.py
+MIN_KB = 10
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--dataset_type", choices=["laion", "mmc4"], required=True)
+arg_parser.add_argument(
+    "--input_shards",
+    type=str,
+    required=True,
+    help="shards to encode, a brace pattern such as /path/to/shards/{00000..00999}.tar",
+)
+arg_parser.add_argument(
+    "--output_dir",
+    type=str,
+    required=True,
+    help="directory where the feature shards (and pca.npz) will be written to",
+)
+arg_parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+arg_parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+arg_parser.add_argument("--batch_size", type=int, default=256)
+arg_parser.add_argument(
+    "--pca_dim",
+    type=int,
+    default=None,
+    help="if given, store the patch tokens projected onto their top pca_dim principal components",
+)
+arg_parser.add_argument("--pca_num_images", type=int, default=500)
+arg_parser.add_argument(
+    "--pca_path",
+    type=str,
+    default=None,
+    help="existing pca.npz to compress the patch tokens with, instead of fitting a new PCA",
+)
+arg_parser.add_argument(
+    "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+)
+
+
+def load_image(rawbytes):
+    return Image.open(BytesIO(rawbytes)).convert("RGB")
+
+
+def prepare_laion(sample):
+    """Returns the images of a LAION sample and the output sample without its features, or None to skip it."""
+    image_key = next((k for k in ("jpg", "png", "jpeg") if k in sample), None)
+    if "txt" not in sample or image_key is None:
+        return None
+    output = {"__key__": sample["__key__"], "txt": sample["txt"].decode("utf-8")}
+    return [load_image(sample[image_key])], output
+
+
+def prepare_mmc4(sample):
+    """Returns the images of an MMC4 / ChatGPT sample and the output sample without its features, or None."""
+    if "json" not in sample:
+        return None
+    info = json.loads(sample["json"])
+    images = []
+    if "is_gpt" in info:
+        for image_key in range(1, len(info["image_map"]) + 1):
+            image_info = info["image_map"][f"_!_IMAGE{image_key}_!_"]
+            rawbytes = base64.b64decode(image_info.pop("base64_image"))
+            image_info["feature_index"] = len(images)
+            images.append(load_image(rawbytes))
+    else:
+        for image_info in info["image_info"]:
+            # images are base64-encoded in the json or, for shards written by
+            # convert_mmc4_to_wds.py, tar members of the sample
+            if "image_member" in image_info:
+                rawbytes = sample.get(image_info.pop("image_member"))
+                if rawbytes is None:
+                    continue
+            elif "image_base64" in image_info:
+                rawbytes = base64.b64decode(image_info.pop("image_base64"))
+            else:
+                continue
+            # filter to images >= 10KB
+            if len(rawbytes) // 1000 <= MIN_KB:
+                continue
+            image_info["feature_index"] = len(images)
+            images.append(load_image(rawbytes))
+    if len(images) == 0:
+        return None
+    return images, {"__key__": sample["__key__"], "json": info}
+
+
+def iter_prepared(shards, prepare_fn):
+    for shard in shards:
+        for sample in wds.WebDataset(shard):
+            try:
+                prepared = prepare_fn(sample)
+            except Exception as e:
+                print(f"Error processing {sample.get('__key__')} in {shard}: {e}")
+                continue
+            if prepared is not None:
+                yield prepared
+
+
+class PatchTokenEncoder:
+    def __init__(
+        self, vision_encoder_path, vision_encoder_pretrained, device, batch_size
+    ):
+        model, _, self.image_processor = open_clip.create_model_and_transforms(
+            vision_encoder_path, pretrained=vision_encoder_pretrained
+        )
+        self.vision_encoder = model.visual.to(device).eval()
+        self.vision_encoder.output_tokens = True
+        self.device = device
+        self.batch_size = batch_size
+        self.pca = None
+
+    @torch.inference_mode()
+    def encode(self, images):
+        """Returns the float32 patch tokens of a list of PIL images, of shape (N, v, d)."""
+        features = []
+        for i in range(0, len(images), self.batch_size):
+            batch = images[i : i + self.batch_size]
+            x = torch.stack([self.image_processor(image) for image in batch])
+            x = x.to(self.device)
+            with torch.autocast(
+                device_type=torch.device(self.device).type,
+                enabled=self.device != "cpu",
+            ):
+                features.append(self.vision_encoder(x)[1].float())
+        return torch.cat(features)
+
+    def fit_pca(self, images, pca_dim):
+        """Fit the PCA used by compress() on the patch tokens of images."""
+        x = self.encode(images).flatten(0, 1)
+        mean = x.mean(dim=0)
+        _, _, V = torch.pca_lowrank(x - mean, q=pca_dim, center=False)
+        self.pca = {"mean": mean, "components": V.T.contiguous()}
+
+    def compress(self, features):
+        """Returns the float16 numpy array stored in the shards, projected with the PCA if there is one."""
+        if self.pca is not None:
+            features = (features - self.pca["mean"]) @ self.pca["components"].T
+        return features.half().cpu().numpy()
+
+
+def main():
+    args = arg_parser.parse_args()
+    assert args.pca_dim is None or args.pca_path is None, "pass pca_dim or pca_path"
+    os.makedirs(args.output_dir, exist_ok=True)
+    shards = list(braceexpand.braceexpand(args.input_shards))
+    prepare_fn = prepare_laion if args.dataset_type == "laion" else prepare_mmc4
+    encoder = PatchTokenEncoder(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.device,
+        args.batch_size,
+    )
+
+    if args.pca_path is not None:
+        pca = np.load(args.pca_path)
+        encoder.pca = {
+            k: torch.from_numpy(pca[k]).to(args.device) for k in ("mean", "components")
+        }
+    elif args.pca_dim is not None:
+        pca_path = os.path.join(args.output_dir, "pca.npz")
+        images = []
+        for sample_images, _ in iter_prepared(shards, prepare_fn):
+            images += sample_images
+            if len(images) >= args.pca_num_images:
+                break
+        encoder.fit_pca(images[: args.pca_num_images], args.pca_dim)
+        np.savez(pca_path, **{k: v.cpu().numpy() for k, v in encoder.pca.items()})
+        print(f"Saved the PCA to {pca_path}")
+
+    for shard in shards:
+        output_path = os.path.join(args.output_dir, os.path.basename(shard))
+        if os.path.exists(output_path):
+            print(f"Skipping {shard}, {output_path} exists")
+            continue
+
+        # write to a temporary file, so that only complete shards are skipped on restart
+        with wds.TarWriter(output_path + ".tmp") as sink:
+            pending, num_pending_images = [], 0
+            for images, output in iter_prepared([shard], prepare_fn):
+                pending.append((images, output))
+                num_pending_images += len(images)
+                if num_pending_images < args.batch_size:
+                    continue
+                write_samples(sink, encoder, pending)
+                pending, num_pending_images = [], 0
+            if len(pending) > 0:
+                write_samples(sink, encoder, pending)
+        os.rename(output_path + ".tmp", output_path)
+        print(f"Wrote {output_path}")
+
+
+def write_samples(sink, encoder, samples):
+    """Encode the images of several samples together, then write each sample with its features."""
+    features = encoder.encode([image for images, _ in samples for image in images])
+    start = 0
+    for images, output in samples:
+        output["npy"] = encoder.compress(features[start : start + len(images)])
+        start += len(images)
+        sink.write(output)
+
+
+if __name__ == "__main__":
+    main()
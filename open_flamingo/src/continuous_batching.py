@@ -0,0 +1,338 @@
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+from .flamingo import Flamingo
+
+
+@dataclass
+class GenerationRequest:
+    """A prompt submitted to ContinuousBatchingEngine and its greedy continuation."""
+
+    request_id: int
+    vision_x: torch.Tensor  # (1, T_img, F, C, H, W)
+    lang_x: torch.Tensor  # (1, T_txt)
+    max_new_tokens: int
+    min_new_tokens: int = 0
+    image_ids: list = None
+    output_ids: List[int] = field(default_factory=list)
+    done: bool = False
+    arrival_time: float = None
+    first_token_time: float = None
+    finish_time: float = None
+
+    @property
+    def sequence(self):
+        """lang_x with the generated tokens appended, like the output of Flamingo.generate"""
+        return torch.cat(
+            [self.lang_x, self.lang_x.new_tensor([self.output_ids])], dim=1
+        )
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level scheduler for greedy generation with a Flamingo model.
+
+    Unlike Flamingo.generate, which runs a fixed batch until its longest sequence finishes, the engine
+    admits waiting requests and retires finished ones between decode steps, so a short caption does not
+    wait for a long answer and new requests do not wait for the whole batch.
+
+    Each running sequence keeps its own media (perceiver latents, padded to the longest T_img of the batch),
+    media locations and rows of the past_key_values. Sequences are left-padded to a common length; the
+    padding is masked out and trimmed once no sequence needs it.
+    """
+
+    def __init__(
+        self,
+        model: Flamingo,
+        max_batch_size: int = 16,
+        eos_token_id: int = None,
+    ):
+        """
+        Args:
+            model (Flamingo): model to generate with. Prompts are prefilled with model.prefill() if the
+                model has a prefix cache (see Flamingo.enable_prefix_cache), else with a plain forward pass.
+            max_batch_size (int, optional): maximum number of sequences decoded together. Defaults to 16.
+            eos_token_id (int, optional): token that ends a sequence. Defaults to the <|endofchunk|> token.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.eos_token_id = (
+            eos_token_id if eos_token_id is not None else model.eoc_token_id
+        )
+        self.waiting = deque()
+        self.running = []
+        self._ids = itertools.count()
+        self._state = None
+        self.num_steps = 0
+
+    def add_request(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        max_new_tokens: int,
+        min_new_tokens: int = 0,
+        image_ids=None,
+    ) -> GenerationRequest:
+        """
+        Queue a prompt for generation; it joins the running batch at the next step().
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (1, T_img, F, C, H, W)
+            lang_x (torch.Tensor): Language input, without padding
+                shape (1, T_txt)
+            max_new_tokens (int): maximum number of tokens to generate
+            min_new_tokens (int, optional): minimum number of tokens to generate before eos is allowed.
+            image_ids (list, optional): ids of the images in vision_x, a list of 1 list of T_img ids.
+                Used as keys for the vision feature and prefix caches.
+        Returns:
+            GenerationRequest: updated in place as tokens are generated
+        """
+        assert vision_x.shape[0] == 1 and lang_x.shape[0] == 1
+        request = GenerationRequest(
+            request_id=next(self._ids),
+            vision_x=vision_x,
+            lang_x=lang_x,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=min_new_tokens,
+            image_ids=image_ids,
+            arrival_time=time.perf_counter(),
+        )
+        self.waiting.append(request)
+        return request
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    @torch.inference_mode()
+    def step(self) -> List[GenerationRequest]:
+        """
+        Admit waiting requests into free batch slots (prefilling their prompts), then run one decode step
+        for every running sequence.
+        Returns:
+            list of the requests that finished during this step
+        """
+        finished = []
+        num_free = self.max_batch_size - len(self.running)
+        if num_free > 0 and len(self.waiting) > 0:
+            admitted = [
+                self.waiting.popleft() for _ in range(min(num_free, len(self.waiting)))
+            ]
+            finished += self._prefill(admitted)
+        if len(self.running) > 0:
+            finished += self._decode()
+        self.num_steps += 1
+        return finished
+
+    def run(self) -> List[GenerationRequest]:
+        """Step until all queued requests are finished and return them in order of completion."""
+        finished = []
+        while self.has_unfinished_requests():
+            finished += self.step()
+        return finished
+
+    def _prefill(self, requests):
+        """Run the prompts of newly admitted requests and add them to the running batch."""
+        model = self.model
+        lang_x, attention_mask = _left_pad(
+            [r.lang_x[0] for r in requests], pad_value=self.eos_token_id
+        )
+        vision_x = _pad_images([r.vision_x for r in requests])
+        image_ids = None
+        if all(r.image_ids is not None for r in requests):
+            image_ids = [
+                r.image_ids[0] + [None] * (vision_x.shape[1] - len(r.image_ids[0]))
+                for r in requests
+            ]
+
+        model.lang_encoder._use_cached_vision_x = False
+        try:
+            if model.prefix_cache is not None:
+                output, attention_mask = model.prefill(
+                    lang_x=lang_x,
+                    vision_x=vision_x,
+                    attention_mask=attention_mask,
+                    image_ids=image_ids,
+                )
+            else:
+                # positions follow the attention mask, like in the decode steps
+                model._encode_vision_x(vision_x=vision_x, image_ids=image_ids)
+                output = model.lang_encoder(
+                    input_ids=lang_x,
+                    attention_mask=attention_mask,
+                    use_cache=True,
+                    **model._position_ids_kwargs(attention_mask, lang_x.shape[1]),
+                )
+            layer = model.lang_encoder._get_decoder_layers()[0]
+            state = _BatchState(
+                past_key_values=output.past_key_values,
+                attention_mask=attention_mask.bool(),
+                media_locations=layer.media_locations,
+                vis_x=layer.vis_x,
+                kv_seq_dims=model.lang_encoder.kv_seq_dims,
+            )
+        finally:
+            # model.prefill() leaves the media cached for decoding, which the next step redoes;
+            # leave the model usable even if every admitted request finishes here
+            model.lang_encoder.clear_conditioned_layers()
+            model.lang_encoder._use_cached_vision_x = False
+        self._state = state if self._state is None else self._state.merge(state)
+        self.running += requests
+        return self._append_tokens(requests, output.logits[:, -1])
+
+    def _decode(self):
+        """Run one decode step for all running sequences."""
+        model, state = self.model, self._state
+        next_tokens = torch.tensor(
+            [[r.output_ids[-1]] for r in self.running],
+            device=state.attention_mask.device,
+        )
+        attention_mask = F.pad(state.attention_mask, (0, 1), value=True)
+
+        # every decoded token attends to the last media of its sequence
+        model.lang_encoder._use_cached_vision_x = True
+        layers = model.lang_encoder._get_decoder_layers()
+        try:
+            for i, layer in enumerate(layers):
+                layer.condition_vis_x(state.vis_x)
+                layer.condition_media_locations(state.media_locations)
+                if state.media_kv is not None:
+                    # reuse the keys / values projected from vis_x in the previous step
+                    layer.media_kv = state.media_kv[i]
+            output = model.lang_encoder(
+                input_ids=next_tokens,
+                attention_mask=attention_mask,
+                past_key_values=state.past_key_values,
+                use_cache=True,
+                **model._position_ids_kwargs(attention_mask, 1),
+            )
+            state.media_kv = [layer.media_kv for layer in layers]
+        finally:
+            model.lang_encoder.clear_conditioned_layers()
+            model.lang_encoder._use_cached_vision_x = False
+
+        state.past_key_values = output.past_key_values
+        state.attention_mask = attention_mask
+        state.media_locations = F.pad(state.media_locations, (0, 1), value=False)
+        return self._append_tokens(self.running, output.logits[:, -1])
+
+    def _append_tokens(self, requests, logits):
+        """Greedily pick the next token of each request, then retire finished requests."""
+        now = time.perf_counter()
+        for request, request_logits in zip(requests, logits):
+            if len(request.output_ids) < request.min_new_tokens:
+                request_logits = request_logits.clone()
+                request_logits[self.eos_token_id] = -float("inf")
+            request.output_ids.append(int(request_logits.argmax()))
+            if request.first_token_time is None:
+                request.first_token_time = now
+            if (
+                request.output_ids[-1] == self.eos_token_id
+                or len(request.output_ids) >= request.max_new_tokens
+            ):
+                request.done = True
+                request.finish_time = now
+
+        finished = [r for r in self.running if r.done]
+        if len(finished) > 0:
+            keep = [i for i, r in enumerate(self.running) if not r.done]
+            self.running = [self.running[i] for i in keep]
+            self._state = self._state.select(keep) if len(keep) > 0 else None
+        return finished
+
+
+class _BatchState:
+    """Batched conditioning and past_key_values of the running sequences (along dim 0)."""
+
+    def __init__(
+        self, past_key_values, attention_mask, media_locations, vis_x, kv_seq_dims
+    ):
+        self.past_key_values = (
+            past_key_values  # tensors of (B, ...) with L along kv_seq_dims
+        )
+        self.kv_seq_dims = kv_seq_dims  # sequence dims of the keys and of the values
+        self.attention_mask = attention_mask  # (B, L)
+        self.media_locations = media_locations  # (B, L)
+        self.vis_x = vis_x  # (B, T_img, n, d)
+        self.media_kv = None  # per layer keys / values projected from vis_x
+
+    def merge(self, other):
+        """Concatenate the sequences of two states, left-padding them to the same length."""
+        L = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+        T_img = max(self.vis_x.shape[1], other.vis_x.shape[1])
+        states = [self, other]
+        return _BatchState(
+            past_key_values=tuple(
+                tuple(
+                    torch.cat([_left_pad_to(t, L, dim=dim) for t in tensors], dim=0)
+                    for tensors, dim in zip(zip(*layers), self.kv_seq_dims)
+                )
+                for layers in zip(*[s.past_key_values for s in states])
+            ),
+            attention_mask=torch.cat(
+                [_left_pad_to(s.attention_mask, L, dim=1) for s in states]
+            ),
+            media_locations=torch.cat(
+                [_left_pad_to(s.media_locations, L, dim=1) for s in states]
+            ),
+            vis_x=torch.cat(
+                [
+                    F.pad(s.vis_x, (0, 0, 0, 0, 0, T_img - s.vis_x.shape[1]))
+                    for s in states
+                ]
+            ),
+            kv_seq_dims=self.kv_seq_dims,
+        )
+
+    def select(self, rows):
+        """Keep the given rows, dropping padding columns that no remaining sequence needs."""
+        rows = torch.tensor(rows, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[rows]
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        length = attention_mask.shape[1] - start
+        return _BatchState(
+            past_key_values=tuple(
+                tuple(
+                    t[rows].narrow(dim, start, length)
+                    for t, dim in zip(layer, self.kv_seq_dims)
+                )
+                for layer in self.past_key_values
+            ),
+            attention_mask=attention_mask[:, start:],
+            media_locations=self.media_locations[rows][:, start:],
+            vis_x=self.vis_x[rows],
+            kv_seq_dims=self.kv_seq_dims,
+        )
+
+
+def _left_pad(sequences, pad_value):
+    """Stack 1D tensors, left-padding them to the longest. Returns (padded, attention_mask)."""
+    length = max(len(s) for s in sequences)
+    padded = sequences[0].new_full((len(sequences), length), pad_value)
+    attention_mask = torch.zeros_like(padded, dtype=torch.bool)
+    for i, s in enumerate(sequences):
+        padded[i, length - len(s) :] = s
+        attention_mask[i, length - len(s) :] = True
+    return padded, attention_mask
+
+
+def _pad_images(vision_x):
+    """Concatenate (1, T_img, F, C, H, W) tensors, padding T_img with all-zero images."""
+    T_img = max(x.shape[1] for x in vision_x)
+    return torch.cat(
+        [
+            torch.cat([x, x.new_zeros((1, T_img - x.shape[1]) + x.shape[2:])], dim=1)
+            for x in vision_x
+        ]
+    )
+
+
+def _left_pad_to(t, length, dim):
+    dim = dim % t.ndim
+    pad = [0, 0] * (t.ndim - dim - 1) + [length - t.shape[dim], 0]
+    return F.pad(t, pad)
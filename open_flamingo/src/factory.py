@@ -78,6 +78,7 @@ def create_model_and_transforms(
     if decoder_layers_attr_name is None:
         decoder_layers_attr_name = _infer_decoder_layers_attr_name(lang_encoder)
     lang_encoder.set_decoder_layers_attr_name(decoder_layers_attr_name)
+    lang_encoder.set_kv_seq_dims(_infer_kv_seq_dims(lang_encoder))
     lang_encoder.resize_token_embeddings(len(text_tokenizer))
 
     model = Flamingo(
@@ -96,11 +97,15 @@ def create_model_and_transforms(
     model.requires_grad_(False)
     assert sum(p.numel() for p in model.parameters() if p.requires_grad) == 0
 
-    # Unfreeze perceiver, gated_cross_attn_layers, and LM input embeddings
+    # Unfreeze perceiver, gated_cross_attn_layers, and the LM input embeddings of the added tokens
     model.perceiver.requires_grad_(True)
     model.lang_encoder.gated_cross_attn_layers.requires_grad_(True)
     if not freeze_lm_embeddings:
-        model.lang_encoder.get_input_embeddings().requires_grad_(True)
+        # only the rows of the added tokens are trained: in a small embedding next to the frozen LM embeddings or,
+        # for MPT-1B, which computes its logits from the input embeddings weight, with the other rows' gradients zeroed
+        model.lang_encoder.init_trainable_token_embeddings(
+            [model.eoc_token_id, model.media_token_id]
+        )
         # TODO: investigate also training the output embeddings when untied
 
     print(
@@ -120,6 +125,17 @@ def _infer_decoder_layers_attr_name(model):
     )
 
 
+def _infer_kv_seq_dims(model):
+    return __KNOWN_KV_SEQ_DIMS.get(model.__class__.__name__, (-2, -2))
+
+
+# sequence dimensions of the keys and values in past_key_values of language models that do not use the Hugging Face
+# layout (batch, heads, sequence, head_dim). Matched on the exact class name: MosaicML's remote code MPTForCausalLM
+# (MPT-7B) caches keys as (batch, heads, head_dim, sequence), whereas transformers' own MptForCausalLM does not.
+__KNOWN_KV_SEQ_DIMS = {
+    "MPTForCausalLM": (-1, -2),
+}
+
 __KNOWN_DECODER_LAYERS_ATTR_NAMES = {
     "opt": "model.decoder.layers",
     "gptj": "transformer.h",
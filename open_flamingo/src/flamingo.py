@@ -1,11 +1,18 @@
+import inspect
+
 import torch
 from einops import rearrange
 from torch import nn
+from .flamingo_lm import FlamingoLMMixin, TrainableTokenEmbedding, chunked_lm_loss
 from .helpers import PerceiverResampler
+from .prefix_cache import PrefixCache
+from .stopping import StopSequencesLogitsProcessor
+from .vision_cache import VisionFeatureCache
 from torch.distributed.fsdp.wrap import (
     enable_wrap,
     wrap,
 )
+from transformers import LogitsProcessorList
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
@@ -24,6 +31,8 @@ class Flamingo(nn.Module):
         vis_dim: int,
         cross_attn_every_n_layers: int = 1,
         gradient_checkpointing: bool = False,
+        attention_backend: str = None,
+        gather_immediate_media: bool = False,
     ):
         """
         Args:
@@ -34,6 +43,11 @@ class Flamingo(nn.Module):
             vis_dim (int): Dimension of the visual features.
                 Visual features are projected to match this shape along the last dimension.
             cross_attn_every_n_layers (int, optional): How often to apply cross attention after transformer layer. Defaults to 1.
+            gradient_checkpointing (bool, optional): Whether to use gradient checkpointing. Defaults to False.
+            attention_backend (str, optional): Attention implementation for the perceiver and cross attention layers.
+                One of "eager", "sdpa" or "chunked". Defaults to None, which uses the global setting (see helpers.set_attention_backend).
+            gather_immediate_media (bool, optional): Whether cross attention gathers the latents of each text token's immediately
+                preceding image instead of masking out all other images. Faster for many-shot prompts. Defaults to False.
         """
         super().__init__()
         self.eoc_token_id = eoc_token_id
@@ -45,7 +59,9 @@ class Flamingo(nn.Module):
             self.lang_dim = lang_encoder.config.hidden_size
 
         self.vision_encoder = vision_encoder.visual
-        self.perceiver = PerceiverResampler(dim=self.vis_dim)
+        self.perceiver = PerceiverResampler(
+            dim=self.vis_dim, attention_backend=attention_backend
+        )
         self.lang_encoder = lang_encoder
         self.lang_encoder.init_flamingo(
             media_token_id=media_token_id,
@@ -53,9 +69,13 @@ class Flamingo(nn.Module):
             vis_hidden_size=self.vis_dim,
             cross_attn_every_n_layers=cross_attn_every_n_layers,
             gradient_checkpointing=gradient_checkpointing,
+            attention_backend=attention_backend,
+            gather_immediate_media=gather_immediate_media,
         )
         self._use_gradient_checkpointing = gradient_checkpointing
         self.perceiver._use_gradient_checkpointing = gradient_checkpointing
+        self.vision_cache = None
+        self.prefix_cache = None
 
     def forward(
         self,
@@ -66,6 +86,9 @@ class Flamingo(nn.Module):
         clear_conditioned_layers: bool = True,
         past_key_values=None,
         use_cache: bool = False,
+        image_ids=None,
+        vision_features: torch.Tensor = None,
+        loss_chunk_size: int = None,
     ):
         """
         Forward pass of Flamingo.
@@ -83,38 +106,85 @@ class Flamingo(nn.Module):
                 forward pass.
             past_key_values: pre-computed values to pass to language model.
                 See past_key_values documentation in Hugging Face
-                CausalLM models.
+                CausalLM models. With cached media (see cache_media()), lang_x
+                may hold several new tokens, and attention_mask then covers
+                the tokens in past_key_values followed by lang_x.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                Only used as keys for the vision feature cache (see enable_vision_cache).
+            vision_features (torch.Tensor, optional): precomputed vision encoder patch tokens,
+                i.e. vision_encoder(images)[1], passed instead of vision_x to skip the vision encoder.
+                shape (B, T_img, F, v, d) with F=1
+            loss_chunk_size (int, optional): with labels, compute the loss from the final hidden states with
+                chunked_lm_loss, loss_chunk_size labeled positions at a time, instead of from the full logits.
+                The output then holds only the loss (see FlamingoLMMixin.forward_hidden_states for the language
+                models this does not apply to). Defaults to None.
         """
         assert (
             self.lang_encoder.initialized_flamingo
         ), "Flamingo layers are not initialized. Please call `init_flamingo` first."
 
         assert (
-            self.lang_encoder._use_cached_vision_x or vision_x is not None
-        ), "Must provide either vision_x or have precached media using cache_media()."
+            self.lang_encoder._use_cached_vision_x
+            or vision_x is not None
+            or vision_features is not None
+        ), "Must provide either vision_x, vision_features or have precached media using cache_media()."
+        assert (
+            vision_x is None or vision_features is None
+        ), "Expect only one of vision_x and vision_features."
 
+        lang_kwargs = {}
         if self.lang_encoder._use_cached_vision_x:
             # Case: use cached; vision_x should be cached and other
             # vision-related inputs should not be provided.
             assert (
-                vision_x is None
+                vision_x is None and vision_features is None
             ), "Expect vision_x to be None when media has been cached using cache_media(). Try uncache_media() first."
             assert self.lang_encoder.is_conditioned()
+            if past_key_values is not None:
+                # lang_x may be a chunk of several tokens, including media tokens, appended to
+                # past_key_values; text after them attends to media in the cached prompt or in lang_x
+                lang_kwargs["past_media_locations"] = self._past_media_locations(
+                    attention_mask.shape[1] - lang_x.shape[1]
+                    if attention_mask is not None
+                    else self.lang_encoder.past_key_values_length(past_key_values)
+                )
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            self._encode_vision_x(
+                vision_x=vision_x, image_ids=image_ids, vision_features=vision_features
+            )
             self._condition_media_locations(input_ids=lang_x)
 
-        output = self.lang_encoder(
-            input_ids=lang_x,
-            attention_mask=attention_mask,
-            labels=labels,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-        )
+        if loss_chunk_size is not None and labels is not None:
+            output = self.lang_encoder.forward_hidden_states(
+                input_ids=lang_x,
+                attention_mask=attention_mask,
+                labels=labels,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                **lang_kwargs,
+            )
+            if isinstance(output, torch.Tensor):
+                output = CausalLMOutputWithPast(
+                    loss=chunked_lm_loss(
+                        output,
+                        labels,
+                        self.lang_encoder.output_logits,
+                        loss_chunk_size,
+                    )
+                )
+        else:
+            output = self.lang_encoder(
+                input_ids=lang_x,
+                attention_mask=attention_mask,
+                labels=labels,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                **lang_kwargs,
+            )
 
         if clear_conditioned_layers:
             self.lang_encoder.clear_conditioned_layers()
@@ -126,6 +196,10 @@ class Flamingo(nn.Module):
         vision_x: torch.Tensor,
         lang_x: torch.Tensor,
         attention_mask: torch.Tensor = None,
+        image_ids=None,
+        stop_token_sequences=None,
+        stop_strings=None,
+        tokenizer=None,
         **kwargs,
     ):
         """
@@ -138,6 +212,13 @@ class Flamingo(nn.Module):
                 currently only F=1 is supported (single-frame videos)
             lang_x (torch.Tensor): Language input
                 shape (B, T_txt)
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                Only used as keys for the vision feature cache (see enable_vision_cache).
+            stop_token_sequences (list, optional): lists of token ids. A sequence ends (with eos_token_id)
+                once its generated tokens end with one of them.
+            stop_strings (list, optional): strings. A sequence ends (with eos_token_id) once its decoded
+                generated text contains one of them. Requires tokenizer.
+            tokenizer (optional): tokenizer used to decode the generated tokens for stop_strings.
             **kwargs: see generate documentation in Hugging Face CausalLM models. Some notable kwargs:
                 max_length (int, optional): Maximum length of the output. Defaults to None.
                 attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
@@ -155,26 +236,302 @@ class Flamingo(nn.Module):
             torch.Tensor: lang_x with generated tokens appended to it
         """
         num_beams = kwargs.pop("num_beams", 1)
-        if num_beams > 1:
-            vision_x = vision_x.repeat_interleave(num_beams, dim=0)
-
+        eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
+        if stop_token_sequences is not None or stop_strings is not None:
+            kwargs["logits_processor"] = LogitsProcessorList(
+                list(kwargs.get("logits_processor", []))
+                + [
+                    StopSequencesLogitsProcessor(
+                        eos_token_id,
+                        stop_token_sequences=stop_token_sequences,
+                        stop_strings=stop_strings,
+                        tokenizer=tokenizer,
+                    )
+                ]
+            )
         self.lang_encoder._use_cached_vision_x = True
-        self._encode_vision_x(vision_x=vision_x)
 
-        eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
+        if (
+            self.prefix_cache is not None
+            and lang_x.shape[1] > 1
+            and not (lang_x[:, -1] == self.media_token_id).any()
+            and (attention_mask is None or attention_mask[:, -1].all())
+            and not kwargs.get("return_dict_in_generate", False)
+        ):
+            output = self._generate_with_prefix_cache(
+                vision_x=vision_x,
+                lang_x=lang_x,
+                attention_mask=attention_mask,
+                image_ids=image_ids,
+                eos_token_id=eos_token_id,
+                num_beams=num_beams,
+                **kwargs,
+            )
+        else:
+            # encode each image once; the latents are repeated for every beam
+            self._encode_vision_x(
+                vision_x=vision_x, image_ids=image_ids, repeats=num_beams
+            )
+            output = self.lang_encoder.generate(
+                input_ids=lang_x,
+                attention_mask=attention_mask,
+                eos_token_id=eos_token_id,
+                num_beams=num_beams,
+                **kwargs,
+            )
+
+        self.lang_encoder.clear_conditioned_layers()
+        self.lang_encoder._use_cached_vision_x = False
+        return output
+
+    def _generate_with_prefix_cache(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        image_ids=None,
+        num_beams: int = 1,
+        **kwargs,
+    ):
+        """
+        generate(), but the prompt (except its last token, which generate needs to process itself)
+        is prefilled with prefill(), so cached prompt prefixes are not recomputed.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+        prefill, prefill_attention_mask, prefill_input_ids = self._prefill(
+            lang_x=lang_x[:, :-1],
+            vision_x=vision_x,
+            attention_mask=attention_mask[:, :-1],
+            image_ids=image_ids,
+        )
+        past_key_values = prefill.past_key_values
+
+        # generate() needs the prompt in the same layout as the past_key_values (see prefill)
+        input_ids = torch.cat([prefill_input_ids, lang_x[:, -1:]], dim=1)
+        attention_mask = torch.cat(
+            [prefill_attention_mask, attention_mask[:, -1:].to(prefill_attention_mask)],
+            dim=1,
+        )
+        if "max_length" in kwargs:
+            kwargs["max_length"] += input_ids.shape[1] - lang_x.shape[1]
+
+        if num_beams > 1:
+            # generate() expands input_ids and attention_mask for each beam, but not the conditioning
+            layers = self.lang_encoder._get_decoder_layers()
+            vis_x = layers[0].vis_x.repeat_interleave(num_beams, dim=0)
+            media_locations = layers[0].media_locations.repeat_interleave(
+                num_beams, dim=0
+            )
+            for layer in layers:
+                layer.condition_vis_x(vis_x)
+                layer.condition_media_locations(media_locations)
+            past_key_values = tuple(
+                tuple(t.repeat_interleave(num_beams, dim=0) for t in layer_past)
+                for layer_past in past_key_values
+            )
+
         output = self.lang_encoder.generate(
-            input_ids=lang_x,
+            input_ids=input_ids,
             attention_mask=attention_mask,
-            eos_token_id=eos_token_id,
+            past_key_values=past_key_values,
             num_beams=num_beams,
             **kwargs,
         )
+        # swap the re-laid out prompt for the original one
+        return torch.cat(
+            [
+                lang_x.repeat_interleave(output.shape[0] // lang_x.shape[0], dim=0),
+                output[:, input_ids.shape[1] :],
+            ],
+            dim=1,
+        )
 
-        self.lang_encoder.clear_conditioned_layers()
-        self.lang_encoder._use_cached_vision_x = False
-        return output
+    def prefill(
+        self,
+        lang_x: torch.Tensor,
+        vision_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        image_ids=None,
+    ):
+        """
+        Cache media like cache_media() and run the language model over the prompt lang_x, reusing the
+        past_key_values of the longest prefix of each row found in the prefix cache (see enable_prefix_cache).
+        The past_key_values of each prompt are then added to the prefix cache.
+
+        The prompt is laid out like a left-padded batch: each row's tokens are left-padded to the longest row L.
+        Rows may reuse prefixes of different lengths, so the past_key_values of the first P positions are taken
+        from the cache, where P is the first position not covered by the cached prefix of every row
+        (past_key_values of padding are zeros, which are masked out); the remaining S = L - P positions are run.
+        Continue the prompt with forward(vision_x=None, past_key_values=output.past_key_values,
+        attention_mask=torch.cat([attention_mask, <attention mask of the continuation>], dim=1),
+        clear_conditioned_layers=False) and call uncache_media() when done.
+        Args:
+            lang_x (torch.Tensor): Language input
+                shape (B, T_txt)
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+            attention_mask (torch.Tensor, optional): Attention mask of lang_x. Defaults to None.
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                If None, images are identified by a hash of their contents.
+        Returns:
+            output: output of the language model for the last S tokens of the layout,
+                i.e. output.logits[:, -1] are the logits of the last prompt token
+            attention_mask (torch.Tensor): attention mask of the layout
+                shape (B, L)
+        """
+        output, attention_mask, _ = self._prefill(
+            lang_x=lang_x,
+            vision_x=vision_x,
+            attention_mask=attention_mask,
+            image_ids=image_ids,
+        )
+        return output, attention_mask
+
+    def _prefill(self, lang_x, vision_x, attention_mask=None, image_ids=None):
+        """prefill(), also returning the input ids of the layout."""
+        assert (
+            self.prefix_cache is not None
+        ), "prefill() requires a prefix cache. Call enable_prefix_cache() first."
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+        self._encode_vision_x(vision_x=vision_x, image_ids=image_ids)
+        self.lang_encoder._use_cached_vision_x = True
+
+        if image_ids is None:
+            T_img = vision_x.shape[1]
+            hashes = VisionFeatureCache.hash_images(
+                rearrange(vision_x, "b T F c h w -> (b T) F c h w")
+            )
+            image_ids = [hashes[i : i + T_img] for i in range(0, len(hashes), T_img)]
+
+        # look up the longest cached prefix of each row, leaving at least one token to run
+        tokens = [row[mask.bool()] for row, mask in zip(lang_x, attention_mask)]
+        labels = [
+            self._prefix_labels(row.tolist(), row_image_ids)
+            for row, row_image_ids in zip(tokens, image_ids)
+        ]
+        matches = [
+            self.prefix_cache.match(row_labels, max_length=len(row_labels) - 1)
+            for row_labels in labels
+        ]
+        key_dim, value_dim = self.lang_encoder.kv_seq_dims
+
+        # lay out the prompt as a left-padded batch, as generate() would see it; padding is masked out,
+        # so the pad token does not matter
+        L = max(len(row) for row in tokens)
+        input_ids = lang_x.new_full((len(tokens), L), self.eoc_token_id)
+        layout_attention_mask = torch.zeros_like(input_ids, dtype=attention_mask.dtype)
+        for i, row in enumerate(tokens):
+            input_ids[i, L - len(row) :] = row
+            layout_attention_mask[i, L - len(row) :] = 1
+
+        # the first P positions are cached for every row: P - (L - len(row)) tokens of each row's cached prefix
+        P = min(L - len(row) + length for row, (length, _) in zip(tokens, matches))
+        past_key_values = None
+        for i, (row, (length, kv)) in enumerate(zip(tokens, matches)):
+            num_cached = P - (L - len(row))
+            if num_cached <= 0:
+                continue
+            if past_key_values is None:
+                past_key_values = tuple(
+                    tuple(
+                        t.new_zeros(self._with_seq_len(t.shape, len(tokens), P, dim))
+                        for t, dim in zip(layer_kv, (key_dim, value_dim))
+                    )
+                    for layer_kv in kv
+                )
+            for layer_past, layer_kv in zip(past_key_values, kv):
+                for past, t, dim in zip(layer_past, layer_kv, (key_dim, value_dim)):
+                    past[i : i + 1].narrow(dim, P - num_cached, num_cached).copy_(
+                        t.narrow(dim, 0, num_cached)
+                    )
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+        media_locations = input_ids == self.media_token_id
+        for layer in self.lang_encoder._get_decoder_layers():
+            layer.condition_media_locations(media_locations)
+        output = self.lang_encoder(
+            input_ids=input_ids[:, P:],
+            attention_mask=layout_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            past_media_locations=media_locations[:, :P] if P > 0 else None,
+            **self._position_ids_kwargs(layout_attention_mask, L - P),
+        )
+
+        for i, row_labels in enumerate(labels):
+            positions = layout_attention_mask[i].nonzero().squeeze(-1)
+            self.prefix_cache.insert(
+                row_labels,
+                tuple(
+                    tuple(
+                        t[i : i + 1].index_select(dim, positions)
+                        for t, dim in zip(layer_past, (key_dim, value_dim))
+                    )
+                    for layer_past in output.past_key_values
+                ),
+            )
+        return output, layout_attention_mask, input_ids
+
+    def _prefix_labels(self, tokens, image_ids):
+        """
+        Prefix cache labels of a row of unpadded tokens: the token id, or (media_token_id, image id) for media tokens.
+        """
+        labels, num_media = [], 0
+        for token in tokens:
+            if token == self.media_token_id:
+                # media tokens without a matching image are never reused
+                image_id = (
+                    image_ids[num_media] if num_media < len(image_ids) else object()
+                )
+                token = (token, image_id)
+                num_media += 1
+            labels.append(token)
+        return labels
+
+    def _position_ids_kwargs(self, attention_mask, num_tokens):
+        """
+        position_ids of the last num_tokens tokens derived from the attention mask, as a kwarg for the
+        language model if its forward() accepts them. Left padding, also in the middle of a sequence,
+        then does not shift the positions.
+        """
+        if (
+            "position_ids"
+            not in inspect.signature(
+                super(FlamingoLMMixin, self.lang_encoder).forward
+            ).parameters
+        ):
+            return {}
+        position_ids = attention_mask.long().cumsum(dim=-1) - 1
+        return {"position_ids": position_ids.clamp(min=0)[:, -num_tokens:]}
+
+    def _past_media_locations(self, num_past_tokens):
+        """
+        Media locations of the num_past_tokens tokens in past_key_values, taken from the conditioned media locations.
+        Tokens appended without re-conditioning (e.g. by decoding steps, which contain no media tokens)
+        are not in the conditioned media locations; they are text.
+        """
+        media_locations = self.lang_encoder._get_decoder_layers()[0].media_locations
+        num_conditioned = media_locations.shape[1]
+        if num_conditioned >= num_past_tokens:
+            return media_locations[:, :num_past_tokens]
+        return torch.nn.functional.pad(
+            media_locations, (0, num_past_tokens - num_conditioned), value=False
+        )
+
+    def _with_seq_len(self, shape, batch_size, seq_len, seq_dim):
+        shape = list(shape)
+        shape[0] = batch_size
+        shape[seq_dim] = seq_len
+        return shape
+
+    def _encode_vision_x(
+        self,
+        vision_x: torch.Tensor,
+        image_ids=None,
+        repeats=1,
+        vision_features: torch.Tensor = None,
+    ):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -182,23 +539,176 @@ class Flamingo(nn.Module):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                Used as keys for the vision feature cache instead of hashing the image contents.
+            repeats (int, optional): number of times to repeat each sample's media tokens along the batch
+                dimension, e.g. num_beams for beam search. Defaults to 1.
+            vision_features (torch.Tensor, optional): precomputed vision encoder patch tokens, used
+                instead of vision_x. Only the perceiver is run on them.
+                shape (B, T_img, F, v, d)
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
+        if vision_features is not None:
+            assert (
+                vision_features.ndim == 5
+            ), "vision_features should be of shape (b, T_img, F, v, d)"
+            vision_x, encode = vision_features, self._resample_patch_tokens
+        else:
+            assert (
+                vision_x.ndim == 6
+            ), "vision_x should be of shape (b, T_img, F, C, H, W)"
+            encode = self._encode_images
         b, T, F = vision_x.shape[:3]
         assert F == 1, "Only single frame supported"
 
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        with torch.no_grad():
-            vision_x = self.vision_encoder(vision_x)[1]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
-        vision_x = self.perceiver(vision_x)
+        vision_x = rearrange(vision_x, "b T F ... -> (b T F) ...")
+        if image_ids is not None:
+            image_ids = [image_id for ids in image_ids for image_id in ids]
+            assert len(image_ids) == len(
+                vision_x
+            ), "image_ids should have one id per image in vision_x"
+
+        # batches with fewer than T_img images are padded with all-zero images,
+        # which no text attends to, so only encode the real images.
+        # always encode at least one image so every rank runs the vision encoder / perceiver under FSDP
+        is_real_image = vision_x.flatten(1).any(dim=1)
+        is_real_image[0] = True
+        if is_real_image.all():
+            vision_x = encode(vision_x, image_ids)
+        else:
+            if image_ids is not None:
+                image_ids = [i for i, real in zip(image_ids, is_real_image) if real]
+            latents = encode(vision_x[is_real_image], image_ids)
+            vision_x = latents.new_zeros(
+                (len(vision_x),) + latents.shape[1:]
+            ).masked_scatter(rearrange(is_real_image, "N -> N 1 1"), latents)
+        vision_x = rearrange(vision_x, "(b T F) n d -> b T (F n) d", b=b, T=T, F=F)
+        if repeats > 1:
+            vision_x = vision_x.repeat_interleave(repeats, dim=0)
 
         for layer in self.lang_encoder._get_decoder_layers():
             layer.condition_vis_x(vision_x)
 
+    def _encode_images(self, vision_x: torch.Tensor, image_ids=None):
+        """
+        Pass single-frame images through the vision encoder and perceiver.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (N, C, H, W)
+            image_ids (list, optional): list of N image ids, used as keys for the vision feature cache.
+        Returns:
+            perceiver latents of shape (N, n, D)
+        """
+        if self.vision_cache is not None:
+            return self._encode_images_with_cache(vision_x, image_ids)
+
+        with torch.no_grad():
+            vision_x = self.vision_encoder(vision_x)[1]
+        return self._resample_patch_tokens(vision_x)
+
+    def _resample_patch_tokens(self, patch_tokens: torch.Tensor, image_ids=None):
+        """
+        Pass vision encoder patch tokens of single-frame images through the perceiver.
+        Args:
+            patch_tokens (torch.Tensor): vision encoder patch tokens
+                shape (N, v, d)
+            image_ids (list, optional): unused, for the same signature as _encode_images.
+        Returns:
+            perceiver latents of shape (N, n, D)
+        """
+        patch_tokens = rearrange(patch_tokens, "N v d -> N 1 1 v d")
+        return self.perceiver(patch_tokens).squeeze(1)
+
+    def _encode_images_with_cache(self, vision_x: torch.Tensor, image_ids=None):
+        """
+        Encode single-frame images, only running the vision encoder on images missing from self.vision_cache.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (N, C, H, W)
+            image_ids (list, optional): list of N image ids.
+                If None, images are keyed by a hash of their contents.
+        Returns:
+            perceiver latents of shape (N, n, D)
+        """
+        if image_ids is not None:
+            keys = image_ids
+        else:
+            keys = VisionFeatureCache.hash_images(vision_x)
+
+        # perceiver latents can only be reused if they would not receive gradients
+        # and do not depend on the image's position in the sequence
+        cache_latents = (
+            self.vision_cache.cache_latents
+            and self.perceiver.media_time_embs is None
+            and self.perceiver.frame_embs is None
+            and not (
+                torch.is_grad_enabled()
+                and any(p.requires_grad for p in self.perceiver.parameters())
+            )
+        )
+        keys = [("latents" if cache_latents else "patch_tokens", key) for key in keys]
+
+        features = [self.vision_cache.get(key) for key in keys]
+        missing = {}  # key -> index of the first image with that key
+        for i, key in enumerate(keys):
+            if features[i] is None and key not in missing:
+                missing[key] = i
+
+        if len(missing) > 0:
+            with torch.no_grad():
+                new_features = self.vision_encoder(vision_x[list(missing.values())])[1]
+            if cache_latents:
+                new_features = self.perceiver(
+                    rearrange(new_features, "N v d -> N 1 1 v d")
+                ).squeeze(1)
+            new_features = dict(zip(missing.keys(), new_features))
+            for key, f in new_features.items():
+                self.vision_cache.put(key, f)
+            features = [
+                new_features[key] if f is None else f for key, f in zip(keys, features)
+            ]
+
+        vision_x = torch.stack(features)
+        if cache_latents:
+            return vision_x
+        return self._resample_patch_tokens(vision_x)
+
+    def enable_vision_cache(self, max_bytes: int, cache_latents: bool = False):
+        """
+        Cache vision encoder outputs for images passed to forward(), generate() and cache_media(),
+        so that repeated images (e.g. in-context demonstrations) are only encoded once.
+        Args:
+            max_bytes (int): memory budget for the cached features.
+            cache_latents (bool, optional): if True, cache perceiver latents instead of vision encoder
+                patch tokens whenever the perceiver is frozen or gradients are disabled. Defaults to False.
+        Returns:
+            VisionFeatureCache: the cache, e.g. to inspect hit / miss / eviction counts with stats()
+        """
+        self.vision_cache = VisionFeatureCache(max_bytes, cache_latents=cache_latents)
+        return self.vision_cache
+
+    def disable_vision_cache(self):
+        self.vision_cache = None
+
+    def enable_prefix_cache(self, max_bytes: int):
+        """
+        Cache the language model past_key_values of prompts passed to generate() and prefill(),
+        so that later prompts sharing a prefix (e.g. the same in-context demonstrations) only run the rest.
+        Args:
+            max_bytes (int): memory budget for the cached past_key_values.
+        Returns:
+            PrefixCache: the cache, e.g. to inspect hit / miss / eviction counts with stats()
+        """
+        self.prefix_cache = PrefixCache(
+            max_bytes, seq_dims=self.lang_encoder.kv_seq_dims
+        )
+        return self.prefix_cache
+
+    def disable_prefix_cache(self):
+        self.prefix_cache = None
+
     def wrap_fsdp(self, wrapper_kwargs, device_id):
         """
         Manually wraps submodules for FSDP and move other parameters to device_id.
@@ -214,16 +724,20 @@ class Flamingo(nn.Module):
             - FSDP(FSDP(vision_encoder))
             - FSDP(FSDP(perceiver))
             - lang_encoder
-                - FSDP(FSDP(input_embeddings))
+                - input_embeddings (a TrainableTokenEmbedding unless --freeze_lm_embeddings)
+                    - FSDP(FSDP(base))
+                    - FSDP(FSDP(trainable))
                 - FlamingoLayers
                     - FSDP(FSDP(gated_cross_attn_layer))
                     - FSDP(FSDP(decoder_layer))
                 - FSDP(FSDP(output_embeddings))
                 - other parameters
+        If the LM embeddings are tied, the frozen base embedding (i.e. the output embeddings) is not wrapped
+        but replicated on every rank, since the output head reads it outside of the embedding's forward.
 
         Known issues:
-        - Our FSDP strategy is not compatible with tied embeddings. If the LM embeddings are tied,
-            train with DDP or set the --freeze_lm_embeddings flag to true.
+        - With --freeze_lm_embeddings, the input and output embeddings are wrapped separately, so their tied
+            weights are no longer shared.
         - With FSDP + gradient ckpting, one can increase the batch size with seemingly no upper bound.
             Although the training curves look okay, we found that downstream performance dramatically
             degrades if the batch size is unreasonably large (e.g., 100 MMC4 batch size for OPT-125M).
@@ -250,9 +764,13 @@ class Flamingo(nn.Module):
             # Unfreeze perceiver, gated_cross_attn_layers, and LM input embeddings
             model.perceiver.requires_grad_(True)
             model.lang_encoder.gated_cross_attn_layers.requires_grad_(True)
-            [optional] model.lang_encoder.get_input_embeddings().requires_grad_(True)
+            [optional] model.lang_encoder.get_input_embeddings().trainable.requires_grad_(True)
             ```
         """
+        assert self.lang_encoder.masked_token_embedding_ids is None, (
+            "FSDP flattens the input embeddings, so the gradients of their rows cannot be masked "
+            "(see init_trainable_token_embeddings); use --freeze_lm_embeddings"
+        )
         # unfreeze the decoder layers
         for block in self.lang_encoder.old_decoder_blocks:
             block.requires_grad_(True)
@@ -268,12 +786,19 @@ class Flamingo(nn.Module):
                 for layer in self.lang_encoder.gated_cross_attn_layers
             )
             self.lang_encoder.init_flamingo_layers(self._use_gradient_checkpointing)
-            self.lang_encoder.set_input_embeddings(
-                wrap(wrap(self.lang_encoder.get_input_embeddings()))
-            )
-            self.lang_encoder.set_output_embeddings(
-                wrap(wrap(self.lang_encoder.get_output_embeddings()))
-            )
+            input_embeddings = self.lang_encoder.get_input_embeddings()
+            if isinstance(input_embeddings, TrainableTokenEmbedding):
+                input_embeddings.trainable = wrap(wrap(input_embeddings.trainable))
+                if not self.lang_encoder.has_tied_embeddings():
+                    input_embeddings.base = wrap(wrap(input_embeddings.base))
+                    self.lang_encoder.set_output_embeddings(
+                        wrap(wrap(self.lang_encoder.get_output_embeddings()))
+                    )
+            else:
+                self.lang_encoder.set_input_embeddings(wrap(wrap(input_embeddings)))
+                self.lang_encoder.set_output_embeddings(
+                    wrap(wrap(self.lang_encoder.get_output_embeddings()))
+                )
             self.vision_encoder = wrap(wrap(self.vision_encoder))  # frozen
 
         # manually move non-FSDP managed parameters to device_id
@@ -284,6 +809,9 @@ class Flamingo(nn.Module):
             apply_condition=lambda m: len(list(m.children())) == 0,
             stopping_condition=lambda m: isinstance(m, FSDP),
         )
+        if isinstance(input_embeddings, TrainableTokenEmbedding):
+            # buffer of a module with children, which the above skips
+            input_embeddings.token_ids = input_embeddings.token_ids.to(device_id)
 
         # exclude the original decoder layers from the optimizer
         for block in self.lang_encoder.old_decoder_blocks:
@@ -296,7 +824,10 @@ class Flamingo(nn.Module):
             for layer in self.lang_encoder.gated_cross_attn_layers:
                 if layer is not None:
                     layer.clip_grad_norm_(max_norm)
-            self.lang_encoder.get_input_embeddings().clip_grad_norm_(max_norm)
+            if isinstance(input_embeddings, TrainableTokenEmbedding):
+                input_embeddings.trainable.clip_grad_norm_(max_norm)
+            else:
+                input_embeddings.clip_grad_norm_(max_norm)
 
         self.clip_grad_norm_ = clip_grad_norm_
 
@@ -312,7 +843,9 @@ class Flamingo(nn.Module):
         for layer in self.lang_encoder._get_decoder_layers():
             layer.condition_media_locations(media_locations)
 
-    def cache_media(self, input_ids: torch.Tensor, vision_x: torch.Tensor):
+    def cache_media(
+        self, input_ids: torch.Tensor, vision_x: torch.Tensor, image_ids=None
+    ):
         """
         Pre-cache a prompt/sequence of images / text for log-likelihood evaluations.
         All subsequent calls to forward() will generate attending to the LAST
@@ -325,8 +858,10 @@ class Flamingo(nn.Module):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                Only used as keys for the vision feature cache (see enable_vision_cache).
         """
-        self._encode_vision_x(vision_x=vision_x)
+        self._encode_vision_x(vision_x=vision_x, image_ids=image_ids)
         self._condition_media_locations(input_ids=input_ids)
         self.lang_encoder._use_cached_vision_x = True
 
@@ -1,26 +1,242 @@
+import contextlib
+import contextvars
+import functools
+import weakref
+
+import torch
 import torch.nn as nn
-from .helpers import GatedCrossAttentionBlock
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from .helpers import GatedCrossAttentionBlock, MediaMask
 from .utils import getattr_recursive, setattr_recursive
 
+# Media conditioning (vis_x, media locations, ...) is stored per contextvars context rather than on the modules,
+# so that threads (which each start with an empty context) can share one model without overwriting each other's media.
+_conditioning = contextvars.ContextVar("flamingo_conditioning")
+
+
+def _get_conditioning_store():
+    store = _conditioning.get(None)
+    if store is None:
+        store = weakref.WeakKeyDictionary()
+        _conditioning.set(store)
+    return store
+
+
+def _get_conditioning(module):
+    """The conditioning dict of a module: its pinned conditioning if any (see pin_conditioning), else the context's."""
+    pinned = module.__dict__.get("pinned_conditioning")
+    if pinned is not None:
+        return pinned
+    return _get_conditioning_store().setdefault(module, {})
+
+
+@contextlib.contextmanager
+def conditioning_scope():
+    """
+    Give the enclosed code its own, initially empty, media conditioning.
+    Threads are isolated from each other automatically; use this to isolate e.g. asyncio tasks,
+    which otherwise share the conditioning of the context they were created from.
+    """
+    token = _conditioning.set(weakref.WeakKeyDictionary())
+    try:
+        yield
+    finally:
+        _conditioning.reset(token)
+
+
+def chunked_lm_loss(hidden_states, labels, output_head, chunk_size):
+    """
+    Causal language modeling loss from the final hidden states, equal to the loss of Hugging Face
+    CausalLM models for the same labels (shifted inside, -100 is ignored, mean over the other labels).
+    Only the positions with a label are passed through output_head, chunk_size positions at a time,
+    and the logits of each chunk are recomputed in the backward pass rather than stored, so at most
+    (chunk_size, vocab) logits are materialized.
+
+    Args:
+        hidden_states (torch.Tensor): shape (B, T_txt, d)
+        labels (torch.Tensor): shape (B, T_txt)
+        output_head (callable): maps hidden states to logits, e.g. FlamingoLMMixin.output_logits
+        chunk_size (int): number of positions per chunk
+    """
+    shift_labels = labels[:, 1:]
+    valid = shift_labels != -100
+    hidden_states = hidden_states[:, :-1][valid]
+    shift_labels = shift_labels[valid]
+
+    def chunk_loss(h, y):
+        return F.cross_entropy(output_head(h).float(), y, reduction="sum")
+
+    loss = hidden_states.new_zeros((), dtype=torch.float32)
+    for i in range(0, hidden_states.shape[0], chunk_size):
+        loss = loss + checkpoint(
+            chunk_loss,
+            hidden_states[i : i + chunk_size],
+            shift_labels[i : i + chunk_size],
+            use_reentrant=False,
+        )
+    # nan if there are no labels, like the Hugging Face loss
+    return loss / shift_labels.numel()
+
+
+class TrainableTokenEmbedding(nn.Module):
+    """
+    Input embedding whose rows for a few tokens (e.g. the added <image> and <|endofchunk|> tokens) are looked up in
+    a small separate embedding, so that these rows can be trained while the full-vocabulary embedding stays frozen.
+    """
+
+    def __init__(self, base, token_ids):
+        """
+        Args:
+            base (nn.Embedding): the language model's input embedding, which is kept frozen
+            token_ids (list): ids of the tokens whose rows are trainable, initialized from base
+        """
+        super().__init__()
+        self.base = base
+        self.register_buffer(
+            "token_ids",
+            torch.tensor(token_ids, dtype=torch.long, device=base.weight.device),
+        )
+        self.trainable = nn.Embedding.from_pretrained(
+            base.weight.detach()[self.token_ids].clone(), freeze=False
+        )
+
+    def trainable_weight(self):
+        """
+        The trainable rows, shape (len(token_ids), d). Read through the module call rather than
+        trainable.weight, so that it also works once trainable is wrapped in FSDP.
+        """
+        return self.trainable(
+            torch.arange(len(self.token_ids), device=self.token_ids.device)
+        )
+
+    @property
+    def weight(self):
+        """
+        The frozen full-vocabulary embedding matrix, without the trainable rows, e.g. for device lookups. Logits tied
+        to the embeddings are computed by forward(hidden_states, unembed=True) or tied_output_hook.
+        """
+        return self.base.weight
+
+    def forward(self, input, unembed=False):
+        """
+        Look up the embeddings of the input ids, or, with unembed=True, compute the tied logits of the input hidden
+        states, like MPT's SharedEmbedding that the output head of MPT-7B is.
+        """
+        if unembed:
+            return self._with_trainable_logits(input, F.linear(input, self.base.weight))
+        x = self.base(input)
+        is_trainable = input.unsqueeze(-1) == self.token_ids
+        index = is_trainable.long().argmax(dim=-1)
+        return torch.where(
+            is_trainable.any(dim=-1, keepdim=True),
+            self.trainable(index).to(x.dtype),
+            x,
+        )
+
+    def _with_trainable_logits(self, hidden_states, logits):
+        """Replace the logits of token_ids, computed from the frozen rows, with those of the trainable rows."""
+        trainable_logits = F.linear(
+            hidden_states, self.trainable_weight().to(hidden_states.dtype)
+        )
+        # in place, so that the (B, T, vocab) logits are not copied
+        return logits.index_copy_(-1, self.token_ids, trainable_logits.to(logits.dtype))
+
+    def tied_output_hook(self, module, args, output):
+        """Forward hook for an output head module tied to base: the logits of token_ids use the trainable rows."""
+        return self._with_trainable_logits(args[0], output)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints written before the embedding was split hold the full embedding under prefix + "weight"
+        split_token_embedding_state_dict(state_dict, prefix, self.token_ids)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def split_token_embedding_state_dict(state_dict, prefix, token_ids):
+    """
+    Convert, in place, the full input embedding prefix + "weight" of a checkpoint written before the embedding
+    was split into a TrainableTokenEmbedding to the states of the TrainableTokenEmbedding at prefix.
+    Does nothing if the checkpoint has no such key.
+    """
+    weight = state_dict.pop(prefix + "weight", None)
+    if weight is None:
+        return state_dict
+    token_ids = token_ids.to(weight.device)
+    state_dict[prefix + "base.weight"] = weight
+    state_dict[prefix + "trainable.weight"] = weight[token_ids].clone()
+    state_dict[prefix + "token_ids"] = token_ids
+    return state_dict
+
+
+def merge_token_embedding_state_dict(state_dict):
+    """
+    Convert, in place, the states of every TrainableTokenEmbedding in a checkpoint back to a single full input
+    embedding weight, e.g. to load the checkpoint with --freeze_lm_embeddings or with earlier versions.
+    """
+    suffix = "trainable.weight"
+    for key in [k for k in state_dict if k.endswith(suffix)]:
+        prefix = key[: -len(suffix)]
+        if prefix + "base.weight" not in state_dict:
+            continue
+        weight = state_dict.pop(prefix + "base.weight").clone()
+        token_ids = state_dict.pop(prefix + "token_ids").to(weight.device)
+        weight[token_ids] = state_dict.pop(key).to(weight)
+        state_dict[prefix + "weight"] = weight
+    return state_dict
+
+
+def _mask_gradient_rows(token_ids, grad):
+    """Zero the gradient of every row of an embedding weight except the rows of token_ids."""
+    keep = torch.zeros(grad.shape[0], 1, dtype=torch.bool, device=grad.device)
+    keep[token_ids.to(grad.device)] = True
+    return grad.masked_fill(~keep, 0)
+
+
+class ConditionedAttribute:
+    """
+    Module attribute whose value is scoped to the current contextvars context (see conditioning_scope),
+    or held by the module itself while its conditioning is pinned (see FlamingoLMMixin.pin_conditioning).
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, module, owner=None):
+        if module is None:
+            return self
+        return _get_conditioning(module).get(self.name, self.default)
+
+    def __set__(self, module, value):
+        _get_conditioning(module)[self.name] = value
+
 
 class FlamingoLayer(nn.Module):
     """
     FlamingoLayer is a wrapper around the GatedCrossAttentionBlock and DecoderLayer.
     """
 
+    vis_x = ConditionedAttribute()
+    media_locations = ConditionedAttribute()
+    use_cached_media = ConditionedAttribute()
+    media_mask = ConditionedAttribute()
+    media_kv = ConditionedAttribute()
+
     def __init__(
         self, gated_cross_attn_layer, decoder_layer, gradient_checkpointing=False
     ):
         super().__init__()
         self.gated_cross_attn_layer = gated_cross_attn_layer
         self.decoder_layer = decoder_layer
-        self.vis_x = None
-        self.media_locations = None
         if self.gated_cross_attn_layer is not None:
             self.gated_cross_attn_layer._use_gradient_checkpointing = (
                 gradient_checkpointing
             )
         self.decoder_layer._use_gradient_checkpointing = gradient_checkpointing
+        # plain dict of conditioning values used instead of the context's, see FlamingoLMMixin.pin_conditioning
+        self.pinned_conditioning = None
 
     def is_conditioned(self) -> bool:
         """Check whether the layer is conditioned."""
@@ -29,6 +245,8 @@ class FlamingoLayer(nn.Module):
     # Used this great idea from this implementation of Flamingo (https://github.com/dhansmair/flamingo-mini/)
     def condition_vis_x(self, vis_x):
         self.vis_x = vis_x
+        # keys / values projected from the previous vis_x are stale
+        self.media_kv = None
 
     def condition_media_locations(self, media_locations):
         self.media_locations = media_locations
@@ -36,6 +254,9 @@ class FlamingoLayer(nn.Module):
     def condition_use_cached_media(self, use_cached_media):
         self.use_cached_media = use_cached_media
 
+    def condition_media_mask(self, media_mask):
+        self.media_mask = media_mask
+
     def forward(
         self,
         lang_x,
@@ -44,19 +265,37 @@ class FlamingoLayer(nn.Module):
     ):
         # Cross attention
         if self.gated_cross_attn_layer is not None:
-            if self.vis_x is None:
+            # read the conditioning once rather than through the ConditionedAttributes: the pinned dict is a
+            # plain attribute, which torch.compile can trace
+            conditioning = self.pinned_conditioning
+            if conditioning is None:
+                conditioning = _get_conditioning(self)
+            vis_x = conditioning.get("vis_x")
+            media_locations = conditioning.get("media_locations")
+            use_cached_media = conditioning.get("use_cached_media")
+            media_kv = conditioning.get("media_kv")
+
+            if vis_x is None:
                 raise ValueError("vis_x must be conditioned before forward pass")
 
-            if self.media_locations is None:
+            if media_locations is None:
                 raise ValueError(
                     "media_locations must be conditioned before forward pass"
                 )
 
+            # when attending to cached media (e.g. while decoding in generate()),
+            # vis_x is the same for every step, so project it to keys / values once
+            if use_cached_media and media_kv is None:
+                media_kv = self.gated_cross_attn_layer.attn.project_media(vis_x)
+                conditioning["media_kv"] = media_kv
+
             lang_x = self.gated_cross_attn_layer(
                 lang_x,
-                self.vis_x,
-                media_locations=self.media_locations,
-                use_cached_media=self.use_cached_media,
+                vis_x,
+                media_locations=media_locations,
+                use_cached_media=use_cached_media,
+                media_kv=media_kv if use_cached_media else None,
+                media_mask=conditioning.get("media_mask"),
             )
 
         # Normal decoder layer
@@ -71,9 +310,27 @@ class FlamingoLMMixin(nn.Module):
     Mixin to add cross-attention layers to a language model.
     """
 
+    _use_cached_vision_x = ConditionedAttribute(default=False)
+    # ids of the trainable rows of a full input embedding weight, see init_trainable_token_embeddings
+    masked_token_embedding_ids = None
+    # sequence dimensions of the key and of the value tensors in past_key_values, see set_kv_seq_dims
+    kv_seq_dims = (-2, -2)
+
     def set_decoder_layers_attr_name(self, decoder_layers_attr_name):
         self.decoder_layers_attr_name = decoder_layers_attr_name
 
+    def set_kv_seq_dims(self, kv_seq_dims):
+        """
+        Set the sequence dimensions of the key and of the value tensors in past_key_values. The default (-2, -2) is
+        the Hugging Face layout (batch, heads, sequence, head_dim); e.g. MPT-7B caches its keys as
+        (batch, heads, head_dim, sequence), i.e. (-1, -2).
+        """
+        self.kv_seq_dims = tuple(kv_seq_dims)
+
+    def past_key_values_length(self, past_key_values):
+        """Number of tokens in past_key_values."""
+        return past_key_values[0][0].shape[self.kv_seq_dims[0]]
+
     def _get_decoder_layers(self):
         return getattr_recursive(self, self.decoder_layers_attr_name)
 
@@ -87,6 +344,8 @@ class FlamingoLMMixin(nn.Module):
         vis_hidden_size,
         cross_attn_every_n_layers,
         gradient_checkpointing,
+        attention_backend=None,
+        gather_immediate_media=False,
     ):
         """
         Initialize Flamingo by adding a new gated cross attn to the decoder. Store the media token id for computing the media locations.
@@ -95,7 +354,10 @@ class FlamingoLMMixin(nn.Module):
         self.gated_cross_attn_layers = nn.ModuleList(
             [
                 GatedCrossAttentionBlock(
-                    dim=lang_hidden_size, dim_visual=vis_hidden_size
+                    dim=lang_hidden_size,
+                    dim_visual=vis_hidden_size,
+                    attention_backend=attention_backend,
+                    gather_immediate_media=gather_immediate_media,
                 )
                 if (layer_idx + 1) % cross_attn_every_n_layers == 0
                 else None
@@ -125,8 +387,55 @@ class FlamingoLMMixin(nn.Module):
             )
         )
 
-    def forward(self, input_ids, attention_mask, **kwargs):
-        """Condition the Flamingo layers on the media locations before forward()"""
+    def init_trainable_token_embeddings(self, token_ids):
+        """
+        Replace the input embeddings with a TrainableTokenEmbedding, so that only the rows of token_ids can be
+        trained. An output head tied to the input embeddings also uses the trainable rows for these tokens: an output
+        head that is the input embedding module itself (e.g. MPT-7B's SharedEmbedding) is replaced along with it,
+        and computes the logits with TrainableTokenEmbedding.forward(hidden_states, unembed=True).
+        Language models without an output head module (e.g. MPT-1B, whose forward multiplies with the input
+        embeddings weight) keep their input embeddings, whose full weight is trained with the gradients of all rows
+        but those of token_ids zeroed. The other rows then only change if the optimizer decays them (train.py
+        does not decay the embeddings), and FSDP, which flattens the weight, is not supported.
+        """
+        output_head = self.get_output_embeddings()
+        if output_head is None:
+            weight = self.get_input_embeddings().weight
+            weight.requires_grad_(True)
+            weight.register_hook(
+                functools.partial(
+                    _mask_gradient_rows,
+                    torch.tensor(token_ids, device=weight.device),
+                )
+            )
+            self.masked_token_embedding_ids = list(token_ids)
+            return
+        embedding = TrainableTokenEmbedding(self.get_input_embeddings(), token_ids)
+        if (
+            output_head is not embedding.base
+            and output_head.weight is embedding.base.weight
+        ):
+            output_head.register_forward_hook(embedding.tied_output_hook)
+        self.set_input_embeddings(embedding)
+
+    def has_tied_embeddings(self):
+        """
+        Whether the output head shares its weight with the input embeddings. Language models without an output
+        head module (e.g. MPT-1B) are assumed to compute their logits from the input embeddings.
+        """
+        input_embeddings = self.get_input_embeddings()
+        if isinstance(input_embeddings, TrainableTokenEmbedding):
+            input_embeddings = input_embeddings.base
+        output_head = self.get_output_embeddings()
+        return output_head is None or output_head.weight is input_embeddings.weight
+
+    def _condition_layers(self, input_ids, past_media_locations=None):
+        """
+        Condition the Flamingo layers on the media locations of input_ids
+        Args:
+            past_media_locations (torch.Tensor, optional): media token locations of the tokens in past_key_values,
+                shape (B, T_past). If given, text in input_ids also attends to media in past_key_values.
+        """
         if not self.initialized_flamingo:
             raise ValueError(
                 "Flamingo layers are not initialized. Please call `init_flamingo` first."
@@ -144,24 +453,117 @@ class FlamingoLMMixin(nn.Module):
             and self.is_conditioned()
             and not media_locations.any()
         )
+        if past_media_locations is not None:
+            media_locations = torch.cat([past_media_locations, media_locations], dim=1)
 
         for layer in self._get_decoder_layers():
             if not use_cached_media_locations:
                 layer.condition_media_locations(media_locations)
             layer.condition_use_cached_media(use_cached_media_locations)
 
+        # the text-to-media mask is the same for every cross attention layer,
+        # so build it once here rather than in each layer
+        conditioned_media_locations = self._get_decoder_layers()[0].media_locations
+        media_mask = (
+            MediaMask(
+                conditioned_media_locations,
+                use_cached_media=use_cached_media_locations,
+                num_text_tokens=input_ids.shape[1],
+            )
+            if conditioned_media_locations is not None
+            else None
+        )
+        for layer in self._get_decoder_layers():
+            layer.condition_media_mask(media_mask)
+
+    def forward(self, input_ids, attention_mask, past_media_locations=None, **kwargs):
+        """
+        Condition the Flamingo layers on the media locations before forward()
+        Args:
+            past_media_locations (torch.Tensor, optional): media token locations of the tokens in past_key_values,
+                shape (B, T_past). If given, text in input_ids also attends to media in past_key_values.
+        """
+        self._condition_layers(input_ids, past_media_locations)
+
         # package arguments for the other parent's forward. since we don't know the order of the arguments,
         # make them all kwargs
         kwargs["input_ids"] = input_ids
         kwargs["attention_mask"] = attention_mask
         return super().forward(**kwargs)  # Call the other parent's forward method
 
+    def _get_base_model(self):
+        """
+        The language model without its output head (e.g. OPTModel, MPT-7B's transformer), or None if it has no such
+        module (e.g. MPT-1B, whose transformer is an nn.ModuleDict run by the causal LM's own forward()).
+        """
+        base_model = self.base_model
+        if base_model is self:
+            # MPT-7B's base_model_prefix does not name its transformer
+            base_model = getattr(self, "transformer", None)
+        if base_model is None or isinstance(base_model, nn.ModuleDict):
+            return None
+        return base_model
+
+    def forward_hidden_states(
+        self, input_ids, attention_mask, past_media_locations=None, **kwargs
+    ):
+        """
+        forward() up to the output head: returns the final hidden states of the base model, to be passed to
+        output_logits(), instead of computing the logits. Language models without a base model module
+        (see _get_base_model) run the full forward(), whose output is returned instead.
+        """
+        base_model = self._get_base_model()
+        if base_model is None:
+            return self(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_media_locations=past_media_locations,
+                **kwargs,
+            )
+
+        self._condition_layers(input_ids, past_media_locations)
+        kwargs.pop("labels", None)
+        kwargs["input_ids"] = input_ids
+        kwargs["attention_mask"] = attention_mask
+        # a ModelOutput or, e.g. for MPT-style models, a tuple starting with the hidden states
+        return base_model(**kwargs)[0]
+
+    def output_logits(self, hidden_states):
+        """
+        Logits of the output head for the final hidden states. An output head that is the input embedding module
+        itself (e.g. MPT-7B's SharedEmbedding) computes the tied logits when called with unembed=True.
+        """
+        output_head = self.get_output_embeddings()
+        if output_head is self.get_input_embeddings():
+            return output_head(hidden_states, unembed=True)
+        return output_head(hidden_states)
+
     def is_conditioned(self) -> bool:
         """Check whether all decoder layers are already conditioned."""
         return all(l.is_conditioned() for l in self._get_decoder_layers())
 
     def clear_conditioned_layers(self):
         for layer in self._get_decoder_layers():
-            layer.condition_vis_x(None)
+            layer.condition_vis_x(None)  # also clears the cached media keys / values
             layer.condition_media_locations(None)
             layer.condition_use_cached_media(None)
+            layer.condition_media_mask(None)
+
+    @contextlib.contextmanager
+    def pin_conditioning(self):
+        """
+        Hold the current media conditioning in plain attributes of the modules for the enclosed code, so that
+        torch.compile can trace the decoder layers (it cannot trace the contextvars lookup). Meanwhile, the
+        conditioning is shared by all contexts: the model must not be used from other threads.
+        On exit, the (possibly updated) conditioning is moved back to the current context.
+        """
+        modules = [self, *self._get_decoder_layers()]
+        for module in modules:
+            module.pinned_conditioning = dict(_get_conditioning(module))
+        try:
+            yield
+        finally:
+            store = _get_conditioning_store()
+            for module in modules:
+                store[module] = module.pinned_conditioning
+                module.pinned_conditioning = None
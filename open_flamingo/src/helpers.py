@@ -3,15 +3,104 @@ Based on: https://github.com/lucidrains/flamingo-pytorch
 """
 
 import torch
-from einops import rearrange, repeat
+import torch.nn.functional as F
+from einops import rearrange, reduce, repeat
 from einops_exts import rearrange_many
 from torch import einsum, nn
 
+ATTENTION_BACKENDS = ("eager", "sdpa", "chunked")
+_attention_backend = "eager"
+
 
 def exists(val):
     return val is not None
 
 
+def set_attention_backend(backend):
+    """
+    Set the attention backend used by PerceiverAttention and MaskedCrossAttention
+    modules that were not given an explicit attention_backend.
+    Args:
+        backend (str): one of "eager", "sdpa" or "chunked"
+    """
+    global _attention_backend
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unsupported attention backend: {backend}. Choose from {ATTENTION_BACKENDS}."
+        )
+    _attention_backend = backend
+
+
+def get_attention_backend():
+    return _attention_backend
+
+
+def attention(q, k, v, mask=None, scale=None, backend="eager", chunk_size=1024):
+    """
+    Softmax attention over the last two dimensions.
+    Args:
+        q (torch.Tensor): queries
+            shape (..., i, d)
+        k (torch.Tensor): keys
+            shape (..., j, d)
+        v (torch.Tensor): values
+            shape (..., j, d)
+        mask (torch.Tensor, optional): boolean mask, True where a query may attend to a key
+            broadcastable to (..., i, j). Queries with no valid key attend uniformly to all keys.
+        scale (float, optional): scaling applied to q. Defaults to d**-0.5.
+        backend (str): "eager" materializes the full similarity matrix,
+            "sdpa" routes through torch.nn.functional.scaled_dot_product_attention,
+            "chunked" runs the eager computation over chunks of chunk_size queries.
+    Returns:
+        shape (..., i, d)
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+
+    if backend == "sdpa":
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * q.shape[-1] ** 0.5)
+        if not exists(mask):
+            return F.scaled_dot_product_attention(q, k, v)
+        # sdpa returns nan for fully masked rows; let these attend to every key
+        # and fill in the uniform average the eager path would produce
+        empty_rows = ~mask.any(dim=-1, keepdim=True)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask | empty_rows)
+        return torch.where(empty_rows, v.mean(dim=-2, keepdim=True), out)
+
+    if backend == "chunked":
+        outs = []
+        for start in range(0, q.shape[-2], chunk_size):
+            end = start + chunk_size
+            chunk_mask = None
+            if exists(mask):
+                chunk_mask = mask[..., start:end, :] if mask.shape[-2] > 1 else mask
+            outs.append(
+                attention(
+                    q[..., start:end, :],
+                    k,
+                    v,
+                    mask=chunk_mask,
+                    scale=scale,
+                    backend="eager",
+                )
+            )
+        return torch.cat(outs, dim=-2)
+
+    if backend != "eager":
+        raise ValueError(
+            f"Unsupported attention backend: {backend}. Choose from {ATTENTION_BACKENDS}."
+        )
+
+    q = q * scale
+    sim = einsum("... i d, ... j d -> ... i j", q, k)
+    if exists(mask):
+        sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+    sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+    attn = sim.softmax(dim=-1)
+    return einsum("... i j, ... j d -> ... i d", attn, v)
+
+
 def FeedForward(dim, mult=4):
     inner_dim = int(dim * mult)
     return nn.Sequential(
@@ -23,10 +112,12 @@ def FeedForward(dim, mult=4):
 
 
 class PerceiverAttention(nn.Module):
-    def __init__(self, *, dim, dim_head=64, heads=8):
+    def __init__(self, *, dim, dim_head=64, heads=8, attention_backend=None):
         super().__init__()
         self.scale = dim_head**-0.5
         self.heads = heads
+        # if None, use the global backend set with set_attention_backend()
+        self.attention_backend = attention_backend
         inner_dim = dim_head * heads
 
         self.norm_media = nn.LayerNorm(dim)
@@ -52,16 +143,17 @@ class PerceiverAttention(nn.Module):
         q = self.to_q(latents)
         kv_input = torch.cat((x, latents), dim=-2)
         k, v = self.to_kv(kv_input).chunk(2, dim=-1)
-        q, k, v = rearrange_many((q, k, v), "b t n (h d) -> b h t n d", h=h)
-        q = q * self.scale
+        q, k, v = rearrange_many((q, k, v), "b t n (h d) -> (b t) h n d", h=h)
 
         # attention
-        sim = einsum("... i d, ... j d  -> ... i j", q, k)
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
-
-        out = einsum("... i j, ... j d -> ... i d", attn, v)
-        out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
+        out = attention(
+            q,
+            k,
+            v,
+            scale=self.scale,
+            backend=self.attention_backend or get_attention_backend(),
+        )
+        out = rearrange(out, "(b t) h n d -> b t n (h d)", b=latents.shape[0])
         return self.to_out(out)
 
 
@@ -77,6 +169,7 @@ class PerceiverResampler(nn.Module):
         max_num_media=None,
         max_num_frames=None,
         ff_mult=4,
+        attention_backend=None,
     ):
         super().__init__()
         self.latents = nn.Parameter(torch.randn(num_latents, dim))
@@ -96,7 +189,12 @@ class PerceiverResampler(nn.Module):
             self.layers.append(
                 nn.ModuleList(
                     [
-                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads),
+                        PerceiverAttention(
+                            dim=dim,
+                            dim_head=dim_head,
+                            heads=heads,
+                            attention_backend=attention_backend,
+                        ),
                         FeedForward(dim=dim, mult=ff_mult),
                     ]
                 )
@@ -132,6 +230,94 @@ class PerceiverResampler(nn.Module):
         return self.norm(latents)
 
 
+class MediaMask:
+    """
+    Which media each text token may attend to. It only depends on the media locations,
+    so it is built once per forward pass and shared by all cross attention layers;
+    the masks / indices derived from it are computed on first use and reused.
+    """
+
+    def __init__(self, media_locations, use_cached_media=False, num_text_tokens=None):
+        """
+        Args:
+            media_locations: boolean mask identifying the media tokens
+                shape (B, T)
+            use_cached_media: bool
+                If true, treat all text as if it occurs after the last media
+                registered in media_locations.
+            num_text_tokens (int): number of text tokens T_txt.
+                Needed if use_cached_media, or if media_locations also covers T - T_txt tokens
+                that are in past_key_values. Otherwise T_txt = T.
+        """
+        self.media_locations = media_locations
+        self.use_cached_media = use_cached_media
+        if use_cached_media:
+            # text time is set to the last cached media location
+            self.text_time = repeat(
+                torch.count_nonzero(media_locations, dim=1),
+                "b -> b i",
+                i=num_text_tokens,
+            )
+        else:
+            # at each boolean of True, increment the time counter (relative to media time)
+            self.text_time = media_locations.cumsum(dim=-1)
+            if num_text_tokens is not None:
+                # only the last num_text_tokens locations are text inputs
+                self.text_time = self.text_time[:, -num_text_tokens:]
+        self._memo = {}
+
+    def text_to_media_mask(self, num_media, num_latents, only_attend_immediate_media):
+        """
+        Returns:
+            boolean mask, True where a text token may attend to a media latent
+                shape (B, 1, T_txt, num_media * num_latents)
+        """
+        key = ("mask", num_media, num_latents, only_attend_immediate_media)
+        if key not in self._memo:
+            media_time = torch.arange(num_media, device=self.text_time.device) + 1
+
+            # text time must equal media time if only attending to most immediate image
+            # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
+            mask_op = torch.eq if only_attend_immediate_media else torch.ge
+
+            self._memo[key] = mask_op(
+                rearrange(self.text_time, "b i -> b 1 i 1"),
+                repeat(media_time, "j -> 1 1 1 (j n)", n=num_latents),
+            )
+        return self._memo[key]
+
+    def media_blocks(self, num_media):
+        """
+        Text following the same media is contiguous, so text tokens can be grouped into
+        one block per media. Only valid if not use_cached_media.
+        Returns:
+            block_index: index of each text token in the flattened (num_media, block_len) blocks.
+                Text without a matching media is assigned the extra index num_media * block_len.
+                shape (B, T_txt)
+            block_len (int): length of the longest block
+        """
+        key = ("blocks", num_media)
+        if key not in self._memo:
+            positions = torch.arange(
+                self.media_locations.shape[1], device=self.text_time.device
+            )
+            last_media_position = (
+                (positions * self.media_locations).cummax(dim=-1).values
+            )
+            block_position = (positions - last_media_position)[
+                :, -self.text_time.shape[1] :
+            ]
+            has_media = (self.text_time > 0) & (self.text_time <= num_media)
+            block_len = int(block_position.masked_fill(~has_media, 0).max()) + 1
+            block_index = torch.where(
+                has_media,
+                (self.text_time - 1) * block_len + block_position,
+                num_media * block_len,
+            )
+            self._memo[key] = (block_index, block_len)
+        return self._memo[key]
+
+
 # gated cross attention
 class MaskedCrossAttention(nn.Module):
     def __init__(
@@ -142,11 +328,15 @@ class MaskedCrossAttention(nn.Module):
         dim_head=64,
         heads=8,
         only_attend_immediate_media=True,
+        attention_backend=None,
+        gather_immediate_media=False,
     ):
         super().__init__()
         self.scale = dim_head**-0.5
         self.heads = heads
         inner_dim = dim_head * heads
+        # if None, use the global backend set with set_attention_backend()
+        self.attention_backend = attention_backend
 
         self.norm = nn.LayerNorm(dim)
 
@@ -157,7 +347,84 @@ class MaskedCrossAttention(nn.Module):
         # whether for text to only attend to immediate preceding image, or all previous images
         self.only_attend_immediate_media = only_attend_immediate_media
 
-    def forward(self, x, media, media_locations=None, use_cached_media=False):
+        # if only attending to the immediate media, whether to group text tokens by media and
+        # attend to that media's latents instead of masking the similarities to all T_img * n latents
+        self.gather_immediate_media = gather_immediate_media
+
+    def project_media(self, media):
+        """
+        Compute the keys and values for the media.
+        Args:
+            media (torch.Tensor): image features
+                shape (B, T_img, n, D_img) where n is the dim of the latents
+        Returns:
+            k, v (torch.Tensor): each of shape (B, heads, T_img * n, dim_head)
+        """
+        media = rearrange(media, "b t n d -> b (t n) d")
+        k, v = self.to_kv(media).chunk(2, dim=-1)
+        # rearrange each rather than with rearrange_many, whose generator torch.compile cannot trace
+        k = rearrange(k, "b n (h d) -> b h n d", h=self.heads)
+        v = rearrange(v, "b n (h d) -> b h n d", h=self.heads)
+        return k, v
+
+    def _attend_immediate_media(self, q, k, v, media_mask, n, backend):
+        """
+        Attention where each text token only sees the n latents of its immediately preceding media.
+        Rather than masking the similarities to all T_img * n latents, queries are grouped by media
+        and attend densely to that media's latents.
+        Args:
+            q (torch.Tensor): shape (B, heads, T_txt, dim_head)
+            k, v (torch.Tensor): shape (B, heads, T_img * n, dim_head)
+            media_mask (MediaMask): media each text token attends to
+        Returns:
+            shape (B, heads, T_txt, dim_head). Rows of text without a preceding media are zeroed by forward().
+        """
+        b, h, T_txt, d = q.shape
+        k = rearrange(k, "b h (t n) d -> b h t n d", n=n)
+        v = rearrange(v, "b h (t n) d -> b h t n d", n=n)
+        T_img = k.shape[2]
+        text_time = media_mask.text_time
+
+        if media_mask.use_cached_media:
+            # all text attends to the last cached media
+            media_index = (text_time[:, 0] - 1).clamp(min=0, max=T_img - 1)
+            media_index = rearrange(media_index, "b -> b 1 1 1 1").expand(
+                -1, h, 1, n, d
+            )
+            out = attention(
+                q,
+                k.gather(2, media_index).squeeze(2),
+                v.gather(2, media_index).squeeze(2),
+                scale=self.scale,
+                backend=backend,
+            )
+        else:
+            # scatter queries into (T_img, block_len) blocks; other text goes to a trailing dummy slot
+            block_index, block_len = media_mask.media_blocks(T_img)
+            block_index = rearrange(block_index, "b i -> b 1 i 1").expand(-1, h, -1, d)
+            q = q.new_zeros(b, h, T_img * block_len + 1, d).scatter(2, block_index, q)
+            q = rearrange(q[:, :, :-1], "b h (t l) d -> b h t l d", l=block_len)
+
+            out = attention(q, k, v, scale=self.scale, backend=backend)
+            out = rearrange(out, "b h t l d -> b h (t l) d")
+            out = F.pad(out, (0, 0, 0, 1)).gather(2, block_index)
+
+        # as in the masked path, text after more media tokens than there are media
+        # has no matching media and attends uniformly to all of them
+        no_matching_media = rearrange(text_time > T_img, "b i -> b 1 i 1")
+        return torch.where(
+            no_matching_media, reduce(v, "b h t n d -> b h 1 d", "mean"), out
+        )
+
+    def forward(
+        self,
+        x,
+        media,
+        media_locations=None,
+        use_cached_media=False,
+        media_kv=None,
+        media_mask=None,
+    ):
         """
         Args:
             x (torch.Tensor): text features
@@ -165,16 +432,21 @@ class MaskedCrossAttention(nn.Module):
             media (torch.Tensor): image features
                 shape (B, T_img, n, D_img) where n is the dim of the latents
             media_locations: boolean mask identifying the media tokens in x
-                shape (B, T_txt)
+                shape (B, T_txt), or (B, T) where the first T - T_txt locations
+                are tokens in past_key_values preceding x
             use_cached_media: bool
                 If true, treat all of x as if they occur after the last media
                 registered in media_locations. T_txt does not need to exactly
                 equal media_locations.shape[1] in this case
+            media_kv: optional tuple of (k, v) precomputed by project_media(media).
+                If provided, the media is not projected again.
+            media_mask (MediaMask): optional MediaMask built from media_locations and use_cached_media.
+                If provided, it is used instead of recomputing the text-to-media mask.
         """
 
         if not use_cached_media:
             assert (
-                media_locations.shape[1] == x.shape[1]
+                media_locations.shape[1] >= x.shape[1]
             ), f"media_location.shape is {media_locations.shape} but x.shape is {x.shape}"
 
         T_txt = x.shape[1]
@@ -184,51 +456,45 @@ class MaskedCrossAttention(nn.Module):
         x = self.norm(x)
 
         q = self.to_q(x)
-        media = rearrange(media, "b t n d -> b (t n) d")
-
-        k, v = self.to_kv(media).chunk(2, dim=-1)
-        q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=h)
+        q = rearrange(q, "b n (h d) -> b h n d", h=h)
+        k, v = media_kv if exists(media_kv) else self.project_media(media)
 
-        q = q * self.scale
-
-        sim = einsum("... i d, ... j d -> ... i j", q, k)
-
-        if exists(media_locations):
-            media_time = torch.arange(T_img, device=x.device) + 1
+        if exists(media_locations) and not exists(media_mask):
+            media_mask = MediaMask(
+                media_locations,
+                use_cached_media=use_cached_media,
+                num_text_tokens=T_txt,
+            )
 
-            if use_cached_media:
-                # text time is set to the last cached media location
-                text_time = repeat(
-                    torch.count_nonzero(media_locations, dim=1),
-                    "b -> b i",
-                    i=T_txt,
+        backend = self.attention_backend or get_attention_backend()
+        if (
+            exists(media_mask)
+            and self.only_attend_immediate_media
+            and self.gather_immediate_media
+        ):
+            out = self._attend_immediate_media(q, k, v, media_mask, n, backend)
+        else:
+            out = attention(
+                q,
+                k,
+                v,
+                mask=media_mask.text_to_media_mask(
+                    T_img, n, self.only_attend_immediate_media
                 )
-            else:
-                # at each boolean of True, increment the time counter (relative to media time)
-                text_time = media_locations.cumsum(dim=-1)
-
-            # text time must equal media time if only attending to most immediate image
-            # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
-            mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
-
-            text_to_media_mask = mask_op(
-                rearrange(text_time, "b i -> b 1 i 1"),
-                repeat(media_time, "j -> 1 1 1 (j n)", n=n),
+                if exists(media_mask)
+                else None,
+                scale=self.scale,
+                backend=backend,
             )
-            sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
-
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
 
-        if exists(media_locations) and self.only_attend_immediate_media:
+        if exists(media_mask) and self.only_attend_immediate_media:
             # any text without a preceding media needs to have attention zeroed out
-            text_without_media_mask = text_time == 0
+            text_without_media_mask = media_mask.text_time == 0
             text_without_media_mask = rearrange(
                 text_without_media_mask, "b i -> b 1 i 1"
             )
-            attn = attn.masked_fill(text_without_media_mask, 0.0)
+            out = out.masked_fill(text_without_media_mask, 0.0)
 
-        out = einsum("... i j, ... j d -> ... i d", attn, v)
         out = rearrange(out, "b h n d -> b n (h d)")
         return self.to_out(out)
 
@@ -243,6 +509,8 @@ class GatedCrossAttentionBlock(nn.Module):
         heads=8,
         ff_mult=4,
         only_attend_immediate_media=True,
+        attention_backend=None,
+        gather_immediate_media=False,
     ):
         super().__init__()
         self.attn = MaskedCrossAttention(
@@ -251,6 +519,8 @@ class GatedCrossAttentionBlock(nn.Module):
             dim_head=dim_head,
             heads=heads,
             only_attend_immediate_media=only_attend_immediate_media,
+            attention_backend=attention_backend,
+            gather_immediate_media=gather_immediate_media,
         )
         self.attn_gate = nn.Parameter(torch.tensor([0.0]))
 
@@ -263,6 +533,8 @@ class GatedCrossAttentionBlock(nn.Module):
         media,
         media_locations=None,
         use_cached_media=False,
+        media_kv=None,
+        media_mask=None,
     ):
         x = (
             self.attn(
@@ -270,6 +542,8 @@ class GatedCrossAttentionBlock(nn.Module):
                 media,
                 media_locations=media_locations,
                 use_cached_media=use_cached_media,
+                media_kv=media_kv,
+                media_mask=media_mask,
             )
             * self.attn_gate.tanh()
             + x
@@ -0,0 +1,227 @@
+import itertools
+import threading
+
+import torch
+
+
+class _RadixNode:
+    def __init__(self, key=(), kv=None, parent=None):
+        self.key = key  # labels of the edge from parent to this node
+        # per layer tuple of key / value tensors for the tokens in self.key
+        self.kv = kv
+        self.parent = parent
+        self.children = {}  # first label of the child's key -> child
+        self.last_access = 0
+        self.num_bytes = _kv_bytes(kv) if kv is not None else 0
+
+
+class PrefixCache:
+    """
+    LRU cache of language model past_key_values for shared prompt prefixes (e.g. few-shot demonstrations).
+    Prefixes are stored in a radix tree over token labels, where each node holds the past_key_values for the tokens
+    on its incoming edge, so prompts sharing a prefix also share its memory.
+    A token's label is its id, or (media_token_id, image id) for media tokens, so that prefixes only match if they
+    contain the same images.
+
+    The cached keys / values depend on the model weights: clear() the cache whenever they change.
+    """
+
+    def __init__(self, max_bytes: int, seq_dims=(-2, -2)):
+        """
+        Args:
+            max_bytes (int): memory budget for the cached keys / values. Least recently used
+                prefixes are evicted once the budget is exceeded.
+            seq_dims (tuple, optional): sequence dimensions of the key and of the value tensors of each layer
+                (see FlamingoLMMixin.kv_seq_dims). Defaults to (-2, -2), the Hugging Face convention of
+                (batch, heads, sequence, head_dim).
+        """
+        self.max_bytes = max_bytes
+        self.seq_dims = tuple(seq_dims)
+        self._root = _RadixNode()
+        self._clock = itertools.count(1)
+        # the cache may be shared by threads serving requests with the same model
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.num_nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.query_tokens = 0
+        self.evictions = 0
+
+    def match(self, labels, max_length=None):
+        """
+        Find the longest cached prefix of labels.
+        Args:
+            labels (list): token labels of one sequence
+            max_length (int, optional): upper bound on the length of the match
+        Returns:
+            (length of the match, per layer tuples of key / value tensors of shape (1, ..., length, ...)
+            along seq_dims, or None if nothing matched)
+        """
+        labels = labels if max_length is None else labels[:max_length]
+        with self._lock:
+            node, length, segments = self._root, 0, []
+            now = next(self._clock)
+            while length < len(labels):
+                child = node.children.get(labels[length])
+                if child is None:
+                    break
+                common = _common_prefix_length(child.key, labels[length:])
+                child.last_access = now
+                segments.append(
+                    child.kv
+                    if common == len(child.key)
+                    else self._slice(child.kv, 0, common)
+                )
+                length += common
+                if common < len(child.key):
+                    break
+                node = child
+
+            self.query_tokens += len(labels)
+            self.hit_tokens += length
+            if length > 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if length == 0:
+            return 0, None
+        return length, self._concat(segments)
+
+    def insert(self, labels, kv):
+        """
+        Cache the past_key_values of a sequence.
+        Args:
+            labels (list): token labels of the sequence
+            kv: per layer tuples of key / value tensors of shape (1, ..., len(labels), ...) along seq_dims
+        """
+        with self._lock:
+            node, length = self._root, 0
+            now = next(self._clock)
+            while length < len(labels):
+                child = node.children.get(labels[length])
+                if child is None:
+                    leaf = _RadixNode(
+                        tuple(labels[length:]),
+                        self._slice(kv, length, len(labels), clone=True),
+                        parent=node,
+                    )
+                    leaf.last_access = now
+                    node.children[leaf.key[0]] = leaf
+                    self.num_bytes += leaf.num_bytes
+                    self.num_nodes += 1
+                    break
+                common = _common_prefix_length(child.key, labels[length:])
+                if common < len(child.key):
+                    child = self._split(child, common)
+                child.last_access = now
+                node = child
+                length += common
+            self._evict()
+
+    def clear(self):
+        """Drop all cached prefixes, e.g. after the model weights change."""
+        with self._lock:
+            self._root = _RadixNode()
+            self.num_bytes = 0
+            self.num_nodes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.query_tokens = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Return hit / miss / eviction counters and current usage."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "token_hit_rate": self.hit_tokens / self.query_tokens
+            if self.query_tokens > 0
+            else 0.0,
+            "num_nodes": self.num_nodes,
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _split(self, node, length):
+        """Split node's edge after length labels, returning the new parent node."""
+        parent = _RadixNode(
+            node.key[:length], self._slice(node.kv, 0, length, clone=True), node.parent
+        )
+        parent.last_access = node.last_access
+        parent.children[node.key[length]] = node
+        node.parent.children[node.key[0]] = parent
+        self.num_bytes += parent.num_bytes - node.num_bytes
+        node.key = node.key[length:]
+        node.kv = self._slice(node.kv, length, length + len(node.key), clone=True)
+        node.num_bytes = _kv_bytes(node.kv)
+        node.parent = parent
+        self.num_bytes += node.num_bytes
+        self.num_nodes += 1
+        return parent
+
+    def _evict(self):
+        """Evict least recently used leaves until the cache fits in max_bytes."""
+        while self.num_bytes > self.max_bytes:
+            leaves = [n for n in self._iter_nodes() if len(n.children) == 0]
+            if len(leaves) == 0:
+                break
+            leaf = min(leaves, key=lambda n: n.last_access)
+            del leaf.parent.children[leaf.key[0]]
+            self.num_bytes -= leaf.num_bytes
+            self.num_nodes -= 1
+            self.evictions += 1
+
+    def _iter_nodes(self):
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def _slice(self, kv, start, end, clone=False):
+        sliced = tuple(
+            tuple(
+                t.narrow(dim, start, end - start)
+                for t, dim in zip(layer, self.seq_dims)
+            )
+            for layer in kv
+        )
+        if clone:
+            sliced = tuple(tuple(t.clone() for t in layer) for layer in sliced)
+        return sliced
+
+    def _concat(self, segments):
+        if len(segments) == 1:
+            return segments[0]
+        return tuple(
+            tuple(
+                torch.cat(tensors, dim=dim)
+                for tensors, dim in zip(zip(*layers), self.seq_dims)
+            )
+            for layers in zip(*segments)
+        )
+
+    def __len__(self):
+        return self.num_nodes
+
+
+def _common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _kv_bytes(kv):
+    return sum(t.numel() * t.element_size() for layer in kv for t in layer)
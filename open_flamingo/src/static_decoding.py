@@ -0,0 +1,401 @@
+import contextlib
+import inspect
+import math
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+from .flamingo import Flamingo
+from .flamingo_lm import FlamingoLMMixin
+from .helpers import MediaMask
+from .utils import extend_instance
+
+
+def _attend_past_and_new(q, past_keys_t, past_values, k, v, bias):
+    """
+    Attention of a new token to the past tokens and to itself, reading the past keys / values in place.
+    Args:
+        q, k, v (torch.Tensor): scaled query, key and value of the new token
+            shape (B, heads, 1, head_dim)
+        past_keys_t (torch.Tensor): past keys, transposed
+            shape (B, heads, head_dim, L)
+        past_values (torch.Tensor): shape (B, heads, L, head_dim)
+        bias (torch.Tensor): additive attention bias of the past tokens followed by the new token
+            broadcastable to (B, heads, 1, L + 1)
+    Returns:
+        shape (B, heads, 1, head_dim)
+    """
+    scores = torch.cat([q @ past_keys_t, (q * k).sum(dim=-1, keepdim=True)], dim=-1)
+    min_val = torch.finfo(scores.dtype).min
+    scores = (scores + bias).clamp(min=min_val)
+    if scores.dtype == torch.float16:
+        probs = scores.softmax(dim=-1, dtype=torch.float32).to(scores.dtype)
+    else:
+        probs = scores.softmax(dim=-1)
+    return probs[..., :-1] @ past_values + probs[..., -1:] * v
+
+
+class _OPTStaticAttention:
+    """
+    Mixin for Hugging Face's OPTAttention. While static_decoding is set, past_key_value holds views of the
+    StaticCacheDecoder buffers: one token attends to them and to itself without concatenating them, and the new
+    token's (keys, values) are left in static_decoding_outputs for the decoder to write into its buffers.
+    """
+
+    def forward(
+        self, hidden_states, past_key_value=None, attention_mask=None, **kwargs
+    ):
+        if not self.static_decoding:
+            return super().forward(
+                hidden_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                **kwargs,
+            )
+        bsz = hidden_states.shape[0]
+        q = self._shape(self.q_proj(hidden_states) * self.scaling, 1, bsz)
+        k = self._shape(self.k_proj(hidden_states), 1, bsz)
+        v = self._shape(self.v_proj(hidden_states), 1, bsz)
+        past_keys, past_values = past_key_value
+        out = _attend_past_and_new(
+            q, past_keys.transpose(-1, -2), past_values, k, v, attention_mask
+        )
+        self.static_decoding_outputs["key_value"] = (k, v)
+        out = self.out_proj(out.transpose(1, 2).reshape(bsz, 1, self.embed_dim))
+        return out, None, None
+
+
+class _MPTStaticAttention:
+    """
+    Mixin for the MultiheadAttention of MosaicML's MPT (torch attention implementation), like _OPTStaticAttention.
+    MPT caches keys as (B, heads, head_dim, L).
+    """
+
+    def forward(
+        self, x, past_key_value=None, attn_bias=None, attention_mask=None, **kwargs
+    ):
+        if not self.static_decoding:
+            return super().forward(
+                x,
+                past_key_value=past_key_value,
+                attn_bias=attn_bias,
+                attention_mask=attention_mask,
+                **kwargs,
+            )
+        qkv = self.Wqkv(x)
+        if getattr(self, "clip_qkv", None):
+            qkv = qkv.clamp(min=-self.clip_qkv, max=self.clip_qkv)
+        q, k, v = qkv.chunk(3, dim=2)
+        if getattr(self, "qk_ln", False):
+            q, k = self.q_ln(q).to(q.dtype), self.k_ln(k).to(k.dtype)
+        q = rearrange(q, "b s (h d) -> b h s d", h=self.n_heads)
+        k = rearrange(k, "b s (h d) -> b h s d", h=self.n_heads)
+        v = rearrange(v, "b s (h d) -> b h s d", h=self.n_heads)
+        scale = self.softmax_scale or q.shape[-1] ** -0.5
+
+        past_keys, past_values = past_key_value
+        num_keys = past_values.shape[2] + 1
+        bias = torch.zeros((), dtype=q.dtype, device=q.device)
+        if attn_bias is not None:
+            bias = attn_bias[:, :, -1:, -num_keys:]
+        if attention_mask is not None:
+            bias = bias.masked_fill(
+                ~attention_mask.bool().view(-1, 1, 1, num_keys),
+                torch.finfo(q.dtype).min,
+            )
+        out = _attend_past_and_new(q * scale, past_keys, past_values, k, v, bias)
+        self.static_decoding_outputs["key_value"] = (k.transpose(-1, -2), v)
+        out = self.out_proj(rearrange(out, "b h s d -> b s (h d)"))
+        return out, None, None
+
+
+# attribute name of the self attention of each supported decoder layer class, and its static attention mixin
+_STATIC_ATTENTION = {
+    "OPTDecoderLayer": ("self_attn", _OPTStaticAttention),
+    "MPTBlock": ("attn", _MPTStaticAttention),
+}
+
+
+class StaticCacheDecoder:
+    """
+    Greedy decoding with fixed-size, preallocated past_key_values, for torch.compile / CUDA graphs.
+
+    Flamingo.generate concatenates every new token's keys / values to the past_key_values, so every step copies
+    the whole cache and has new shapes, and FlamingoLMMixin.forward decides how to condition the cross attention
+    with a data-dependent media_locations.any() check. Here the prompt's past_key_values are copied into buffers of
+    max_length tokens per layer. In each decode step, the self attention modules (extended with a static
+    attention mixin) read the buffers in place and attend to the new token separately; its keys / values are then
+    written into the buffers at the next position.
+    Steps only attend to the first tokens of the buffers, rounded up to a multiple of bucket_size, so the step
+    has one set of shapes per bucket (compiled once per bucket) rather than one per token, without attending to
+    the whole max_length. The cross attention conditioning is fixed after the prompt: every decoded token attends
+    to the last image of its sequence, so the text-to-media mask and the projected media keys / values are computed
+    once and pinned in plain attributes (see FlamingoLMMixin.pin_conditioning), and the step calls the language
+    model without the mixin's conditioning logic.
+
+    Supports language models with OPT or MosaicML MPT (e.g. MPT-7B) decoder layers. While decoding, the model must
+    not be used from other threads.
+    """
+
+    def __init__(
+        self,
+        model: Flamingo,
+        max_length: int,
+        bucket_size: int = 64,
+        compile: bool = False,
+        **compile_kwargs,
+    ):
+        """
+        Args:
+            model (Flamingo): model to generate with
+            max_length (int): capacity of the buffers, i.e. the maximum number of prompt and generated tokens
+            bucket_size (int, optional): granularity of the number of buffered tokens attended to. Smaller buckets
+                attend to less padding, but compile more graphs. Defaults to 64.
+            compile (bool, optional): whether to compile the decode step with torch.compile. Defaults to False.
+            **compile_kwargs: passed to torch.compile, e.g. mode="reduce-overhead" to use CUDA graphs.
+        """
+        self.model = model
+        self.max_length = max_length
+        self.bucket_size = bucket_size
+        self.kv_seq_dims = model.lang_encoder.kv_seq_dims
+        self._attentions = []
+        for layer in model.lang_encoder._get_decoder_layers():
+            decoder_layer = layer.decoder_layer
+            if decoder_layer.__class__.__name__ not in _STATIC_ATTENTION:
+                raise ValueError(
+                    f"StaticCacheDecoder does not support {decoder_layer.__class__.__name__} decoder layers. "
+                    f"Supported: {list(_STATIC_ATTENTION)}."
+                )
+            attr, mixin = _STATIC_ATTENTION[decoder_layer.__class__.__name__]
+            attention = getattr(decoder_layer, attr)
+            if not isinstance(attention, mixin):
+                extend_instance(attention, mixin)
+                attention.static_decoding = False
+                attention.static_decoding_outputs = {}
+            self._attentions.append(attention)
+
+        self._pass_position_ids = (
+            "position_ids"
+            in inspect.signature(
+                super(FlamingoLMMixin, model.lang_encoder).forward
+            ).parameters
+        )
+        if compile:
+            from einops._torch_specific import allow_ops_in_compiled_graph
+
+            allow_ops_in_compiled_graph()
+        self._step = (
+            torch.compile(self._decode_step, **compile_kwargs)
+            if compile
+            else self._decode_step
+        )
+        self.past_key_values = None
+        self.attention_mask = None
+        self.length = 0
+        self._pinned_conditioning = contextlib.ExitStack()
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        max_new_tokens: int = 20,
+        eos_token_id: int = None,
+        image_ids=None,
+    ):
+        """
+        Greedily generate text, like Flamingo.generate with num_beams=1.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+            lang_x (torch.Tensor): Language input, left-padded
+                shape (B, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask of lang_x. Defaults to None.
+            max_new_tokens (int, optional): maximum number of tokens to generate. Defaults to 20.
+            eos_token_id (int, optional): token that ends a sequence. Defaults to the <|endofchunk|> token.
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+                Used as keys for the vision feature and prefix caches.
+        Returns:
+            torch.Tensor: lang_x with generated tokens appended to it. Sequences that ended early are
+                padded with eos_token_id.
+        """
+        eos_token_id = (
+            eos_token_id if eos_token_id is not None else self.model.eoc_token_id
+        )
+        try:
+            logits = self.prefill(
+                vision_x,
+                lang_x,
+                attention_mask=attention_mask,
+                image_ids=image_ids,
+                max_new_tokens=max_new_tokens,
+            )
+            tokens = []
+            finished = torch.zeros(
+                lang_x.shape[0], dtype=torch.bool, device=lang_x.device
+            )
+            for i in range(max_new_tokens):
+                next_tokens = logits.argmax(dim=-1).masked_fill(finished, eos_token_id)
+                tokens.append(next_tokens)
+                finished |= next_tokens == eos_token_id
+                if i == max_new_tokens - 1 or finished.all():
+                    break
+                logits = self.step(next_tokens[:, None])
+        finally:
+            self.reset()
+        return torch.cat([lang_x, torch.stack(tokens, dim=1)], dim=1)
+
+    @torch.inference_mode()
+    def prefill(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        image_ids=None,
+        max_new_tokens: int = 0,
+    ):
+        """
+        Run the prompt, then copy its past_key_values into the buffers and condition the model for step().
+        Uses Flamingo.prefill() if the model has a prefix cache (see Flamingo.enable_prefix_cache).
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+            lang_x (torch.Tensor): Language input, left-padded
+                shape (B, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask of lang_x. Defaults to None.
+            image_ids (list, optional): ids of the images in vision_x, a list of B lists of T_img ids.
+            max_new_tokens (int, optional): number of tokens that will be generated, to check that they fit
+                in the buffers. Defaults to 0.
+        Returns:
+            logits of the last prompt token, shape (B, vocab_size)
+        """
+        model = self.model
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+
+        model.lang_encoder._use_cached_vision_x = False
+        if model.prefix_cache is not None:
+            output, attention_mask = model.prefill(
+                lang_x=lang_x,
+                vision_x=vision_x,
+                attention_mask=attention_mask,
+                image_ids=image_ids,
+            )
+        else:
+            # positions follow the attention mask, like in the decode steps
+            model._encode_vision_x(vision_x=vision_x, image_ids=image_ids)
+            output = model.lang_encoder(
+                input_ids=lang_x,
+                attention_mask=attention_mask,
+                use_cache=True,
+                **model._position_ids_kwargs(attention_mask, lang_x.shape[1]),
+            )
+        L = attention_mask.shape[1]
+        assert (
+            L + max_new_tokens <= self.max_length
+        ), f"prompt of {L} tokens and {max_new_tokens} new tokens do not fit in max_length={self.max_length}"
+
+        self.past_key_values = tuple(
+            tuple(
+                self._allocate(t, dim) for t, dim in zip(layer_past, self.kv_seq_dims)
+            )
+            for layer_past in output.past_key_values
+        )
+        self.attention_mask = F.pad(
+            attention_mask.bool(), (0, self.max_length - L), value=False
+        )
+        self.length = L
+
+        # every decoded token attends to the last media of its sequence
+        model.lang_encoder._use_cached_vision_x = True
+        layers = model.lang_encoder._get_decoder_layers()
+        media_mask = MediaMask(
+            layers[0].media_locations, use_cached_media=True, num_text_tokens=1
+        )
+        for layer in layers:
+            layer.condition_use_cached_media(True)
+            layer.condition_media_mask(media_mask)
+            if layer.gated_cross_attn_layer is not None:
+                attn = layer.gated_cross_attn_layer.attn
+                layer.media_kv = attn.project_media(layer.vis_x)
+                media_mask.text_to_media_mask(
+                    layer.vis_x.shape[1],
+                    layer.vis_x.shape[2],
+                    attn.only_attend_immediate_media,
+                )
+        self._pinned_conditioning.enter_context(model.lang_encoder.pin_conditioning())
+        self._set_static_decoding(True)
+        return output.logits[:, -1]
+
+    @torch.inference_mode()
+    def step(self, input_ids: torch.Tensor):
+        """
+        Run one decode step and write its keys / values into the buffers.
+        Args:
+            input_ids (torch.Tensor): next token of each sequence
+                shape (B, 1)
+        Returns:
+            logits of input_ids, shape (B, vocab_size)
+        """
+        position = self.length
+        assert position < self.max_length, "the buffers are full"
+        num_past = min(
+            math.ceil(position / self.bucket_size) * self.bucket_size,
+            self.max_length,
+        )
+        attention_mask = F.pad(self.attention_mask[:, :num_past], (0, 1), value=True)
+        # a list, since some models (e.g. MPT-7B) assign to it
+        past_key_values = [
+            tuple(t.narrow(dim, 0, num_past) for t, dim in zip(layer, self.kv_seq_dims))
+            for layer in self.past_key_values
+        ]
+        logits = self._step(input_ids, attention_mask, past_key_values)
+        for attention, layer_buffers in zip(self._attentions, self.past_key_values):
+            new_key_value = attention.static_decoding_outputs.pop("key_value")
+            for buffer, t, dim in zip(layer_buffers, new_key_value, self.kv_seq_dims):
+                buffer.narrow(dim, position, 1).copy_(t)
+        self.attention_mask[:, position] = True
+        self.length += 1
+        return logits
+
+    def reset(self):
+        """Free the buffers and clear the conditioning."""
+        self._set_static_decoding(False)
+        self._pinned_conditioning.close()
+        self.past_key_values = None
+        self.attention_mask = None
+        self.length = 0
+        self.model.lang_encoder.clear_conditioned_layers()
+        self.model.lang_encoder._use_cached_vision_x = False
+
+    def _decode_step(self, input_ids, attention_mask, past_key_values):
+        """
+        Language model forward for one token, with static shapes and no data-dependent control flow.
+        The keys / values of the new token are left in the static_decoding_outputs of the attention modules.
+        """
+        kwargs = {}
+        if self._pass_position_ids:
+            kwargs["position_ids"] = attention_mask.long().sum(dim=-1, keepdim=True) - 1
+        output = super(FlamingoLMMixin, self.model.lang_encoder).forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=False,
+            **kwargs,
+        )
+        return output.logits[:, -1]
+
+    def _set_static_decoding(self, static_decoding):
+        for attention in self._attentions:
+            attention.static_decoding = static_decoding
+
+    def _allocate(self, t, seq_dim):
+        """Copy t into a new buffer of max_length along seq_dim, left-aligned."""
+        L = t.shape[seq_dim]
+        shape = list(t.shape)
+        shape[seq_dim] = self.max_length
+        buffer = t.new_zeros(shape)
+        buffer.narrow(seq_dim, 0, L).copy_(t)
+        return buffer
@@ -0,0 +1,61 @@
+import torch
+from transformers import LogitsProcessor
+
+
+class StopSequencesLogitsProcessor(LogitsProcessor):
+    """
+    Forces eos_token_id for every sequence whose generated text contains one of the stop strings or ends with one of
+    the stop token sequences. With greedy decoding and sampling the sequence is then finished; with beam search
+    the beam is finalised as a hypothesis. generate() returns as soon as all sequences are finished, so a batch
+    stops once every sequence has emitted a stop sequence rather than after max_new_tokens.
+    """
+
+    def __init__(
+        self,
+        eos_token_id: int,
+        stop_token_sequences=None,
+        stop_strings=None,
+        tokenizer=None,
+    ):
+        """
+        Args:
+            eos_token_id (int): token that ends a sequence
+            stop_token_sequences (list, optional): list of lists of token ids
+            stop_strings (list, optional): list of strings, matched anywhere in the decoded generated text
+            tokenizer (optional): tokenizer to decode the generated tokens with. Required for stop_strings.
+        """
+        assert (
+            stop_strings is None or tokenizer is not None
+        ), "stop_strings require a tokenizer"
+        self.eos_token_id = eos_token_id
+        self.stop_token_sequences = [list(s) for s in stop_token_sequences or []]
+        self.stop_strings = list(stop_strings or [])
+        self.tokenizer = tokenizer
+        # the first call sees the prompt only, which is excluded from matching
+        self.prompt_length = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        generated = input_ids[:, self.prompt_length :]
+        if generated.shape[1] == 0:
+            return scores
+
+        stopped = torch.zeros(len(generated), dtype=torch.bool, device=scores.device)
+        for stop_tokens in self.stop_token_sequences:
+            if generated.shape[1] >= len(stop_tokens):
+                stopped |= (
+                    generated[:, -len(stop_tokens) :]
+                    == generated.new_tensor(stop_tokens)
+                ).all(dim=1)
+        if len(self.stop_strings) > 0:
+            texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            stopped |= torch.tensor(
+                [any(s in text for s in self.stop_strings) for text in texts],
+                device=scores.device,
+            )
+
+        # like ForcedEOSTokenLogitsProcessor, eos gets all the probability
+        scores[stopped] = -float("inf")
+        scores[stopped, self.eos_token_id] = 0
+        return scores
@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class VisionFeatureCache:
+    """
+    LRU cache of per-image vision features, keyed by image content or a caller-supplied image id.
+    Used by Flamingo._encode_vision_x to skip the vision encoder (and optionally the perceiver)
+    for images that were already encoded, e.g. in-context demonstrations reused across queries.
+    """
+
+    def __init__(self, max_bytes: int, cache_latents: bool = False):
+        """
+        Args:
+            max_bytes (int): memory budget for the cached features. Least recently used
+                features are evicted once the budget is exceeded.
+            cache_latents (bool, optional): if True, cache perceiver latents instead of vision encoder
+                patch tokens whenever the perceiver is frozen (or gradients are disabled).
+                Defaults to False.
+        """
+        self.max_bytes = max_bytes
+        self.cache_latents = cache_latents
+        self._features = OrderedDict()
+        # the cache may be shared by threads serving requests with the same model
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def hash_images(images: torch.Tensor):
+        """
+        Compute a content hash for each preprocessed image.
+        Args:
+            images (torch.Tensor): shape (N, ...)
+        Returns:
+            list of N hex digests
+        """
+        images = images.detach().cpu().contiguous()
+        return [
+            hashlib.sha1(
+                f"{image.dtype}{tuple(image.shape)}".encode()
+                + image.view(torch.uint8).numpy().tobytes()
+            ).hexdigest()
+            for image in images
+        ]
+
+    def get(self, key):
+        """Return the cached features for key, or None on a miss."""
+        with self._lock:
+            features = self._features.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self._features.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key, features: torch.Tensor):
+        """Cache features for key, evicting least recently used features to fit the budget."""
+        features = features.detach().clone()
+        size = features.numel() * features.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._features:
+                self.num_bytes -= self._size(self._features.pop(key))
+            while self.num_bytes + size > self.max_bytes:
+                _, evicted = self._features.popitem(last=False)
+                self.num_bytes -= self._size(evicted)
+                self.evictions += 1
+            self._features[key] = features
+            self.num_bytes += size
+
+    def clear(self):
+        """Drop all cached features, e.g. after the vision encoder or perceiver weights change."""
+        with self._lock:
+            self._features.clear()
+            self.num_bytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Return hit / miss / eviction counters and current usage."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "num_entries": len(self._features),
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    @staticmethod
+    def _size(features):
+        return features.numel() * features.element_size()
+
+    def __len__(self):
+        return len(self._features)
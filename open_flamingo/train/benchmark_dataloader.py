@@ -0,0 +1,78 @@
+"""
+Benchmark the training dataloader on raw shards and on the same shards written by pretokenize_shards.py.
+Reports samples/s in total and per dataloader worker, excluding the first batch (worker startup).
+
+Usage (from this directory):
+    python benchmark_dataloader.py --dataset_type mmc4 --shards "/path/to/mmc4/{00000..00099}.tar"
+        --pretokenized_shards "/path/to/mmc4_pretokenized/{00000..00099}.tar"
+        --tokenizer_path anas-awadalla/mpt-1b-redpajama-200b --mmc4_textsim_threshold 0.24 --workers 4
+"""
+import argparse
+import time
+
+from data import get_laion_dataset, get_mmc4_dataset
+from pretokenize_shards import get_tokenizer_and_image_processor
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset_type", choices=["laion", "mmc4"], required=True)
+parser.add_argument("--shards", type=str, required=True)
+parser.add_argument("--pretokenized_shards", type=str, required=True)
+parser.add_argument("--tokenizer_path", type=str, required=True)
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--num_batches", type=int, default=50)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--mmc4_textsim_threshold", default=30, type=float)
+parser.add_argument("--mmc4_min_num_images", default=1, type=int)
+parser.add_argument("--mmc4_max_num_images", default=6, type=int)
+parser.add_argument("--seed", type=int, default=42)
+
+
+def time_loader(args, tokenizer, image_processor, shards, pretokenized):
+    num_samples = (args.num_batches + 1) * args.batch_size
+    data_args = argparse.Namespace(
+        laion_shards=shards,
+        mmc4_shards=shards,
+        pretokenized=pretokenized,
+        dataset_resampled=True,
+        train_num_samples_laion=num_samples,
+        train_num_samples_mmc4=num_samples,
+        batch_size_laion=args.batch_size,
+        batch_size_mmc4=args.batch_size,
+        mmc4_textsim_threshold=args.mmc4_textsim_threshold,
+        mmc4_min_num_images=args.mmc4_min_num_images,
+        mmc4_max_num_images=args.mmc4_max_num_images,
+        workers=args.workers,
+        world_size=1,
+        seed=args.seed,
+    )
+    get_dataset = (
+        get_laion_dataset if args.dataset_type == "laion" else get_mmc4_dataset
+    )
+    dataloader = get_dataset(data_args, image_processor, tokenizer).dataloader
+
+    batches = iter(dataloader)
+    next(batches)  # wait for the workers to start
+    start = time.perf_counter()
+    for _ in range(args.num_batches):
+        next(batches)
+    return args.num_batches * args.batch_size / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    tokenizer, image_processor = get_tokenizer_and_image_processor(
+        args.tokenizer_path, args.vision_encoder_path, args.vision_encoder_pretrained
+    )
+    print("shards | samples/s | samples/s per worker")
+    for name, shards, pretokenized in [
+        ("raw", args.shards, False),
+        ("pretokenized", args.pretokenized_shards, True),
+    ]:
+        throughput = time_loader(args, tokenizer, image_processor, shards, pretokenized)
+        print(f"{name} | {throughput:.1f} | {throughput / args.workers:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,12 @@ import functools
 import io
 import json
 import math
+import os
+import queue
 import re
 import random
+import threading
+from dataclasses import dataclass
 import numpy as np
 import torch
 import torchvision
@@ -25,6 +29,7 @@ _SHARD_SHUFFLE_SIZE = 2000
 _SHARD_SHUFFLE_INITIAL = 500
 _SAMPLE_SHUFFLE_SIZE = 5000
 _SAMPLE_SHUFFLE_INITIAL = 1000
+PRETOKENIZED_INDEX = "index.json"
 
 try:
     import horovod.torch as hvd
@@ -44,6 +49,35 @@ def preprocess_image(sample, image_processor):
     return image
 
 
+def load_vision_features(npy_bytes, pca=None):
+    """
+    Load precomputed vision encoder patch tokens, as written by scripts/precompute_vision_features.py.
+    If the patch tokens were PCA-compressed, pca holds the "mean" (d,) and "components" (k, d)
+    used to project them back to the vision encoder width.
+    Returns a float16 tensor of shape (N, v, d).
+    """
+    features = np.load(io.BytesIO(npy_bytes))
+    if pca is not None:
+        features = features.astype(np.float32) @ pca["components"] + pca["mean"]
+    return torch.from_numpy(features.astype(np.float16))
+
+
+def preprocess_vision_features(sample, pca=None):
+    """
+    Stack the precomputed patch tokens of a batch of LAION samples.
+    No augmentations, the patch tokens were computed from unflipped images.
+    """
+    return torch.cat([load_vision_features(s, pca) for s in sample], dim=0)
+
+
+def load_vision_features_pca(path):
+    """Load the PCA written next to PCA-compressed vision feature shards, or None if path is None."""
+    if path is None:
+        return None
+    pca = np.load(path)
+    return {"mean": pca["mean"], "components": pca["components"]}
+
+
 def filter_no_caption_or_no_image(sample):
     """
     Filter out LAION samples with no caption or no image.
@@ -53,15 +87,27 @@ def filter_no_caption_or_no_image(sample):
     )
 
 
+def filter_no_caption_or_no_vision_features(sample):
+    """
+    Filter out LAION samples with no caption or no precomputed vision features.
+    """
+    return ("txt" in sample) and ("npy" in sample)
+
+
+def laion_text(caption, tokenizer):
+    """
+    Text of a LAION sample: an image followed by its caption.
+    """
+    return f"<image>{caption.strip()}<|endofchunk|>{tokenizer.eos_token}"
+
+
 def preprocess_laion_text(sample, tokenizer, max_tokens=32):
     """
     Preprocess text for LAION.
     Captions are truncated to 32 tokens by default.
     """
     tokenizer.padding_side = "right"
-    sample = [
-        (f"<image>{s.strip()}<|endofchunk|>{tokenizer.eos_token}") for s in sample
-    ]
+    sample = [laion_text(s, tokenizer) for s in sample]
     text = tokenizer(
         sample,
         max_length=max_tokens,
@@ -72,33 +118,92 @@ def preprocess_laion_text(sample, tokenizer, max_tokens=32):
     return text["input_ids"], text["attention_mask"]
 
 
-def preprocess_gpt_interleaved(
-    info, tokenizer, clip_processor, min_num_images, max_num_images, max_tokens=256
+def get_media_token_id(tokenizer):
+    return tokenizer.additional_special_tokens_ids[
+        tokenizer.additional_special_tokens.index("<image>")
+    ]
+
+
+def get_endofchunk_token_id(tokenizer):
+    return tokenizer.additional_special_tokens_ids[
+        tokenizer.additional_special_tokens.index("<|endofchunk|>")
+    ]
+
+
+def get_interleaved_labels(
+    input_ids, media_token_id, endofchunk_token_id, pad_token_id
 ):
     """
-    Preprocess a ChatGPT-generated image-text sequence.
+    Labels of a batch of interleaved sequences; language model is expected to handle shifting.
+    The loss is only computed on text that belongs to an image: tokens before the first <image> and
+    between an <|endofchunk|> and the next <image> are masked with -100, as are <image> and padding tokens.
+    """
+    is_media = input_ids == media_token_id
+    is_endofchunk = input_ids == endofchunk_token_id
+    positions = torch.arange(input_ids.shape[1]).expand_as(input_ids)
+    # position of the last <image> or <|endofchunk|> strictly before each token, -1 if there is none
+    last_chunk_token = torch.where(is_media | is_endofchunk, positions, -1)
+    last_chunk_token = last_chunk_token.cummax(dim=1).values
+    last_chunk_token = torch.cat(
+        [last_chunk_token.new_full((len(input_ids), 1), -1), last_chunk_token[:, :-1]],
+        dim=1,
+    )
+    after_endofchunk = (last_chunk_token >= 0) & is_endofchunk.gather(
+        1, last_chunk_token.clamp(min=0)
+    )
+    before_first_media = is_media.cumsum(dim=1) == 0
+
+    labels = input_ids.clone()
+    labels[
+        before_first_media | after_endofchunk | is_media | (input_ids == pad_token_id)
+    ] = -100
+    return labels
+
+
+def preprocess_interleaved_batch(batch, tokenizer):
+    """
+    Stack the text of a batch of interleaved sequences and build its labels, so that labels are built
+    in the dataloader workers rather than in the training loop.
+    Returns (images, (input_ids, attention_mask, labels)).
+    """
+    images, text = batch
+    input_ids = torch.cat([x[0] for x in text])
+    attention_mask = torch.cat([x[1] for x in text])
+    labels = get_interleaved_labels(
+        input_ids,
+        get_media_token_id(tokenizer),
+        get_endofchunk_token_id(tokenizer),
+        tokenizer.pad_token_id,
+    )
+    return images, (input_ids, attention_mask, labels)
+
+
+def interleave_gpt(info, tokenizer, max_num_images, vision_features=None):
+    """
+    Build the text of a ChatGPT-generated image-text sequence and load its images.
+    If vision_features (the sample's precomputed patch tokens) is given, it replaces the images.
+    Returns:
+        images: PIL images, or a tensor of patch tokens, truncated to max_num_images
+        text: the sequence with <image> and <|endofchunk|> tokens
     """
     text = info["example"]
     text = re.sub(r"_!_IMAGE\d+_!_", "<|endofchunk|><image>", text)
 
-    # convert images from base64 to PIL
-    images = []
-    for image_key in range(1, len(info["image_map"]) + 1):
-        image_base64 = info["image_map"][f"_!_IMAGE{image_key}_!_"]["base64_image"]
-        rawbytes = base64.b64decode(image_base64)
-        images.append(Image.open(io.BytesIO(rawbytes)).convert("RGB"))
-
-    # preprocess and pad images
-    images_tensors = preprocess_image(images, clip_processor)
-    keep_ixs = range(min(len(images_tensors), max_num_images))
-    images_tensors = images_tensors[keep_ixs]
-    if len(images_tensors) < max_num_images:
-        zero_padding = torch.zeros(
-            (max_num_images - len(images_tensors), 3, 224, 224), dtype=torch.float
-        )
-        images_tensors = torch.cat((images_tensors, zero_padding), dim=0)
+    if vision_features is not None:
+        feature_ixs = [
+            info["image_map"][f"_!_IMAGE{image_key}_!_"]["feature_index"]
+            for image_key in range(1, len(info["image_map"]) + 1)
+        ]
+        images = vision_features[feature_ixs]
+    else:
+        # convert images from base64 to PIL
+        images = []
+        for image_key in range(1, len(info["image_map"]) + 1):
+            image_base64 = info["image_map"][f"_!_IMAGE{image_key}_!_"]["base64_image"]
+            rawbytes = base64.b64decode(image_base64)
+            images.append(Image.open(io.BytesIO(rawbytes)).convert("RGB"))
+    images = images[:max_num_images]
 
-    # preprocess and tokenize text
     text = text.replace("<|endofchunk|>", "", 1)  # but remove first eoc
     # whitespace cleanup
     text = (
@@ -113,57 +218,46 @@ def preprocess_gpt_interleaved(
         text = text[:start_index]
 
     text = f"{text}<|endofchunk|>{tokenizer.eos_token}"
-    tokenizer.padding_side = "right"
-    text_tensor = tokenizer(
-        text,
-        max_length=max_tokens,
-        truncation=True,
-        padding="max_length",
-        return_tensors="pt",
-    )
+    return images, text
 
-    # reject sequences with too few images after truncation
-    num_images = torch.count_nonzero(
-        text_tensor["input_ids"]
-        == tokenizer.additional_special_tokens_ids[
-            tokenizer.additional_special_tokens.index("<image>")
-        ]
-    )
-    if num_images < min_num_images:
-        raise ValueError(f"Fewer than {min_num_images} images in sample")
 
-    return (images_tensors, (text_tensor["input_ids"], text_tensor["attention_mask"]))
-
-
-def preprocess_interleaved(
-    sample,
+def interleave_mmc4(
+    info,
     tokenizer,
-    clip_processor,
     sim_threshold,
-    min_num_images,
     max_num_images,
-    max_tokens=256,
+    vision_features=None,
+    image_members=None,
 ):
     """
-    Preprocess an interleaved image-text sequence, either by calling preprocess_gpt_interleaved (if the sequence
-    is ChatGPT-generated) or by preprocessing in this function (if the sequences is from MMC4).
+    Assign the images of an MMC4 sequence to sentences, then build its text and load its images.
+    Images are either base64-encoded in the json, or tar members of the sample (see
+    scripts/convert_mmc4_to_wds.py) whose bytes are given by image_members, a dict of member name -> bytes.
+    If vision_features (the sample's precomputed patch tokens) is given, it replaces the images.
+    Returns:
+        images: PIL images, or a tensor of patch tokens, truncated to max_num_images
+        text: the sequence with <image> and <|endofchunk|> tokens
     """
-    info = json.loads(sample[0])
-    if "is_gpt" in info:
-        return preprocess_gpt_interleaved(
-            info, tokenizer, clip_processor, min_num_images, max_num_images, max_tokens
-        )
-
     sentences = info["text_list"]
     sim_matrix = info["similarity_matrix"]
 
     # load images first to find which ones are valid
     valid_images, valid_image_indices = [], []
     for i, sample_image in enumerate(info["image_info"]):
-        if "image_base64" not in sample_image:
+        if vision_features is not None:
+            # images were filtered when the features were computed
+            if "feature_index" in sample_image:
+                valid_images.append(vision_features[sample_image["feature_index"]])
+                valid_image_indices.append(i)
+            continue
+        if "image_member" in sample_image:
+            rawbytes = (image_members or {}).get(sample_image["image_member"])
+            if rawbytes is None:
+                continue
+        elif "image_base64" in sample_image:
+            rawbytes = base64.b64decode(sample_image["image_base64"])
+        else:
             continue
-        image_base64 = sample_image["image_base64"]
-        rawbytes = base64.b64decode(image_base64)
 
         # filter to images >= 10KB
         if len(rawbytes) // 1000 <= MIN_KB:
@@ -197,24 +291,11 @@ def preprocess_interleaved(
     if len(images) == 0:
         raise ValueError("No images in sample")
 
-    # preprocess and pad images
-    images_tensors = preprocess_image(images, clip_processor)
-    keep_ixs = range(min(len(images_tensors), max_num_images))
-    images_tensors = images_tensors[keep_ixs]
-    sentence_ixs = [sentence_ixs[ix] for ix in keep_ixs]
-    if len(images_tensors) < max_num_images:
-        zero_padding = torch.zeros(
-            (
-                max_num_images - len(images_tensors),
-                N_CHANNELS,
-                images_tensors[0].shape[1],
-                images_tensors[0].shape[2],
-            ),
-            dtype=torch.float,
-        )
-        images_tensors = torch.cat((images_tensors, zero_padding), dim=0)
+    images = images[:max_num_images]
+    sentence_ixs = sentence_ixs[:max_num_images]
+    if vision_features is not None:
+        images = torch.stack(images)
 
-    # preprocess and tokenize text
     # add in <image> and <eoc> tokens
     for ix in sentence_ixs:
         sentences[ix] = f"<|endofchunk|><image>{sentences[ix]}"
@@ -227,8 +308,27 @@ def preprocess_interleaved(
         .replace(" <image>", "<image>")
     )
     text = f"{text}<|endofchunk|>{tokenizer.eos_token}"
+    return images, text
+
+
+def split_interleaved_sample(sample):
+    """
+    Split a raw MMC4 / ChatGPT sample into (json, image members), where image members maps the names of the
+    image tar members written by scripts/convert_mmc4_to_wds.py to their bytes. Shards with base64-encoded
+    images in the json have no image members.
+    """
+    if "json" not in sample:
+        raise ValueError(f"No json in sample {sample.get('__key__')}")
+    image_members = {k: v for k, v in sample.items() if k.startswith("image")}
+    return sample["json"], image_members
+
+
+def tokenize_interleaved(text, tokenizer, max_tokens=256):
+    """
+    Tokenize an interleaved sequence, truncating and right-padding it to max_tokens.
+    """
     tokenizer.padding_side = "right"
-    text_tensor = tokenizer(
+    return tokenizer(
         text,
         max_length=max_tokens,
         truncation=True,
@@ -236,45 +336,228 @@ def preprocess_interleaved(
         return_tensors="pt",
     )
 
-    # reject sequences with too few images (after truncation)
-    num_images = torch.count_nonzero(
-        text_tensor["input_ids"]
-        == tokenizer.additional_special_tokens_ids[
-            tokenizer.additional_special_tokens.index("<image>")
-        ]
-    )
+
+def filter_interleaved_num_images(
+    input_ids,
+    media_token_id,
+    min_num_images,
+    drop_single_image=True,
+    reject_image_at_end=True,
+):
+    """
+    Reject interleaved sequences (by raising ValueError) with too few images after truncation.
+    If drop_single_image, single image sequences are kept with 50% chance.
+    If reject_image_at_end, reject single image sequences whose image is the last token.
+    """
+    num_images = torch.count_nonzero(input_ids == media_token_id)
     if num_images < min_num_images:
         raise ValueError(f"Fewer than {min_num_images} images in sample")
     elif (
-        num_images == 1 and random.random() <= 0.5
+        drop_single_image and num_images == 1 and random.random() <= 0.5
     ):  # 50% chance of keeping single image samples
         raise ValueError("Only one image in sample")
 
     # avoid the situation where there's one <image> token and it's at the end
-    if (
-        num_images == 1
-        and text_tensor["input_ids"][:, -1]
-        == tokenizer.additional_special_tokens_ids[
-            tokenizer.additional_special_tokens.index("<image>")
-        ]
-    ):
+    if reject_image_at_end and num_images == 1 and input_ids[:, -1] == media_token_id:
         raise ValueError(
             "Only one image at the end of sample, so labels will all be -100"
         )
 
+
+def pad_images(images_tensors, max_num_images):
+    """
+    Pad a tensor of at most max_num_images images (or patch tokens) to max_num_images with zeros.
+    """
+    if len(images_tensors) < max_num_images:
+        zero_padding = images_tensors.new_zeros(
+            (max_num_images - len(images_tensors),) + images_tensors.shape[1:]
+        )
+        images_tensors = torch.cat((images_tensors, zero_padding), dim=0)
+    return images_tensors
+
+
+def preprocess_interleaved(
+    sample,
+    tokenizer,
+    clip_processor,
+    sim_threshold,
+    min_num_images,
+    max_num_images,
+    max_tokens=256,
+    use_vision_features=False,
+    vision_features_pca=None,
+):
+    """
+    Preprocess an interleaved image-text sequence, which is either ChatGPT-generated (see interleave_gpt)
+    or from MMC4 (see interleave_mmc4).
+    The sample is a (json, image members) pair, see split_interleaved_sample.
+    If use_vision_features, the sample is a (json, npy) pair of a shard written by
+    scripts/precompute_vision_features.py, and the images are replaced by their precomputed patch tokens.
+    """
+    info = json.loads(sample[0])
+    vision_features, image_members = None, None
+    if use_vision_features:
+        vision_features = load_vision_features(sample[1], vision_features_pca)
+    else:
+        image_members = sample[1]
+    is_gpt = "is_gpt" in info
+    if is_gpt:
+        images, text = interleave_gpt(
+            info, tokenizer, max_num_images, vision_features=vision_features
+        )
+    else:
+        images, text = interleave_mmc4(
+            info,
+            tokenizer,
+            sim_threshold,
+            max_num_images,
+            vision_features=vision_features,
+            image_members=image_members,
+        )
+
+    # preprocess and pad images
+    if vision_features is None:
+        images = preprocess_image(images, clip_processor)
+    images_tensors = pad_images(images, max_num_images)
+
+    # tokenize text, then reject sequences with too few images (after truncation)
+    text_tensor = tokenize_interleaved(text, tokenizer, max_tokens)
+    filter_interleaved_num_images(
+        text_tensor["input_ids"],
+        get_media_token_id(tokenizer),
+        min_num_images,
+        drop_single_image=not is_gpt,
+        reject_image_at_end=not is_gpt,
+    )
+
     return (
         images_tensors,
         (text_tensor["input_ids"], text_tensor["attention_mask"]),
     )
 
 
+def get_resize_transform(image_processor):
+    """
+    The transforms of image_processor that come before ToTensor, i.e. resizing and cropping a PIL image
+    to the vision encoder input size. Pretokenized shards hold images after these transforms.
+    """
+    transforms = image_processor.transforms
+    to_tensor_ix = next(
+        i
+        for i, t in enumerate(transforms)
+        if isinstance(t, torchvision.transforms.ToTensor)
+    )
+    return torchvision.transforms.Compose(transforms[:to_tensor_ix])
+
+
+def preprocess_resized_images(images, image_processor):
+    """
+    Like preprocess_image, for uint8 images of shape (N, H, W, C) already resized by get_resize_transform.
+    Augmentations: random horizontal flip.
+    """
+    normalize = next(
+        t
+        for t in image_processor.transforms
+        if isinstance(t, torchvision.transforms.Normalize)
+    )
+    image = torch.from_numpy(images).permute(0, 3, 1, 2).float().div(255)
+    image = normalize(image)
+    image = torchvision.transforms.RandomHorizontalFlip(p=0.5)(image)
+    return image
+
+
+def pad_token_ids(input_ids, pad_token_id, length=None):
+    """
+    Right-pad 1D arrays of token ids to length (by default the longest).
+    Returns (input_ids, attention_mask), like the tokenizer.
+    """
+    length = length if length is not None else max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), length), dtype=torch.long)
+    for i, ids in enumerate(input_ids):
+        padded[i, : len(ids)] = torch.from_numpy(ids.astype(np.int64))
+        attention_mask[i, : len(ids)] = 1
+    return padded, attention_mask
+
+
+def load_npy(npy_bytes):
+    return np.load(io.BytesIO(npy_bytes))
+
+
+def preprocess_pretokenized_laion_images(sample, image_processor):
+    """
+    Preprocess the resized images of a batch of pretokenized LAION samples.
+    """
+    images = np.concatenate([load_npy(s) for s in sample])
+    return preprocess_resized_images(images, image_processor)
+
+
+def preprocess_pretokenized_laion_text(sample, tokenizer):
+    """
+    Pad the token ids of a batch of pretokenized LAION samples to the longest, like preprocess_laion_text.
+    """
+    return pad_token_ids([load_npy(s) for s in sample], tokenizer.pad_token_id)
+
+
+def preprocess_pretokenized_interleaved(
+    sample,
+    tokenizer,
+    clip_processor,
+    min_num_images,
+    max_num_images,
+    max_tokens=256,
+):
+    """
+    Preprocess a pretokenized interleaved image-text sequence, a (input_ids.npy, images.npy, json) tuple
+    of a shard written by pretokenize_shards.py. Only the random parts of preprocess_interleaved are left:
+    random horizontal flips and dropping single image sequences.
+    """
+    input_ids, attention_mask = pad_token_ids(
+        [load_npy(sample[0])], tokenizer.pad_token_id, max_tokens
+    )
+    is_gpt = json.loads(sample[2])["is_gpt"]
+    filter_interleaved_num_images(
+        input_ids,
+        get_media_token_id(tokenizer),
+        min_num_images,
+        drop_single_image=not is_gpt,
+        reject_image_at_end=not is_gpt,
+    )
+    images_tensors = preprocess_resized_images(load_npy(sample[1]), clip_processor)
+    images_tensors = pad_images(images_tensors, max_num_images)
+    return images_tensors, (input_ids, attention_mask)
+
+
+def check_pretokenized_index(input_shards, **expected):
+    """
+    Check that pretokenized shards were written with the expected preprocessing arguments.
+    Skipped if the index written by pretokenize_shards.py is not found next to the shards (e.g. on s3).
+    """
+    index_path = os.path.join(os.path.dirname(input_shards), PRETOKENIZED_INDEX)
+    if not os.path.exists(index_path):
+        logging.warning(f"No {index_path}, cannot check the pretokenized shards")
+        return
+    with open(index_path, "r") as f:
+        index_args = json.load(f)["args"]
+    for key, value in expected.items():
+        if index_args.get(key) != value:
+            raise ValueError(
+                f"Pretokenized shards were written with {key}={index_args.get(key)}, expected {value}"
+            )
+
+
 def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     """
     Initialize webdataset for MMC4 / ChatGPT sequences
+    With args.vision_features, the shards hold precomputed vision encoder patch tokens instead of images
+    and the dataset yields those in place of the image tensors.
+    With args.pretokenized, the shards were written by pretokenize_shards.py.
     """
     input_shards = args.mmc4_shards
     assert input_shards is not None
     resampled = getattr(args, "dataset_resampled", False)
+    use_vision_features = getattr(args, "vision_features", False)
+    use_pretokenized = getattr(args, "pretokenized", False)
 
     num_samples, num_shards = get_dataset_size(input_shards)
     num_samples = None
@@ -295,14 +578,42 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     else:
         pipeline = [wds.SimpleShardList(input_shards)]
 
-    preprocess_fn = functools.partial(
-        preprocess_interleaved,
-        clip_processor=image_processor,
-        tokenizer=tokenizer,
-        sim_threshold=args.mmc4_textsim_threshold,
-        min_num_images=args.mmc4_min_num_images,
-        max_num_images=args.mmc4_max_num_images,
-    )
+    if use_pretokenized:
+        check_pretokenized_index(
+            input_shards,
+            dataset_type="mmc4",
+            vocab_size=len(tokenizer),
+            sim_threshold=args.mmc4_textsim_threshold,
+            max_num_images=args.mmc4_max_num_images,
+            max_tokens=256,
+        )
+        split_sample = wds.to_tuple(
+            "input_ids.npy", "images.npy", "json", handler=log_and_continue
+        )
+        preprocess_fn = functools.partial(
+            preprocess_pretokenized_interleaved,
+            clip_processor=image_processor,
+            tokenizer=tokenizer,
+            min_num_images=args.mmc4_min_num_images,
+            max_num_images=args.mmc4_max_num_images,
+        )
+    else:
+        if use_vision_features:
+            split_sample = wds.to_tuple("json", "npy", handler=log_and_continue)
+        else:
+            split_sample = wds.map(split_interleaved_sample, handler=log_and_continue)
+        preprocess_fn = functools.partial(
+            preprocess_interleaved,
+            clip_processor=image_processor,
+            tokenizer=tokenizer,
+            sim_threshold=args.mmc4_textsim_threshold,
+            min_num_images=args.mmc4_min_num_images,
+            max_num_images=args.mmc4_max_num_images,
+            use_vision_features=use_vision_features,
+            vision_features_pca=load_vision_features_pca(
+                getattr(args, "vision_features_pca", None)
+            ),
+        )
 
     # at this point we have an iterator over all the shards
     if not resampled:
@@ -332,9 +643,12 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
 
     pipeline.extend(
         [
-            wds.to_tuple("json", handler=log_and_continue),
+            split_sample,
             wds.map(preprocess_fn, handler=log_and_continue),
             wds.batched(args.batch_size_mmc4, partial=False),
+            wds.map(
+                functools.partial(preprocess_interleaved_batch, tokenizer=tokenizer)
+            ),
         ]
     )
 
@@ -372,10 +686,15 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
 def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     """
     Initialize webdataset for LAION data
+    With args.vision_features, the shards hold precomputed vision encoder patch tokens instead of images
+    and the dataset yields those in place of the image tensors.
+    With args.pretokenized, the shards were written by pretokenize_shards.py.
     """
     input_shards = args.laion_shards
     assert input_shards is not None
     resampled = getattr(args, "dataset_resampled", False)
+    use_vision_features = getattr(args, "vision_features", False)
+    use_pretokenized = getattr(args, "pretokenized", False)
 
     num_samples, num_shards = get_dataset_size(input_shards)
     num_samples = None
@@ -397,10 +716,31 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         pipeline = [wds.SimpleShardList(input_shards)]
 
     # create two preprocess functions that take in the passed in image_processor and tokenizer
-    preprocess_image_fn = functools.partial(
-        preprocess_image, image_processor=image_processor
-    )
-    preprocess_text_fn = functools.partial(preprocess_laion_text, tokenizer=tokenizer)
+    if use_pretokenized:
+        check_pretokenized_index(
+            input_shards, dataset_type="laion", vocab_size=len(tokenizer), max_tokens=32
+        )
+        preprocess_image_fn = functools.partial(
+            preprocess_pretokenized_laion_images, image_processor=image_processor
+        )
+        preprocess_text_fn = functools.partial(
+            preprocess_pretokenized_laion_text, tokenizer=tokenizer
+        )
+    else:
+        if use_vision_features:
+            preprocess_image_fn = functools.partial(
+                preprocess_vision_features,
+                pca=load_vision_features_pca(
+                    getattr(args, "vision_features_pca", None)
+                ),
+            )
+        else:
+            preprocess_image_fn = functools.partial(
+                preprocess_image, image_processor=image_processor
+            )
+        preprocess_text_fn = functools.partial(
+            preprocess_laion_text, tokenizer=tokenizer
+        )
 
     # at this point we have an iterator over all the shards
     if not resampled:
@@ -428,11 +768,28 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         ]
     )
 
+    if use_pretokenized:
+        pipeline.append(
+            wds.to_tuple("images.npy", "input_ids.npy", handler=log_and_continue)
+        )
+    elif use_vision_features:
+        pipeline.extend(
+            [
+                wds.select(filter_no_caption_or_no_vision_features),
+                wds.decode(only="txt", handler=log_and_continue),
+                wds.to_tuple("npy", "txt", handler=log_and_continue),
+            ]
+        )
+    else:
+        pipeline.extend(
+            [
+                wds.select(filter_no_caption_or_no_image),
+                wds.decode("pilrgb", handler=log_and_continue),
+                wds.to_tuple("jpg;png;jpeg", "txt", handler=log_and_continue),
+            ]
+        )
     pipeline.extend(
         [
-            wds.select(filter_no_caption_or_no_image),
-            wds.decode("pilrgb", handler=log_and_continue),
-            wds.to_tuple("jpg;png;jpeg", "txt", handler=log_and_continue),
             wds.batched(args.batch_size_laion, partial=False),
             wds.map_tuple(
                 preprocess_image_fn, preprocess_text_fn, handler=log_and_continue
@@ -490,3 +847,174 @@ def get_data(args, image_processor, tokenizer, dataset_type, epoch=0):
     return get_dataset_fn(dataset_type)(
         args, image_processor=image_processor, epoch=epoch, tokenizer=tokenizer
     )
+
+
+@dataclass
+class MixtureSource:
+    """A dataset of a MixtureLoader; dataset_type is as in get_data."""
+
+    name: str
+    dataset_type: str
+    data: DataInfo
+    weight: float = 1.0
+
+
+class MixtureLoader:
+    """
+    Iterates over the batches of several datasets, yielding (source, batch) pairs tagged with their MixtureSource.
+    The sources of the batches follow a weighted random schedule: the i-th scheduled source is drawn with
+    probabilities weight / sum(weights) by a generator seeded with (seed, i), so every rank given the same seed
+    follows the same schedule, and a resumed run continues it.
+    Each source is read by a background thread into a queue of up to prefetch batches, so that a slow source only
+    stalls its own stream: if the scheduled source has no batch ready within fallback_timeout seconds, the batch is
+    taken from the next scheduled source that is ready (drawing further ahead in the schedule if needed), and the
+    blocked source keeps its place in the schedule, to be served as soon as it is ready, without being waited for
+    again in the meantime. Only these fallbacks make
+    the order of the sources depend on the speed of the dataloaders, and so differ between ranks and runs; each
+    source still gets its scheduled batches, only later. The order of the batches within a source is that of
+    its dataloader.
+    Sources have independent epochs: a source that runs out of batches moves on to its next epoch.
+    An epoch of the mixture is num_batches batches, the sum of the batches per epoch of its sources.
+    Prefetch threads run ahead of the training loop, so batches are queued with their epoch, and source_epochs
+    holds the epoch of the last batch yielded from each source rather than the epoch being read.
+    """
+
+    def __init__(self, sources, epoch=0, prefetch=2, seed=0, fallback_timeout=1.0):
+        assert all(source.weight >= 0 for source in sources), "weights must be >= 0"
+        self.sources = [source for source in sources if source.weight > 0]
+        assert len(self.sources) > 0, "at least one source needs a positive weight"
+        self.num_batches = sum(s.data.dataloader.num_batches for s in self.sources)
+        self.seed = seed
+        self.fallback_timeout = fallback_timeout
+        # epoch of the last batch yielded from each source
+        self.source_epochs = {source.name: epoch for source in self.sources}
+        # epoch each source starts with when resuming: the one after its last yielded batch, if any
+        self._resume_epochs = dict(self.source_epochs)
+        # number of sources drawn from the schedule, and the names of those drawn but not yielded yet, in order
+        self._num_scheduled = 0
+        self._pending = []
+        # sources found blocked, which are not waited for again until they have been ready
+        self._blocked = set()
+        self._queues = {
+            source.name: queue.Queue(maxsize=prefetch) for source in self.sources
+        }
+        # notified whenever a batch is queued
+        self._ready = threading.Condition()
+        self._threads = None
+
+    def _prefetch(self, source):
+        batches = self._queues[source.name]
+        epoch = self.source_epochs[source.name]
+        try:
+            while True:
+                source.data.set_epoch(epoch)
+                for batch in source.data.dataloader:
+                    batches.put((epoch, batch))
+                    with self._ready:
+                        self._ready.notify()
+                epoch += 1
+        except Exception as e:
+            # re-raised by __iter__
+            batches.put(e)
+            with self._ready:
+                self._ready.notify()
+
+    def _schedule(self):
+        """Draw the next source of the schedule, appending it to the pending sources."""
+        weights = np.array([source.weight for source in self.sources])
+        rng = np.random.default_rng((self.seed, self._num_scheduled))
+        source = self.sources[rng.choice(len(self.sources), p=weights / weights.sum())]
+        self._pending.append(source.name)
+        self._num_scheduled += 1
+
+    def _is_ready(self, name):
+        # only __iter__ takes batches from the queues, so a ready source stays ready
+        return not self._queues[name].empty()
+
+    def _next_source(self):
+        """The name of the source to take the next batch from, see the class docstring."""
+        if len(self._pending) == 0:
+            self._schedule()
+        scheduled = self._pending[0]
+        timeout = 0 if scheduled in self._blocked else self.fallback_timeout
+        with self._ready:
+            if self._ready.wait_for(lambda: self._is_ready(scheduled), timeout=timeout):
+                return scheduled
+            self._blocked.add(scheduled)
+            self._ready.wait_for(lambda: any(map(self._is_ready, self._queues)))
+        i = 1
+        while True:
+            if i == len(self._pending):
+                self._schedule()
+            if self._is_ready(self._pending[i]):
+                return self._pending[i]
+            i += 1
+
+    def __iter__(self):
+        if self._threads is None:
+            self._threads = [
+                threading.Thread(target=self._prefetch, args=(source,), daemon=True)
+                for source in self.sources
+            ]
+            for thread in self._threads:
+                thread.start()
+
+        sources = {source.name: source for source in self.sources}
+        for _ in range(self.num_batches):
+            name = self._next_source()
+            self._pending.remove(name)
+            self._blocked.discard(name)
+            item = self._queues[name].get_nowait()
+            if isinstance(item, Exception):
+                raise item
+            self.source_epochs[name], batch = item
+            self._resume_epochs[name] = self.source_epochs[name] + 1
+            yield sources[name], batch
+
+    def __len__(self):
+        return self.num_batches
+
+    def state_dict(self):
+        """The epochs to resume the sources at and the position in the schedule, for load_state_dict()."""
+        return {
+            "resume_epochs": dict(self._resume_epochs),
+            "num_scheduled": self._num_scheduled,
+            "pending": list(self._pending),
+        }
+
+    def load_state_dict(self, state_dict):
+        """
+        Resume from a state_dict(), before iterating. Each source starts with the epoch after that of its last
+        batch yielded before the state_dict() call: the batches left in that epoch are skipped rather than replayed.
+        A source that had not yielded any batch starts with the epoch it was going to start with.
+        The schedule continues where it was, starting with the sources scheduled but not yielded yet.
+        """
+        assert (
+            self._threads is None
+        ), "load_state_dict() must be called before iterating"
+        for name in self.source_epochs:
+            if name in state_dict["resume_epochs"]:
+                self.source_epochs[name] = state_dict["resume_epochs"][name]
+                self._resume_epochs[name] = state_dict["resume_epochs"][name]
+        self._num_scheduled = state_dict["num_scheduled"]
+        self._pending = [
+            name for name in state_dict["pending"] if name in self.source_epochs
+        ]
+
+
+def get_mixture(args, image_processor, tokenizer, epoch=0):
+    """
+    The LAION and MMC4 / ChatGPT datasets as a MixtureLoader, sampled with weights
+    args.sampling_weight_laion and args.sampling_weight_mmc4.
+    """
+    sources = [
+        MixtureSource(
+            name,
+            dataset_type,
+            get_data(args, image_processor, tokenizer, dataset_type, epoch=epoch),
+            weight=getattr(args, f"sampling_weight_{name}", 1.0),
+        )
+        for name, dataset_type in [("laion", "image_text"), ("mmc4", "mmc4")]
+    ]
+    # the same seed on every rank, so that the ranks follow the same schedule
+    return MixtureLoader(sources, epoch=epoch, seed=args.seed)
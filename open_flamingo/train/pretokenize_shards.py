@@ -0,0 +1,233 @@
+"""
+Write pretokenized shards for training with --pretokenized.
+
+Everything preprocess_interleaved and the LAION pipeline do to a sample before the random augmentations is done
+once here, instead of every epoch: decoding the json and the images, assigning MMC4 images to sentences,
+inserting the <image> and <|endofchunk|> tokens, tokenizing, and resizing the images to the vision encoder
+input size. Each sample of the output shards holds
+    - input_ids.npy: int32 token ids, truncated to max_tokens and not padded
+    - images.npy: uint8 images of shape (num_images, H, W, 3), resized and cropped by the image processor
+    - json (MMC4 only): {"is_gpt": whether the sequence is ChatGPT-generated}
+Each input shard is written to a shard of the same name in --output_dir. The preprocessing arguments and the
+number of samples per shard are recorded in <output_dir>/index.json, which train.py checks, and in sizes.json.
+Shards already in the index are skipped, so an interrupted run can be restarted with the same arguments.
+
+Usage (from this directory):
+    python pretokenize_shards.py --dataset_type mmc4 --input_shards "/path/to/mmc4/{00000..09999}.tar"
+        --output_dir /path/to/mmc4_pretokenized --tokenizer_path anas-awadalla/mpt-1b-redpajama-200b
+        --mmc4_textsim_threshold 0.24 --num_workers 32
+"""
+import argparse
+import functools
+import io
+import json
+import os
+from multiprocessing import Pool
+
+import braceexpand
+import numpy as np
+import open_clip
+import webdataset as wds
+from PIL import Image
+from transformers import AutoTokenizer
+
+from data import (
+    PRETOKENIZED_INDEX,
+    filter_interleaved_num_images,
+    get_media_token_id,
+    get_resize_transform,
+    interleave_gpt,
+    interleave_mmc4,
+    laion_text,
+    split_interleaved_sample,
+    tokenize_interleaved,
+)
+
+
+def get_tokenizer_and_image_processor(
+    tokenizer_path, vision_encoder_path, vision_encoder_pretrained
+):
+    """The tokenizer and image processor of create_model_and_transforms, without the models."""
+    _, _, image_processor = open_clip.create_model_and_transforms(
+        vision_encoder_path, pretrained=vision_encoder_pretrained
+    )
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+    tokenizer.add_special_tokens(
+        {"additional_special_tokens": ["<|endofchunk|>", "<image>"]}
+    )
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({"pad_token": "<PAD>"})
+    return tokenizer, image_processor
+
+
+def pretokenize_laion(sample, tokenizer, resize, max_tokens=32):
+    image_key = next((k for k in ("jpg", "png", "jpeg") if k in sample), None)
+    if "txt" not in sample or image_key is None:
+        raise ValueError("No caption or no image in sample")
+    image = Image.open(io.BytesIO(sample[image_key])).convert("RGB")
+    input_ids = tokenizer(
+        laion_text(sample["txt"].decode("utf-8"), tokenizer),
+        max_length=max_tokens,
+        truncation="only_first",
+    )["input_ids"]
+    return {
+        "input_ids.npy": np.array(input_ids, dtype=np.int32),
+        "images.npy": np.asarray(resize(image))[None],
+    }
+
+
+def pretokenize_interleaved(
+    sample,
+    tokenizer,
+    resize,
+    sim_threshold,
+    min_num_images,
+    max_num_images,
+    max_tokens=256,
+):
+    info, image_members = split_interleaved_sample(sample)
+    info = json.loads(info)
+    is_gpt = "is_gpt" in info
+    if is_gpt:
+        images, text = interleave_gpt(info, tokenizer, max_num_images)
+    else:
+        images, text = interleave_mmc4(
+            info,
+            tokenizer,
+            sim_threshold,
+            max_num_images,
+            image_members=image_members,
+        )
+
+    text_tensor = tokenize_interleaved(text, tokenizer, max_tokens)
+    # single image sequences are randomly dropped at train time
+    filter_interleaved_num_images(
+        text_tensor["input_ids"],
+        get_media_token_id(tokenizer),
+        min_num_images,
+        drop_single_image=False,
+        reject_image_at_end=not is_gpt,
+    )
+    num_tokens = int(text_tensor["attention_mask"].sum())
+    input_ids = text_tensor["input_ids"][0, :num_tokens]
+    return {
+        "input_ids.npy": input_ids.numpy().astype(np.int32),
+        "images.npy": np.stack([np.asarray(resize(image)) for image in images]),
+        "json": {"is_gpt": is_gpt},
+    }
+
+
+# set in each worker process by init_worker
+_pretokenize_fn = None
+
+
+def init_worker(args):
+    global _pretokenize_fn
+    tokenizer, image_processor = get_tokenizer_and_image_processor(
+        args.tokenizer_path, args.vision_encoder_path, args.vision_encoder_pretrained
+    )
+    resize = get_resize_transform(image_processor)
+    if args.dataset_type == "laion":
+        _pretokenize_fn = functools.partial(
+            pretokenize_laion, tokenizer=tokenizer, resize=resize
+        )
+    else:
+        _pretokenize_fn = functools.partial(
+            pretokenize_interleaved,
+            tokenizer=tokenizer,
+            resize=resize,
+            sim_threshold=args.mmc4_textsim_threshold,
+            min_num_images=args.mmc4_min_num_images,
+            max_num_images=args.mmc4_max_num_images,
+        )
+
+
+def pretokenize_shard(shard, output_dir):
+    """Write the pretokenized samples of shard to output_dir. Returns (shard name, number of samples)."""
+    name = os.path.basename(shard)
+    output_path = os.path.join(output_dir, name)
+    num_samples = 0
+    # write to a temporary file, so that only complete shards are recorded in the index
+    with wds.TarWriter(output_path + ".tmp") as sink:
+        for sample in wds.WebDataset(shard):
+            try:
+                output = _pretokenize_fn(sample)
+            except Exception as e:
+                # same samples as rejected by preprocess_interleaved and the LAION pipeline
+                print(f"Skipping {sample['__key__']} in {shard}: {e}")
+                continue
+            sink.write({"__key__": sample["__key__"], **output})
+            num_samples += 1
+    os.rename(output_path + ".tmp", output_path)
+    return name, num_samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_type", choices=["laion", "mmc4"], required=True)
+    parser.add_argument(
+        "--input_shards",
+        type=str,
+        required=True,
+        help="shards to pretokenize, a brace pattern such as /path/to/shards/{00000..00999}.tar",
+    )
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--tokenizer_path", type=str, required=True)
+    parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+    parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+    parser.add_argument("--mmc4_textsim_threshold", default=30, type=float)
+    parser.add_argument("--mmc4_min_num_images", default=1, type=int)
+    parser.add_argument("--mmc4_max_num_images", default=6, type=int)
+    parser.add_argument("--num_workers", default=1, type=int)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tokenizer, image_processor = get_tokenizer_and_image_processor(
+        args.tokenizer_path, args.vision_encoder_path, args.vision_encoder_pretrained
+    )
+    index_args = {
+        "dataset_type": args.dataset_type,
+        "tokenizer": args.tokenizer_path,
+        "vocab_size": len(tokenizer),
+        "vision_encoder_path": args.vision_encoder_path,
+        "vision_encoder_pretrained": args.vision_encoder_pretrained,
+    }
+    if args.dataset_type == "laion":
+        index_args["max_tokens"] = 32
+    else:
+        index_args.update(
+            sim_threshold=args.mmc4_textsim_threshold,
+            min_num_images=args.mmc4_min_num_images,
+            max_num_images=args.mmc4_max_num_images,
+            max_tokens=256,
+        )
+
+    index_path = os.path.join(args.output_dir, PRETOKENIZED_INDEX)
+    index = {"args": index_args, "shards": {}}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        assert (
+            index["args"] == index_args
+        ), f"{index_path} was written with different arguments: {index['args']}"
+
+    shards = [
+        shard
+        for shard in braceexpand.braceexpand(args.input_shards)
+        if os.path.basename(shard) not in index["shards"]
+    ]
+    print(f"Pretokenizing {len(shards)} shards")
+    with Pool(args.num_workers, initializer=init_worker, initargs=(args,)) as pool:
+        for name, num_samples in pool.imap_unordered(
+            functools.partial(pretokenize_shard, output_dir=args.output_dir), shards
+        ):
+            index["shards"][name] = num_samples
+            with open(index_path, "w") as f:
+                json.dump(index, f)
+            with open(os.path.join(args.output_dir, "sizes.json"), "w") as f:
+                json.dump(index["shards"], f)
+            print(f"Wrote {name} with {num_samples} samples")
+
+
+if __name__ == "__main__":
+    main()
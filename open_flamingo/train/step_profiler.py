@@ -0,0 +1,172 @@
+"""
+Per-phase timing of training steps, written locally by every rank and independent of wandb.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+def estimate_flops(model, vision_features=False):
+    """
+    Estimated training FLOPs per text token and per image, using the usual 2 * params FLOPs per token of a
+    forward pass. Call before wrapping the model in FSDP, which flattens and shards the parameters.
+    The language model runs forward and backward (4 * params per token, since the activation gradients
+    must reach every cross attention layer), plus 2 * params per token for the weight gradients of the
+    trainable parameters. The frozen vision encoder only runs forward over its patch tokens, and is
+    skipped with vision_features.
+    Returns (flops_per_token, flops_per_image).
+    """
+    lm_params = sum(p.numel() for p in model.lang_encoder.parameters())
+    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    flops_per_token = 4 * lm_params + 2 * trainable_params
+    if vision_features:
+        return flops_per_token, 0
+    vision_params = sum(p.numel() for p in model.vision_encoder.parameters())
+    num_patches = model.vision_encoder.positional_embedding.shape[0]
+    return flops_per_token, 2 * vision_params * num_patches
+
+
+class StepProfiler:
+    """
+    Times the phases of each optimizer step (see phase()), with CUDA events on GPU and wall-clock otherwise,
+    and counts the tokens and images processed. end_step() appends one JSON line per optimizer step to
+    <output_dir>/rank_<rank>.jsonl, with the phase times in seconds, tokens/s, images/s and, given the
+    peak FLOP/s of the device, the estimated model FLOPs utilization.
+    Optionally also runs torch.profiler over a window of optimizer steps, saving TensorBoard traces to
+    <output_dir>/torch_profiler.
+    A profiler without output_dir does nothing.
+    """
+
+    def __init__(
+        self,
+        output_dir=None,
+        rank=0,
+        device=None,
+        flops_per_token=None,
+        flops_per_image=0,
+        peak_flops=None,
+        torch_profiler_schedule=None,
+    ):
+        """
+        Args:
+            output_dir (str, optional): directory to write the JSONL files and traces to
+            rank (int): rank of this process
+            device (optional): the CUDA device the phases run on; None to time on the host
+            flops_per_token (int, optional): estimated training FLOPs per token, see estimate_flops
+            flops_per_image (int, optional): estimated training FLOPs per image
+            peak_flops (float, optional): peak FLOP/s of the device, to report the model FLOPs utilization
+            torch_profiler_schedule (tuple, optional): (wait, warmup, active) optimizer steps for torch.profiler
+        """
+        self.enabled = output_dir is not None
+        self.rank = rank
+        self.use_cuda_events = device is not None and torch.cuda.is_available()
+        self.flops_per_token = flops_per_token
+        self.flops_per_image = flops_per_image
+        self.peak_flops = peak_flops
+        self.torch_profiler = None
+        if not self.enabled:
+            return
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.file = open(os.path.join(output_dir, f"rank_{rank}.jsonl"), "a")
+        if torch_profiler_schedule is not None:
+            wait, warmup, active = torch_profiler_schedule
+            self.torch_profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(
+                    wait=wait, warmup=warmup, active=active, repeat=1
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    os.path.join(output_dir, "torch_profiler"),
+                    worker_name=f"rank_{rank}",
+                ),
+                record_shapes=True,
+                with_stack=True,
+            )
+            self.torch_profiler.start()
+        self._reset()
+
+    def _reset(self):
+        self.host_times = {}
+        self.cuda_events = []
+        self.counts = {}
+        self.step_start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed code as phase name of the current step. Repeated phases add up."""
+        if not self.enabled:
+            yield
+            return
+        if self.use_cuda_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.cuda_events.append((name, start, end))
+        else:
+            start = time.time()
+            yield
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        """Add wall-clock seconds to phase name of the current step, e.g. for waiting on the dataloader."""
+        if self.enabled:
+            self.host_times[name] = self.host_times.get(name, 0) + seconds
+
+    def count(self, name, tokens, images, samples):
+        """Count a batch of dataset name towards the current step."""
+        if not self.enabled:
+            return
+        counts = self.counts.setdefault(name, {"tokens": 0, "images": 0, "samples": 0})
+        counts["tokens"] += tokens
+        counts["images"] += images
+        counts["samples"] += samples
+
+    def end_step(self, global_step, **extra):
+        """Write the record of the optimizer step that just ended and start timing the next one."""
+        if not self.enabled:
+            return
+        phases = dict(self.host_times)
+        if len(self.cuda_events) > 0:
+            # wait for the last phase, so that all events have completed
+            self.cuda_events[-1][2].synchronize()
+            for name, start, end in self.cuda_events:
+                phases[name] = phases.get(name, 0) + start.elapsed_time(end) / 1000
+        step_time = time.time() - self.step_start
+
+        tokens = sum(counts["tokens"] for counts in self.counts.values())
+        images = sum(counts["images"] for counts in self.counts.values())
+        record = {
+            "rank": self.rank,
+            "global_step": global_step,
+            "time": time.time(),
+            "step_time": step_time,
+            "phases": phases,
+            "datasets": self.counts,
+            "tokens_per_second": tokens / step_time,
+            "images_per_second": images / step_time,
+            **extra,
+        }
+        if self.flops_per_token is not None:
+            flops = tokens * self.flops_per_token + images * self.flops_per_image
+            record["model_flops_per_second"] = flops / step_time
+            if self.peak_flops is not None:
+                record["mfu"] = flops / step_time / self.peak_flops
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+        self._reset()
+
+    def close(self):
+        if not self.enabled:
+            return
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+        self.file.close()
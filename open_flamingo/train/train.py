@@ -1,21 +1,29 @@
 """ Main training script """
 
 import argparse
-import glob
 import os
 import random
 
 import numpy as np
 import torch
 import wandb
-from data import get_data
+from data import get_mixture
 from distributed import init_distributed_device, world_info_from_env
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+from step_profiler import StepProfiler, estimate_flops
 from train_utils import (
+    SHARDED_CHECKPOINT_EXTRA_STATE,
+    CheckpointWriter,
+    get_resume_position,
+    list_checkpoints,
+    load_sharded_checkpoint,
+    optim_state_dict_to_load,
     train_one_epoch,
     get_mp_policy_dtype,
+    restore_rank_state,
     save_checkpoint,
+    split_embedding_optimizer_state,
 )
 from transformers import (
     get_constant_schedule_with_warmup,
@@ -40,6 +48,7 @@ from torch.distributed.distributed_c10d import _get_default_group
 import functools
 
 from open_flamingo import create_model_and_transforms
+from open_flamingo.src.flamingo_lm import TrainableTokenEmbedding
 
 
 def random_seed(seed=42, rank=0):
@@ -85,6 +94,12 @@ def main():
         action="store_true",
         help="delete previous checkpoint when saving new checkpoint",
     )
+    parser.add_argument(
+        "--checkpoint_every_n_steps",
+        type=int,
+        default=None,
+        help="also save a checkpoint every n training steps, which training can resume from mid-epoch. Checkpoints are written in the background.",
+    )
     parser.add_argument("--batch_size_mmc4", type=int, default=128)
     parser.add_argument("--batch_size_laion", type=int, default=128)
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
@@ -98,6 +113,18 @@ def main():
     )
     parser.add_argument("--loss_multiplier_mmc4", type=float, default=1.0)
     parser.add_argument("--loss_multiplier_laion", type=float, default=1.0)
+    parser.add_argument(
+        "--sampling_weight_mmc4",
+        type=float,
+        default=1.0,
+        help="relative frequency of MMC4 batches among the training steps; 0 disables the dataset",
+    )
+    parser.add_argument(
+        "--sampling_weight_laion",
+        type=float,
+        default=1.0,
+        help="relative frequency of LAION batches among the training steps; 0 disables the dataset",
+    )
     parser.add_argument("--warmup_steps", default=5000, type=int)
     parser.add_argument("--weight_decay", default=0.1, type=float)
     parser.add_argument(
@@ -106,6 +133,12 @@ def main():
         default="fp32",
         help="Floating point precision.",
     )
+    parser.add_argument(
+        "--loss_chunk_size",
+        type=int,
+        default=None,
+        help="compute the loss only on labeled positions, this many at a time, instead of from the logits of every position; saves activation memory",
+    )
     parser.add_argument(
         "--gradient_checkpointing",
         action="store_true",
@@ -142,6 +175,25 @@ def main():
     parser.add_argument("--train_num_samples_mmc4", type=int, default=10000)
     parser.add_argument("--train_num_samples_laion", type=int, default=10000)
     parser.add_argument("--dataset_resampled", action="store_true")
+    parser.add_argument(
+        "--vision_features",
+        default=False,
+        action="store_true",
+        help="train from precomputed vision encoder patch tokens instead of images; "
+        "--laion_shards and --mmc4_shards must point to shards written by scripts/precompute_vision_features.py",
+    )
+    parser.add_argument(
+        "--pretokenized",
+        default=False,
+        action="store_true",
+        help="--laion_shards and --mmc4_shards point to shards written by pretokenize_shards.py",
+    )
+    parser.add_argument(
+        "--vision_features_pca",
+        default=None,
+        type=str,
+        help="path to the pca.npz of PCA-compressed vision feature shards",
+    )
     parser.add_argument(
         "--mmc4_textsim_threshold",
         default=30,
@@ -198,6 +250,42 @@ def main():
     parser.add_argument(
         "--fsdp_sharding_strategy", default="full", type=str, choices=["full", "hybrid"]
     )
+    parser.add_argument(
+        "--fsdp_sharded_checkpoint",
+        default=False,
+        action="store_true",
+        help="With --fsdp, save checkpoints as directories of per-rank shards instead of gathering them to rank 0. "
+        "Convert them to a single file with scripts/consolidate_fsdp_checkpoint.py.",
+    )
+    parser.add_argument(
+        "--fsdp_no_sync",
+        default=False,
+        action="store_true",
+        help="With --gradient_accumulation_steps > 1, only reduce-scatter FSDP gradients on the optimizer step. "
+        "Accumulates unsharded gradients in between, which uses more memory.",
+    )
+
+    # profiling args
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="write the phase timings, throughput and MFU of every optimizer step of each rank to <profile_dir>/rank_<rank>.jsonl",
+    )
+    parser.add_argument(
+        "--peak_tflops",
+        type=float,
+        default=None,
+        help="peak TFLOP/s of one GPU at the training precision, to report the model FLOPs utilization in --profile_dir",
+    )
+    parser.add_argument(
+        "--torch_profiler_steps",
+        type=int,
+        nargs=3,
+        default=None,
+        metavar=("WAIT", "WARMUP", "ACTIVE"),
+        help="with --profile_dir, also run torch.profiler for ACTIVE optimizer steps after WAIT + WARMUP steps, saving traces to <profile_dir>/torch_profiler",
+    )
 
     # wandb args
     parser.add_argument("--report_to_wandb", default=False, action="store_true")
@@ -225,17 +313,31 @@ def main():
     if args.mmc4_shards.startswith("s3"):
         args.mmc4_shards = f"pipe:aws s3 cp {args.mmc4_shards} -"
 
+    if args.vision_features_pca is not None and not args.vision_features:
+        raise ValueError("vision_features_pca requires vision_features")
+
+    if args.pretokenized and args.vision_features:
+        raise ValueError("pretokenized shards hold images, not vision features")
+
+    if args.torch_profiler_steps is not None and args.profile_dir is None:
+        raise ValueError("torch_profiler_steps requires profile_dir")
+
     if args.save_checkpoints_to_wandb and not args.report_to_wandb:
         raise ValueError("save_checkpoints_to_wandb requires report_to_wandb")
 
     if args.fsdp and not args.fsdp_use_orig_params:
         print(
             "Warning: FSDP is running without fsdp_use_orig_params flag. "
-            + "This is not recommended because it means we will use uniform weight decay"
-            + " and train all embeddings, not just the newly added ones. "
+            + "This is not recommended because it means we will use uniform weight decay. "
             + "Note: OPT models are not compatible with fsdp_use_orig_params flag."
         )
 
+    if args.fsdp_sharded_checkpoint and not args.fsdp:
+        raise ValueError("fsdp_sharded_checkpoint requires fsdp")
+
+    if args.fsdp_sharded_checkpoint and args.fsdp_sharding_strategy != "full":
+        raise ValueError("fsdp_sharded_checkpoint requires fsdp_sharding_strategy full")
+
     if args.fsdp and args.fsdp_sharding_strategy == "hybrid":
         print(
             "Warning: As of torch=2.0.1, the FSDP logic for optim_state_dict() is broken for hybrid sharding."
@@ -244,10 +346,6 @@ def main():
             + "The main issue was the missing group kwarg on line 1596 in _all_gather_optim_state."
         )
 
-    assert (args.train_num_samples_laion // args.batch_size_laion) == (
-        args.train_num_samples_mmc4 // args.batch_size_mmc4
-    ), "number of samples per epoch must be equal for mmc4 and laion"
-
     # Set up distributed training
     if args.offline:
         os.environ["WANDB_MODE"] = "offline"
@@ -268,6 +366,8 @@ def main():
         freeze_lm_embeddings=args.freeze_lm_embeddings,
     )
     random_seed(args.seed, args.rank)
+    input_embeddings = model.lang_encoder.get_input_embeddings()
+    embedding_name = next(n for n, m in model.named_modules() if m is input_embeddings)
 
     # Initialize logging
     print(f"Start running training on rank {args.rank}.")
@@ -283,29 +383,67 @@ def main():
     if os.path.exists(f"{args.run_name}") and args.resume_from_checkpoint is None:
         # if args do not specify a checkpoint to resume from, check if checkpoints exist for this run
         # and automatically resume from the latest checkpoint
-        checkpoint_list = glob.glob(f"{args.run_name}/checkpoint_*.pt")
+        checkpoint_list = list_checkpoints(args.run_name)
         if len(checkpoint_list) == 0:
             print(f"Found no checkpoints for run {args.run_name}.")
         else:
-            args.resume_from_checkpoint = sorted(
-                checkpoint_list, key=lambda x: int(x.split("_")[-1].split(".")[0])
-            )[-1]
+            args.resume_from_checkpoint = checkpoint_list[-1]
             print(
                 f"Found checkpoint {args.resume_from_checkpoint} for run {args.run_name}."
             )
 
-    resume_from_epoch = 0
+    resume_from_epoch, resume_from_step = 0, 0
+    resume_from_sharded_checkpoint = (
+        args.resume_from_checkpoint is not None
+        and os.path.isdir(args.resume_from_checkpoint)
+    )
     if args.resume_from_checkpoint is not None:
         if args.rank == 0:
             print(f"Loading checkpoint from {args.resume_from_checkpoint}")
-        checkpoint = torch.load(args.resume_from_checkpoint, map_location="cpu")
-        msd = checkpoint["model_state_dict"]
-        msd = {k.replace("module.", ""): v for k, v in msd.items()}
-        resume_from_epoch = checkpoint["epoch"] + 1
+        if resume_from_sharded_checkpoint:
+            if not args.fsdp:
+                raise ValueError(
+                    "Sharded checkpoints can only be loaded with --fsdp. "
+                    + "Convert them with scripts/consolidate_fsdp_checkpoint.py first."
+                )
+            # the model and optimizer states are loaded once the model is wrapped in FSDP
+            checkpoint = torch.load(
+                os.path.join(
+                    args.resume_from_checkpoint, SHARDED_CHECKPOINT_EXTRA_STATE
+                ),
+                map_location="cpu",
+                weights_only=False,
+            )
+        else:
+            checkpoint = torch.load(
+                args.resume_from_checkpoint, map_location="cpu", weights_only=False
+            )
+            msd = checkpoint["model_state_dict"]
+            msd = {k.replace("module.", ""): v for k, v in msd.items()}
+            # checkpoints written before the input embeddings were split into a TrainableTokenEmbedding
+            # hold the whole embedding, which load_state_dict converts, and optimizer moments for all its rows
+            merged_embedding_checkpoint = (
+                isinstance(input_embeddings, TrainableTokenEmbedding)
+                and f"{embedding_name}.weight" in msd
+            )
 
-        # for fsdp, only one rank needs to load the state dict
-        if not args.fsdp or args.rank == 0:
-            model.load_state_dict(msd, False)
+            # for fsdp, only one rank needs to load the state dict
+            if not args.fsdp or args.rank == 0:
+                model.load_state_dict(msd, False)
+
+        resume_from_epoch, resume_from_step = get_resume_position(checkpoint)
+
+    # Initialize the step profiler; estimate the FLOPs before FSDP flattens the parameters
+    flops_per_token, flops_per_image = estimate_flops(model, args.vision_features)
+    profiler = StepProfiler(
+        output_dir=args.profile_dir,
+        rank=args.rank,
+        device=device_id,
+        flops_per_token=flops_per_token,
+        flops_per_image=flops_per_image,
+        peak_flops=args.peak_tflops * 1e12 if args.peak_tflops is not None else None,
+        torch_profiler_schedule=args.torch_profiler_steps,
+    )
 
     # Initialize FSDP / DDP, and ensure the model is on GPU
     print(f"Initializing distributed training with {args.world_size} GPUs.")
@@ -415,18 +553,33 @@ def main():
         )
 
     # load optimizer checkpoint
-    if args.resume_from_checkpoint is not None:
+    if resume_from_sharded_checkpoint:
+        load_sharded_checkpoint(ddp_model, optimizer, args.resume_from_checkpoint, args)
+    elif args.resume_from_checkpoint is not None:
         osd = checkpoint["optimizer_state_dict"]
+        if merged_embedding_checkpoint:
+            param_index = None  # FSDP optimizer states are keyed by name
+            if not args.fsdp:
+                params = [
+                    p for group in optimizer.param_groups for p in group["params"]
+                ]
+                param_index = next(
+                    i
+                    for i, p in enumerate(params)
+                    if p is input_embeddings.trainable.weight
+                )
+            osd = split_embedding_optimizer_state(
+                osd, embedding_name, input_embeddings.token_ids.cpu(), param_index
+            )
         if args.fsdp:
-            osd = FSDP.optim_state_dict_to_load(osd, ddp_model, optimizer)
+            osd = optim_state_dict_to_load(ddp_model, optimizer, osd)
         optimizer.load_state_dict(osd)
 
     # Initialize data loaders
-    laion_dataset = get_data(args, image_processor, tokenizer, "image_text")
-    mmc4_dataset = get_data(args, image_processor, tokenizer, "mmc4")
-    total_training_steps = (
-        (args.train_num_samples_mmc4) // (args.batch_size_mmc4 * args.world_size)
-    ) * args.num_epochs
+    mixture_loader = get_mixture(
+        args, image_processor, tokenizer, epoch=resume_from_epoch
+    )
+    total_training_steps = mixture_loader.num_batches * args.num_epochs
 
     if args.rank == 0:
         print(f"Total training steps: {total_training_steps}")
@@ -453,15 +606,25 @@ def main():
     if args.resume_from_checkpoint is not None:
         lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state_dict"])
 
+    # restore the random number generators and data loading state of this rank
+    if args.resume_from_checkpoint is not None:
+        if not restore_rank_state(checkpoint, args, mixture_loader) and args.rank == 0:
+            print(
+                "Warning: the checkpoint holds no random number generator and data loading states for "
+                + f"{args.world_size} ranks; resuming with fresh ones."
+            )
+
     # Start training!
     ddp_model.train()
+    checkpoint_writer = CheckpointWriter(
+        args,
+        previous_checkpoint=args.resume_from_checkpoint
+        if args.resume_from_checkpoint is not None
+        and os.path.dirname(args.resume_from_checkpoint) == args.run_name
+        else None,
+    )
 
     for epoch in range(resume_from_epoch, args.num_epochs):
-        laion_dataset.set_epoch(epoch)
-        laion_loader = laion_dataset.dataloader
-        mmc4_dataset.set_epoch(epoch)
-        mmc4_loader = mmc4_dataset.dataloader
-
         train_one_epoch(
             args=args,
             model=ddp_model,
@@ -469,15 +632,35 @@ def main():
             tokenizer=tokenizer,
             optimizer=optimizer,
             lr_scheduler=lr_scheduler,
-            laion_loader=laion_loader,
-            mmc4_loader=mmc4_loader,
+            mixture_loader=mixture_loader,
             device_id=device_id,
             wandb=wandb,
+            profiler=profiler,
+            start_step=resume_from_step if epoch == resume_from_epoch else 0,
+            checkpoint_writer=checkpoint_writer,
+        )
+        save_checkpoint(
+            ddp_model,
+            optimizer,
+            lr_scheduler,
+            epoch,
+            args,
+            mixture_loader=mixture_loader,
+            checkpoint_writer=checkpoint_writer,
         )
-        save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args)
 
     # save final checkpoint
-    save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args)
+    save_checkpoint(
+        ddp_model,
+        optimizer,
+        lr_scheduler,
+        epoch,
+        args,
+        mixture_loader=mixture_loader,
+        checkpoint_writer=checkpoint_writer,
+    )
+    checkpoint_writer.wait()
+    profiler.close()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,13 @@
+import glob
+import inspect
+import itertools
+import random
+import re
+import shutil
+import threading
 import time
-from contextlib import suppress
+from contextlib import ExitStack, suppress
+import numpy as np
 import torch
 from tqdm import tqdm
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
@@ -8,10 +16,14 @@ from torch.distributed.fsdp import (
     StateDictType,
 )
 from torch.distributed.fsdp.api import FullOptimStateDictConfig
+import torch.distributed.checkpoint as dist_cp
+from torch.distributed.checkpoint.optimizer import load_sharded_optimizer_state_dict
 import os
 import wandb
 from einops import rearrange
 
+from step_profiler import StepProfiler
+
 
 def get_cast_dtype(precision: str):
     cast_dtype = None
@@ -43,240 +55,243 @@ def get_autocast(precision, cache_enabled=True):
         return suppress
 
 
+def no_sync(model, args):
+    """
+    Context manager that disables gradient synchronization across ranks for the forward and backward passes
+    inside it; gradients accumulate locally and are synchronized by the next backward pass outside of it.
+    With FSDP, only used with --fsdp_no_sync, since FSDP then accumulates unsharded gradients.
+    """
+    if not args.fsdp:
+        return model.no_sync()
+    if not getattr(args, "fsdp_no_sync", False):
+        return suppress()
+    # the model is not an FSDP instance itself; enter no_sync() of every outermost FSDP submodule
+    stack = ExitStack()
+    for module in _outermost_fsdp_modules(model):
+        stack.enter_context(module.no_sync())
+    return stack
+
+
+def _outermost_fsdp_modules(module):
+    if isinstance(module, FSDP):
+        return [module]
+    return [m for child in module.children() for m in _outermost_fsdp_modules(child)]
+
+
+def get_batch_inputs(dataset_type, batch, tokenizer, media_token_id):
+    """
+    Returns the images, shaped (b, T_img, F, ...), input ids, attention mask and labels of a batch
+    of a LAION ("image_text") or MMC4 ("mmc4") dataset.
+    """
+    if dataset_type == "image_text":
+        images = rearrange(batch[0], "(b t f) ... -> b t f ...", t=1, f=1)
+        input_ids, attention_mask = batch[1]
+
+        # set up labels; language model is expected to handle shifting
+        labels = input_ids.clone()
+        labels[labels == tokenizer.pad_token_id] = -100
+        labels[labels == tokenizer.eos_token] = -100
+        labels[labels == media_token_id] = -100
+    else:
+        images = rearrange(batch[0], "b (t f) ... -> b t f ...", f=1)
+        # labels are built by the dataloader workers, see preprocess_interleaved_batch
+        input_ids, attention_mask, labels = batch[1]
+    return images, input_ids, attention_mask, labels
+
+
 def train_one_epoch(
     args,
     model,
     epoch,
-    laion_loader,
-    mmc4_loader,
+    mixture_loader,
     tokenizer,
     optimizer,
     lr_scheduler,
     device_id,
     wandb,
+    profiler=None,
+    start_step=0,
+    checkpoint_writer=None,
 ):
-    # setup loaders
-    num_batches_per_epoch_laion = laion_loader.num_batches
-    num_batches_per_epoch_mmc4 = mmc4_loader.num_batches
-    assert (
-        num_batches_per_epoch_laion == num_batches_per_epoch_mmc4
-    ), "Number of batches in laion and mmc4 datasets must be the same"
-    num_batches_per_epoch = num_batches_per_epoch_mmc4
+    """
+    Train on one epoch of mixture_loader, a MixtureLoader over the LAION and MMC4 datasets.
+    Each step is a forward and backward pass on one batch of one of the datasets.
+    profiler is an optional StepProfiler timing the phases of each optimizer step.
+    start_step is the number of steps of the epoch already done, when resuming from a checkpoint written
+    mid-epoch with --checkpoint_every_n_steps; those checkpoints are written with checkpoint_writer.
+    """
+    if profiler is None:
+        profiler = StepProfiler()
+    num_batches_per_epoch = mixture_loader.num_batches
     total_training_steps = num_batches_per_epoch * args.num_epochs
 
     autocast = get_autocast(
         args.precision, cache_enabled=(not args.fsdp)
     )  # if fsdp, disable cache to save memory
     cast_dtype = get_cast_dtype(args.precision)
+    if getattr(args, "vision_features", False):
+        # precomputed patch tokens are stored in float16 and skip the vision encoder
+        vision_key, vision_dtype = "vision_features", cast_dtype or torch.float32
+    else:
+        vision_key, vision_dtype = "vision_x", cast_dtype
 
     # setup model
     media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
-    endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)[
-        "input_ids"
-    ][-1]
     model.train()
 
     # setup logging
     step_time_m = AverageMeter()
     data_time_m = AverageMeter()
+    # samples per source since the last log, and the last loss of each source
+    num_samples = {source.name: 0 for source in mixture_loader.sources}
+    losses = {}
+    # steps done at the last optimizer step
+    last_optimizer_step = epoch * num_batches_per_epoch + start_step
+    # end of the last optimizer step, for the step time, and of the last micro-step, for the data time
     end = time.time()
+    batch_end = end
 
     # loop through dataloader
-    for num_steps, (batch_laion, batch_mmc4) in tqdm(
-        enumerate(zip(laion_loader, mmc4_loader)),
+    for num_steps, (source, batch) in tqdm(
+        enumerate(
+            itertools.islice(mixture_loader, num_batches_per_epoch - start_step),
+            start=start_step,
+        ),
         disable=args.rank != 0,
         total=total_training_steps,
-        initial=(epoch * num_batches_per_epoch),
+        initial=(epoch * num_batches_per_epoch + start_step),
     ):
-        data_time_m.update(time.time() - end)
+        # time waiting for this batch only, not the earlier micro-steps of the optimizer step
+        data_time_m.update(time.time() - batch_end)
+        profiler.add_time("data", time.time() - batch_end)
         global_step = num_steps + epoch * num_batches_per_epoch
-
-        #### LAION FORWARD PASS ####
-        images = batch_laion[0].to(device_id, dtype=cast_dtype, non_blocking=True)
-        images = rearrange(images, "(b t f) c h w -> b t f c h w", t=1, f=1)
-        input_ids = batch_laion[1][0].to(device_id, dtype=cast_dtype, non_blocking=True)
-        attention_mask = batch_laion[1][1].to(
-            device_id, dtype=cast_dtype, non_blocking=True
+        step_optimizer = ((num_steps + 1) % args.gradient_accumulation_steps == 0) or (
+            num_steps == num_batches_per_epoch - 1
         )
 
-        # set up labels; language model is expected to handle shifting
-        labels = input_ids.clone()
-        labels[labels == tokenizer.pad_token_id] = -100
-        labels[labels == tokenizer.eos_token] = -100
-        labels[labels == media_token_id] = -100
-        labels = labels.to(device_id)
-
-        # gradient accumulation w/ fsdp cpu offloading requires a no_sync context manager
-        with autocast():
-            loss_laion = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )[0]
-
-        divided_loss_laion = loss_laion / args.gradient_accumulation_steps
-        (divided_loss_laion * args.loss_multiplier_laion).backward()
-
-        #### MMC4 FORWARD PASS ####
-        images = batch_mmc4[0].to(device_id, dtype=cast_dtype, non_blocking=True)
-        images = rearrange(images, "b (t f) c h w -> b t f c h w", f=1)
-        input_ids = torch.stack([x[0] for x in batch_mmc4[1]]).squeeze(1)
-        attention_mask = torch.stack([x[1] for x in batch_mmc4[1]]).squeeze(1)
-
-        # set up labels; language model is expected to handle shifting
-        labels = input_ids.clone()
-        labels[labels == tokenizer.pad_token_id] = -100
-        labels[labels == tokenizer.eos_token] = -100
-        for i in range(labels.shape[0]):
-            # remove loss for any token before the first <image> token
-            label_idx = 0
-            while (
-                label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id
-            ):
-                labels[i][label_idx] = -100
-                label_idx += 1
-
-            # get index of all endofchunk tokens in the sequence
-            endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
-            for endofchunk_idx in endofchunk_idxs:
-                token_idx = endofchunk_idx + 1
-                while (
-                    token_idx < labels.shape[1]
-                    and labels[i][token_idx] != media_token_id
-                ):
-                    labels[i][token_idx] = -100
-                    token_idx += 1
-
-        labels[labels == media_token_id] = -100
-        labels = labels.to(device_id)
-
-        # gradient accumulation w/ fsdp cpu offloading requires a no_sync context manager
-        with autocast():
-            loss_mmc4 = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )[0]
-
-            # if loss is nan, skip this batch
-            # this hack of skipping the batch is not FSDP-compatible
-            if torch.isnan(loss_mmc4):
-                print("loss is nan, skipping this batch")
-                print("input_ids: ", tokenizer.batch_decode(input_ids))
-                print("labels: ", labels)
-                print("images: ", images)
-                optimizer.zero_grad(set_to_none=True)
-                continue
-
-        divided_loss_mmc4 = loss_mmc4 / args.gradient_accumulation_steps
-        (divided_loss_mmc4 * args.loss_multiplier_mmc4).backward()
-
-        if (not args.freeze_lm_embeddings) and (
-            not args.fsdp or args.fsdp_use_orig_params
-        ):
-            # Mask gradients for input embeddings s.t. we only update the added tokens <image> and <|endofchunk|>
-            if args.fsdp:
-                embed_grad = model.lang_encoder.get_input_embeddings().weight.grad
-            else:
-                embed_grad = (
-                    model.module.lang_encoder.get_input_embeddings().weight.grad
-                )
-            zero_mask = torch.zeros_like(embed_grad)
-            zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-            zero_mask[endofchunk_token_id] = torch.ones_like(
-                zero_mask[endofchunk_token_id]
+        #### FORWARD PASS ####
+        with profiler.phase("labels"):
+            images, input_ids, attention_mask, labels = get_batch_inputs(
+                source.dataset_type, batch, tokenizer, media_token_id
             )
-            if args.fsdp:
-                model.lang_encoder.get_input_embeddings().weight.grad = (
-                    embed_grad * zero_mask
-                )
-            else:
-                model.module.lang_encoder.get_input_embeddings().weight.grad = (
-                    embed_grad * zero_mask
+        with profiler.phase("to_device"):
+            images = images.to(device_id, dtype=vision_dtype, non_blocking=True)
+            if source.dataset_type == "image_text":
+                input_ids = input_ids.to(device_id, dtype=cast_dtype, non_blocking=True)
+                attention_mask = attention_mask.to(
+                    device_id, dtype=cast_dtype, non_blocking=True
                 )
+            labels = labels.to(device_id)
+        num_samples[source.name] += images.shape[0]
+        profiler.count(
+            source.name,
+            tokens=input_ids.numel(),
+            images=images.shape[0] * images.shape[1],
+            samples=images.shape[0],
+        )
 
-        # clip gradient norm
-        if args.fsdp:
-            """
-            The way we clip gradients with FSDP is different than the non-FSDP case,
-            because during FSDP, gradient norms are computed over certain submodules,
-            rather than the entire model.
-            At least for OPT-125M, this didn't seem to make a difference in performance.
-            """
-            model.clip_grad_norm_(1.0)
-        else:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        # gradients are synchronized across ranks by the last backward pass before the optimizer step
+        sync_context = suppress() if step_optimizer else no_sync(model, args)
+        with sync_context, profiler.phase(f"forward_backward_{source.name}"):
+            with autocast():
+                loss = model(
+                    **{vision_key: images},
+                    lang_x=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                    loss_chunk_size=args.loss_chunk_size,
+                )[0]
+
+                # if loss is nan, skip this batch
+                # this hack of skipping the batch is not FSDP-compatible
+                if torch.isnan(loss):
+                    print(f"loss is nan, skipping this {source.name} batch")
+                    print("input_ids: ", tokenizer.batch_decode(input_ids))
+                    print("labels: ", labels)
+                    print("images: ", images)
+                    optimizer.zero_grad(set_to_none=True)
+                    batch_end = time.time()
+                    continue
+
+            divided_loss = loss / args.gradient_accumulation_steps
+            loss_multiplier = getattr(args, f"loss_multiplier_{source.name}", 1.0)
+            (divided_loss * loss_multiplier).backward()
+        losses[source.name] = loss.item()
 
         # step optimizer and log
-        if (((num_steps + 1) % args.gradient_accumulation_steps) == 0) or (
-            num_steps == num_batches_per_epoch - 1
-        ):
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.zero_grad(set_to_none=True)
+        if step_optimizer:
+            # clip the accumulated gradients, which are synchronized across ranks at this point
+            with profiler.phase("clip_grads"):
+                if args.fsdp:
+                    """
+                    The way we clip gradients with FSDP is different than the non-FSDP case,
+                    because during FSDP, gradient norms are computed over certain submodules,
+                    rather than the entire model.
+                    At least for OPT-125M, this didn't seem to make a difference in performance.
+                    """
+                    model.clip_grad_norm_(1.0)
+                else:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+
+            with profiler.phase("optimizer_step"):
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad(set_to_none=True)
 
             # step time and reset end outside of rank 0
             step_time_m.update(time.time() - end)
             end = time.time()
+            profiler.end_step(global_step, epoch=epoch)
+
+            # checkpoint at the first optimizer step after every checkpoint_every_n_steps steps,
+            # except at the end of the epoch, where train.py saves a checkpoint
+            if (
+                args.checkpoint_every_n_steps is not None
+                and (global_step + 1) // args.checkpoint_every_n_steps
+                > last_optimizer_step // args.checkpoint_every_n_steps
+                and num_steps != num_batches_per_epoch - 1
+            ):
+                save_checkpoint(
+                    model,
+                    optimizer,
+                    lr_scheduler,
+                    epoch,
+                    args,
+                    step=num_steps + 1,
+                    mixture_loader=mixture_loader,
+                    checkpoint_writer=checkpoint_writer,
+                )
+            last_optimizer_step = global_step + 1
 
             # rank 0 logging
             if args.rank == 0 and args.report_to_wandb:
-                laion_samples_per_second = (
-                    args.gradient_accumulation_steps
-                    * args.batch_size_laion
-                    * args.world_size
-                    / step_time_m.val
-                )
-                laion_samples_per_second_per_gpu = (
-                    args.gradient_accumulation_steps
-                    * args.batch_size_laion
-                    / step_time_m.val
-                )
-                c4_samples_per_second = (
-                    args.gradient_accumulation_steps
-                    * args.batch_size_mmc4
-                    * args.world_size
-                    / step_time_m.val
-                )
-                c4_samples_per_second_per_gpu = (
-                    args.gradient_accumulation_steps
-                    * args.batch_size_mmc4
-                    / step_time_m.val
-                )
-                wandb.log(
-                    {
-                        "data_time": data_time_m.avg,
-                        "step_time": step_time_m.avg,
-                        "laion_samples_per_second": laion_samples_per_second,
-                        "laion_samples_per_second_per_gpu": laion_samples_per_second_per_gpu,
-                        "c4_samples_per_second": c4_samples_per_second,
-                        "c4_samples_per_second_per_gpu": c4_samples_per_second_per_gpu,
-                        "lr": optimizer.param_groups[0]["lr"],
-                    },
-                    commit=False,
-                )
+                log = {
+                    "data_time": data_time_m.avg,
+                    "step_time": step_time_m.avg,
+                    "lr": optimizer.param_groups[0]["lr"],
+                    "global_step": global_step,
+                }
+                for name, n in num_samples.items():
+                    log[f"{name}_samples_per_second"] = (
+                        n * args.world_size / step_time_m.sum
+                    )
+                    log[f"{name}_samples_per_second_per_gpu"] = n / step_time_m.sum
+                for name, loss_value in losses.items():
+                    log[f"loss_{name}"] = loss_value
+                wandb.log(log, commit=True)
                 step_time_m.reset()
                 data_time_m.reset()
-
-                wandb.log(
-                    {
-                        "loss_laion": loss_laion.item(),
-                        "global_step": global_step,
-                    },
-                    commit=False,
-                )
-                wandb.log(
-                    {"loss_mmc4": loss_mmc4.item(), "global_step": global_step},
-                    commit=True,
-                )
+                num_samples = {name: 0 for name in num_samples}
 
         # Log loss to console
         if ((num_steps + 1) % args.logging_steps == 0) and args.rank == 0:
+            loss_str = " // ".join(
+                f"Loss {name}: {loss_value:.3f}" for name, loss_value in losses.items()
+            )
             print(
-                f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Loss LAION: {loss_laion.item():.3f} // Loss MMC4: {loss_mmc4.item():.3f}"
+                f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. {loss_str}"
             )
+        batch_end = time.time()
 
 
 class AverageMeter(object):
@@ -305,13 +320,19 @@ def filter_state_dict_to_trainable(model, state_dict):
     This is because we need the new <image> <|endofchunk|> tokens to
     be consistent across initializations.
     """
+    embedding_params = {
+        p
+        for m in model.modules()
+        if isinstance(m, torch.nn.Embedding)
+        for p in m.parameters()
+    }
     for (
         name,
         p,
     ) in model.named_parameters():  # won't work for fsdp + use_orig_params=False
         if "fsdp" in name:
             continue
-        if "embed" in name or isinstance(p, torch.nn.Embedding):
+        if "embed" in name or p in embedding_params:
             continue
         if not p.requires_grad:
             name = name.replace("._checkpoint_wrapped_module", "")
@@ -335,10 +356,202 @@ def filter_state_dict_to_trainable(model, state_dict):
     return state_dict
 
 
-def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
+def split_embedding_optimizer_state(osd, embedding_name, token_ids, param_index=None):
+    """
+    Convert the optimizer state of a checkpoint written before the input embeddings were split into a
+    TrainableTokenEmbedding, whose moments cover every row of the embedding, to the moments of its trainable
+    rows (see split_token_embedding_state_dict for the model state).
+    The embedding is keyed by name in FSDP optimizer state dicts, and by its param_index in the optimizer
+    otherwise.
+    """
+    if param_index is None:
+        key, new_key = f"{embedding_name}.weight", f"{embedding_name}.trainable.weight"
+    else:
+        key, new_key = param_index, param_index
+    state = osd["state"].pop(key, None)
+    if state is None:
+        return osd
+    osd["state"][new_key] = {
+        k: v[token_ids.to(v.device)] if torch.is_tensor(v) and v.dim() > 0 else v
+        for k, v in state.items()
+    }
+    for group in osd["param_groups"]:
+        group["params"] = [new_key if p == key else p for p in group["params"]]
+    return osd
+
+
+def get_rng_state():
+    """The states of the random number generators of this process."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def get_resume_position(checkpoint):
+    """
+    The (epoch, step) to resume training at from a checkpoint: the start of the next epoch for a checkpoint
+    written at the end of an epoch, or the step a checkpoint written mid-epoch with --checkpoint_every_n_steps
+    was taken after.
+    """
+    if checkpoint.get("step") is None:
+        return checkpoint["epoch"] + 1, 0
+    return checkpoint["epoch"], checkpoint["step"]
+
+
+def restore_rank_state(checkpoint, args, mixture_loader):
+    """
+    Restore the random number generators and the mixture_loader state of this rank from the rank_states of a
+    checkpoint. Returns False, restoring nothing, if the checkpoint holds no states for args.world_size ranks.
+    """
+    rank_states = checkpoint.get("rank_states")
+    if rank_states is None or len(rank_states) != args.world_size:
+        return False
+    set_rng_state(rank_states[args.rank]["rng"])
+    if rank_states[args.rank]["data"] is not None:
+        mixture_loader.load_state_dict(rank_states[args.rank]["data"])
+    return True
+
+
+def snapshot_to_cpu(state, copy_cpu_tensors=True):
+    """
+    Copy the tensors of a (nested) state dict to CPU, so that it can be serialized while training continues.
+    With copy_cpu_tensors=False, CPU tensors are kept as they are, e.g. for FSDP full state dicts, which are
+    offloaded copies already.
+    """
+    if isinstance(state, torch.Tensor):
+        if state.is_cuda:
+            return state.detach().cpu()
+        return state.detach().clone() if copy_cpu_tensors else state
+    if isinstance(state, dict):
+        return {k: snapshot_to_cpu(v, copy_cpu_tensors) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(v, copy_cpu_tensors) for v in state)
+    return state
+
+
+# checkpoint_{epoch}.pt is written at the end of an epoch, checkpoint_{epoch}_{step}.pt after step steps of an
+# epoch (see --checkpoint_every_n_steps); sharded checkpoints are directories named without the .pt suffix
+_CHECKPOINT_NAME = re.compile(r"checkpoint_(\d+)(?:_(\d+))?(?:\.pt)?")
+# non-tensor state of a sharded checkpoint, next to the shards
+SHARDED_CHECKPOINT_EXTRA_STATE = "extra_state.pt"
+
+
+def list_checkpoints(run_name):
+    """The checkpoints in a run directory, oldest first."""
+    checkpoints = [
+        path
+        for path in glob.glob(os.path.join(run_name, "checkpoint_*"))
+        if _CHECKPOINT_NAME.fullmatch(os.path.basename(path))
+    ]
+    return sorted(checkpoints, key=_checkpoint_sort_key)
+
+
+def _checkpoint_sort_key(path):
+    epoch, step = _CHECKPOINT_NAME.fullmatch(os.path.basename(path)).groups()
+    return (int(epoch), float("inf") if step is None else int(step))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so that training continues while they are serialized.
+    At most one checkpoint is written at a time: write() first waits for the previous one.
+    """
+
+    def __init__(self, args, previous_checkpoint=None):
+        self.args = args
+        # the last written checkpoint, deleted after the next one with --delete_previous_checkpoint
+        self.previous_checkpoint = previous_checkpoint
+        self.thread = None
+
+    def write(self, checkpoint_dict, path):
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(checkpoint_dict, path))
+        self.thread.start()
+
+    def _write(self, checkpoint_dict, path):
+        # write to a temporary file, so that a killed run never leaves a truncated checkpoint
+        torch.save(checkpoint_dict, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.finish(path)
+
+    def finish(self, path):
+        """Called once the checkpoint at path, a file or a sharded checkpoint directory, is complete."""
+        print(f"Saved checkpoint to {path}")
+        if self.args.report_to_wandb and self.args.save_checkpoints_to_wandb:
+            wandb.save(os.path.join(path, "*") if os.path.isdir(path) else path)
+        if (
+            self.args.delete_previous_checkpoint
+            and self.previous_checkpoint is not None
+            and self.previous_checkpoint != path
+            and os.path.exists(self.previous_checkpoint)
+        ):
+            if os.path.isdir(self.previous_checkpoint):
+                shutil.rmtree(self.previous_checkpoint)
+            else:
+                os.remove(self.previous_checkpoint)
+        self.previous_checkpoint = path
+
+    def wait(self):
+        """Wait until the checkpoint being written, if any, is on disk."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def gather_rank_states(args, mixture_loader=None):
+    """The random number generator and data loading states of every rank, which each rank has its own of."""
+    rank_state = {
+        "rng": get_rng_state(),
+        "data": mixture_loader.state_dict() if mixture_loader is not None else None,
+    }
+    rank_states = [None] * args.world_size
+    torch.distributed.all_gather_object(rank_states, rank_state)
+    return rank_states
+
+
+def save_checkpoint(
+    model,
+    optimizer,
+    lr_scheduler,
+    epoch,
+    args,
+    step=None,
+    mixture_loader=None,
+    checkpoint_writer=None,
+):
     """
     Save training checkpoint with model, optimizer, and lr_scheduler state.
+    Without step, the checkpoint is written at the end of epoch; with step, after step steps of epoch.
+    The random number generator states and the mixture_loader state of every rank are saved as well,
+    so that train.py can resume mid-epoch. If a checkpoint_writer is given, the states are copied to CPU
+    and written in the background; otherwise the checkpoint is written before returning.
+    With --fsdp_sharded_checkpoint, see save_sharded_checkpoint.
     """
+    if args.fsdp and args.fsdp_sharded_checkpoint:
+        return save_sharded_checkpoint(
+            model,
+            optimizer,
+            lr_scheduler,
+            epoch,
+            args,
+            step=step,
+            mixture_loader=mixture_loader,
+            checkpoint_writer=checkpoint_writer,
+        )
+
     if args.fsdp:
         FSDP.set_state_dict_type(
             model,
@@ -353,6 +566,8 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
         model_state = model.state_dict()
         optim_state = optimizer.state_dict()
 
+    rank_states = gather_rank_states(args, mixture_loader)
+
     if args.rank == 0:
         if not (args.fsdp and not args.fsdp_use_orig_params):
             model_state = filter_state_dict_to_trainable(model, model_state)
@@ -362,16 +577,137 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
 
         checkpoint_dict = {
             "epoch": epoch,
+            "step": step,
             "model_state_dict": model_state,
             "optimizer_state_dict": optim_state,
             "lr_scheduler_state_dict": lr_scheduler.state_dict(),
+            "rank_states": rank_states,
         }
 
-        print(f"Saving checkpoint to {args.run_name}/checkpoint_{epoch}.pt")
-        torch.save(checkpoint_dict, f"{args.run_name}/checkpoint_{epoch}.pt")
-        if args.report_to_wandb and args.save_checkpoints_to_wandb:
-            wandb.save(f"{args.run_name}/checkpoint_{epoch}.pt")
+        if step is None:
+            path = f"{args.run_name}/checkpoint_{epoch}.pt"
+        else:
+            path = f"{args.run_name}/checkpoint_{epoch}_{step}.pt"
+        if checkpoint_writer is None:
+            checkpoint_writer = CheckpointWriter(
+                args,
+                previous_checkpoint=f"{args.run_name}/checkpoint_{epoch-1}.pt"
+                if step is None and epoch > 0
+                else None,
+            )
+            checkpoint_writer.write(checkpoint_dict, path)
+            checkpoint_writer.wait()
+        else:
+            print(f"Saving checkpoint to {path} in the background")
+            checkpoint_writer.write(
+                snapshot_to_cpu(checkpoint_dict, copy_cpu_tensors=not args.fsdp), path
+            )
+
+
+def _sharded_model_state_dict(model, args):
+    """The sharded model state dict stored in sharded checkpoints; must be called on all ranks."""
+    FSDP.set_state_dict_type(model, StateDictType.SHARDED_STATE_DICT)
+    model_state = model.state_dict()
+    if args.fsdp_use_orig_params:
+        model_state = filter_state_dict_to_trainable(model, model_state)
+    return model_state
 
-        if args.delete_previous_checkpoint:
-            if epoch > 0:
-                os.remove(f"{args.run_name}/checkpoint_{epoch-1}.pt")
+
+def save_sharded_checkpoint(
+    model,
+    optimizer,
+    lr_scheduler,
+    epoch,
+    args,
+    step=None,
+    mixture_loader=None,
+    checkpoint_writer=None,
+):
+    """
+    Save an FSDP training checkpoint as a directory in which each rank writes the shards of the model and
+    optimizer states it holds, with torch.distributed.checkpoint, plus a metadata index of the shards.
+    Unlike save_checkpoint, nothing is gathered to rank 0, so peak memory and save time do not grow with the
+    model size on rank 0. Rank 0 writes the remaining state (epoch, step, lr_scheduler, per-rank states) to
+    SHARDED_CHECKPOINT_EXTRA_STATE. Sharded checkpoints are written synchronously, as writing them involves
+    collectives; load them with load_sharded_checkpoint, or convert them to the single-file format with
+    scripts/consolidate_fsdp_checkpoint.py.
+    """
+    model_state = _sharded_model_state_dict(model, args)
+    optim_state = FSDP.optim_state_dict(model, optimizer)
+    rank_states = gather_rank_states(args, mixture_loader)
+
+    if step is None:
+        path = f"{args.run_name}/checkpoint_{epoch}"
+    else:
+        path = f"{args.run_name}/checkpoint_{epoch}_{step}"
+    # write to a temporary directory, so that a killed run never leaves a partial checkpoint
+    tmp_path = path + ".tmp"
+    if args.rank == 0:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+    torch.distributed.barrier()
+
+    if args.rank == 0:
+        print(f"Saving sharded checkpoint to {path}")
+    dist_cp.save_state_dict(
+        state_dict={"model": model_state, "optim": optim_state},
+        storage_writer=dist_cp.FileSystemWriter(tmp_path),
+    )
+
+    if args.rank == 0:
+        torch.save(
+            {
+                "epoch": epoch,
+                "step": step,
+                "lr_scheduler_state_dict": lr_scheduler.state_dict(),
+                "rank_states": rank_states,
+            },
+            os.path.join(tmp_path, SHARDED_CHECKPOINT_EXTRA_STATE),
+        )
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        if checkpoint_writer is None:
+            checkpoint_writer = CheckpointWriter(args)
+        checkpoint_writer.wait()
+        checkpoint_writer.finish(path)
+    torch.distributed.barrier()
+
+
+def load_sharded_checkpoint(model, optimizer, path, args):
+    """
+    Load the model and optimizer states of a checkpoint written by save_sharded_checkpoint into an FSDP model.
+    torch.distributed.checkpoint reshards the states, so the world size may differ from the saving run.
+    Returns the remaining state of the checkpoint, from SHARDED_CHECKPOINT_EXTRA_STATE.
+    """
+    model_state = _sharded_model_state_dict(model, args)
+    storage_reader = dist_cp.FileSystemReader(path)
+    state = {"model": model_state}
+    dist_cp.load_state_dict(state_dict=state, storage_reader=storage_reader)
+    model.load_state_dict(state["model"], strict=False)
+
+    optim_state = load_sharded_optimizer_state_dict(
+        model_state_dict=state["model"],
+        optimizer_key="optim",
+        storage_reader=storage_reader,
+    )
+    osd = optim_state_dict_to_load(model, optimizer, optim_state["optim"])
+    optimizer.load_state_dict(osd)
+    # not weights_only: the rank states hold numpy random number generator states
+    return torch.load(
+        os.path.join(path, SHARDED_CHECKPOINT_EXTRA_STATE),
+        map_location="cpu",
+        weights_only=False,
+    )
+
+
+def optim_state_dict_to_load(model, optimizer, optim_state_dict):
+    """
+    FSDP.optim_state_dict_to_load, which takes (optim_state_dict, model, optim) in torch 2.0
+    and (model, optim, optim_state_dict) in later versions.
+    """
+    parameters = inspect.signature(FSDP.optim_state_dict_to_load).parameters
+    if next(iter(parameters)) == "model":
+        return FSDP.optim_state_dict_to_load(model, optimizer, optim_state_dict)
+    return FSDP.optim_state_dict_to_load(optim_state_dict, model, optimizer)
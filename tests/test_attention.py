@@ -0,0 +1,141 @@
+"""
+The attention backends of open_flamingo/src/helpers.py against a copy of the original eager implementation.
+"""
+import pytest
+import torch
+from einops import rearrange, repeat
+from einops_exts import rearrange_many
+
+from open_flamingo.src.helpers import (
+    MaskedCrossAttention,
+    PerceiverAttention,
+    attention,
+)
+
+BACKENDS = ["eager", "sdpa", "chunked"]
+
+
+def reference_perceiver_attention(module, x, latents):
+    """PerceiverAttention.forward before the attention backends were added."""
+    x = module.norm_media(x)
+    latents = module.norm_latents(latents)
+    q = module.to_q(latents)
+    k, v = module.to_kv(torch.cat((x, latents), dim=-2)).chunk(2, dim=-1)
+    q, k, v = rearrange_many((q, k, v), "b t n (h d) -> b h t n d", h=module.heads)
+    q = q * module.scale
+    sim = torch.einsum("... i d, ... j d  -> ... i j", q, k)
+    sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+    out = torch.einsum("... i j, ... j d -> ... i d", sim.softmax(dim=-1), v)
+    return module.to_out(rearrange(out, "b h t n d -> b t n (h d)"))
+
+
+def reference_masked_cross_attention(
+    module, x, media, media_locations, use_cached_media=False
+):
+    """MaskedCrossAttention.forward before the attention backends were added."""
+    T_txt = x.shape[1]
+    _, T_img, n = media.shape[:3]
+    x = module.norm(x)
+    q = module.to_q(x)
+    k, v = module.to_kv(rearrange(media, "b t n d -> b (t n) d")).chunk(2, dim=-1)
+    q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=module.heads)
+    q = q * module.scale
+    sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
+
+    media_time = torch.arange(T_img) + 1
+    if use_cached_media:
+        text_time = repeat(
+            torch.count_nonzero(media_locations, dim=1), "b -> b i", i=T_txt
+        )
+    else:
+        text_time = media_locations.cumsum(dim=-1)
+    mask_op = torch.eq if module.only_attend_immediate_media else torch.ge
+    text_to_media_mask = mask_op(
+        rearrange(text_time, "b i -> b 1 i 1"),
+        repeat(media_time, "j -> 1 1 1 (j n)", n=n),
+    )
+    sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
+    sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+    attn = sim.softmax(dim=-1)
+    if module.only_attend_immediate_media:
+        attn = attn.masked_fill(rearrange(text_time == 0, "b i -> b 1 i 1"), 0.0)
+    out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
+    return module.to_out(rearrange(out, "b h n d -> b n (h d)"))
+
+
+def make_media_locations():
+    # row 0: text before the first media; row 1: no media at all;
+    # row 2: more media tokens than there are media (T_img = 2)
+    media_locations = torch.zeros(3, 12, dtype=torch.bool)
+    media_locations[0, [3, 8]] = True
+    media_locations[2, [0, 4, 7]] = True
+    return media_locations
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_perceiver_attention(backend):
+    torch.manual_seed(0)
+    module = PerceiverAttention(dim=32, dim_head=8, heads=4, attention_backend=backend)
+    x, latents = torch.randn(2, 3, 10, 32), torch.randn(2, 3, 5, 32)
+    torch.testing.assert_close(
+        module(x, latents), reference_perceiver_attention(module, x, latents)
+    )
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("only_attend_immediate_media", [True, False])
+@pytest.mark.parametrize("gather_immediate_media", [False, True])
+@pytest.mark.parametrize("use_cached_media", [False, True])
+def test_masked_cross_attention(
+    backend, only_attend_immediate_media, gather_immediate_media, use_cached_media
+):
+    torch.manual_seed(0)
+    module = MaskedCrossAttention(
+        dim=32,
+        dim_visual=16,
+        dim_head=8,
+        heads=4,
+        only_attend_immediate_media=only_attend_immediate_media,
+        attention_backend=backend,
+        gather_immediate_media=gather_immediate_media,
+    )
+    media_locations = make_media_locations()
+    x_len = 1 if use_cached_media else media_locations.shape[1]
+    x, media = torch.randn(3, x_len, 32), torch.randn(3, 2, 5, 16)
+
+    out = module(
+        x, media, media_locations=media_locations, use_cached_media=use_cached_media
+    )
+    expected = reference_masked_cross_attention(
+        module, x, media, media_locations, use_cached_media
+    )
+    torch.testing.assert_close(out, expected)
+
+
+@pytest.mark.parametrize("backend", ["sdpa", "chunked"])
+@pytest.mark.parametrize("scale", [None, 0.05])
+def test_attention_fully_masked_rows(backend, scale):
+    torch.manual_seed(0)
+    q, k, v = torch.randn(2, 4, 7, 8), torch.randn(2, 4, 9, 8), torch.randn(2, 4, 9, 8)
+    mask = torch.rand(2, 1, 7, 9) > 0.5
+    mask[0, :, 2] = False  # rows without any valid key
+    mask[1, :, :] = False
+    out = attention(q, k, v, mask=mask, scale=scale, backend=backend, chunk_size=3)
+    expected = attention(q, k, v, mask=mask, scale=scale, backend="eager")
+    assert not out.isnan().any()
+    torch.testing.assert_close(out, expected)
+    # fully masked rows attend uniformly to all keys
+    torch.testing.assert_close(
+        out[1], v[1].mean(dim=-2, keepdim=True).expand(-1, 7, -1)
+    )
+
+
+def test_sdpa_non_default_scale():
+    # torch 2.0.1 sdpa has no scale argument, so the queries are rescaled instead
+    torch.manual_seed(0)
+    q, k, v = torch.randn(2, 4, 7, 8), torch.randn(2, 4, 9, 8), torch.randn(2, 4, 9, 8)
+    for scale in [0.05, 1.0, 2.0]:
+        torch.testing.assert_close(
+            attention(q, k, v, scale=scale, backend="sdpa"),
+            torch.softmax(q @ k.transpose(-1, -2) * scale, dim=-1) @ v,
+        )
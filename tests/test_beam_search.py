@@ -0,0 +1,65 @@
+"""
+Beam search encodes each image once, against repeating the images for every beam before encoding them.
+"""
+import pytest
+import torch
+
+from tiny_models import (
+    EOC_TOKEN_ID,
+    left_pad,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+NUM_BEAMS = 3
+MAX_NEW_TOKENS = 6
+
+
+def generate_repeating_images(model, vision_x, lang_x, attention_mask):
+    """Flamingo.generate with num_beams before the images were encoded once per sample."""
+    model.lang_encoder._use_cached_vision_x = True
+    model._encode_vision_x(vision_x=vision_x.repeat_interleave(NUM_BEAMS, dim=0))
+    output = model.lang_encoder.generate(
+        input_ids=lang_x,
+        attention_mask=attention_mask,
+        eos_token_id=EOC_TOKEN_ID,
+        num_beams=NUM_BEAMS,
+        max_new_tokens=MAX_NEW_TOKENS,
+        pad_token_id=EOC_TOKEN_ID,
+    )
+    model.lang_encoder.clear_conditioned_layers()
+    model.lang_encoder._use_cached_vision_x = False
+    return output
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+@pytest.mark.parametrize("padded", [False, True])
+def test_matches_repeating_images(lm, padded):
+    model = make_flamingo(lm)
+    vision_x = random_images(4, 3)
+    rows = [random_prompt(9, 3, seed=i) for i in range(4)]
+    if padded:
+        # the last sample has a single image, followed by two padding images
+        vision_x[3, 1:] = 0
+        rows[3] = random_prompt(5, 1, seed=3)
+    lang_x, attention_mask = left_pad(rows)
+
+    num_encoded = []
+    model.vision_encoder.register_forward_hook(
+        lambda module, args, output: num_encoded.append(args[0].shape[0])
+    )
+    with torch.no_grad():
+        output = model.generate(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            num_beams=NUM_BEAMS,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=EOC_TOKEN_ID,
+        )
+        expected = generate_repeating_images(model, vision_x, lang_x, attention_mask)
+    assert torch.equal(output, expected)
+
+    num_images = 10 if padded else 12
+    assert num_encoded == [num_images, num_images * NUM_BEAMS]
@@ -0,0 +1,103 @@
+"""
+A multi-token chunk on top of cached media and past_key_values against the per-token loop and a full forward.
+"""
+import pytest
+import torch
+
+from tiny_models import (
+    MEDIA_TOKEN_ID,
+    left_pad,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+CONTINUATION_LENGTH = 6
+
+
+def make_inputs(media_in_continuation):
+    """Left-padded contexts of one image each, and continuations with or without a second image."""
+    context_ids, context_mask = left_pad(
+        [random_prompt(7, 1, seed=0), random_prompt(5, 1, seed=1)]
+    )
+    generator = torch.Generator().manual_seed(2)
+    continuation = torch.randint(
+        0, MEDIA_TOKEN_ID - 3, (2, CONTINUATION_LENGTH), generator=generator
+    )
+    if media_in_continuation:
+        continuation[:, 2] = MEDIA_TOKEN_ID
+    vision_x = random_images(2, 1 + media_in_continuation)
+    return vision_x, context_ids, context_mask.bool(), continuation
+
+
+def full_forward_logits(model, vision_x, context_ids, context_mask, continuation):
+    """Continuation logits of a forward over the whole sequence, without caching."""
+    output = model(
+        vision_x,
+        torch.cat([context_ids, continuation], dim=1),
+        attention_mask=torch.cat(
+            [context_mask, torch.ones_like(continuation, dtype=torch.bool)], dim=1
+        ),
+    )
+    return output.logits[:, -CONTINUATION_LENGTH:]
+
+
+def cached_logits(model, vision_x, context_ids, context_mask, continuation, chunk):
+    """
+    Continuation logits on top of cached media and the context's past_key_values, either in one forward
+    (chunk=True) or one token at a time (chunk=False), as EvalModel.__call__ used to.
+    """
+    attention_mask = torch.cat(
+        [context_mask, torch.ones_like(continuation, dtype=torch.bool)], dim=1
+    )
+    model.cache_media(input_ids=context_ids, vision_x=vision_x)
+    past_key_values = model(
+        None,
+        context_ids,
+        attention_mask=context_mask,
+        clear_conditioned_layers=False,
+        use_cache=True,
+    ).past_key_values
+    chunks = [continuation] if chunk else continuation.split(1, dim=1)
+    logits = []
+    num_tokens = context_ids.shape[1]
+    for lang_x in chunks:
+        num_tokens += lang_x.shape[1]
+        output = model(
+            None,
+            lang_x,
+            attention_mask=attention_mask[:, :num_tokens],
+            past_key_values=past_key_values,
+            clear_conditioned_layers=False,
+            use_cache=True,
+        )
+        past_key_values = output.past_key_values
+        logits.append(output.logits)
+    model.uncache_media()
+    return torch.cat(logits, dim=1)
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_chunk_matches_per_token_loop(lm):
+    model = make_flamingo(lm)
+    inputs = make_inputs(media_in_continuation=False)
+    with torch.no_grad():
+        chunk = cached_logits(model, *inputs, chunk=True)
+        loop = cached_logits(model, *inputs, chunk=False)
+        full = full_forward_logits(model, *inputs)
+    torch.testing.assert_close(chunk, loop, rtol=1e-5, atol=1e-4)
+    torch.testing.assert_close(chunk, full, rtol=1e-5, atol=1e-4)
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_chunk_with_media_matches_full_forward(lm):
+    model = make_flamingo(lm)
+    inputs = make_inputs(media_in_continuation=True)
+    with torch.no_grad():
+        chunk = cached_logits(model, *inputs, chunk=True)
+        loop = cached_logits(model, *inputs, chunk=False)
+        full = full_forward_logits(model, *inputs)
+    torch.testing.assert_close(chunk, full, rtol=1e-5, atol=1e-4)
+    # in the per-token loop, text before the new media token attends to the last cached image, i.e. the new
+    # one, so only the logits from the media token on agree
+    torch.testing.assert_close(chunk[:, 2:], loop[:, 2:], rtol=1e-5, atol=1e-4)
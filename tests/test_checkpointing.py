@@ -0,0 +1,250 @@
+"""
+Step checkpoints written in the background by CheckpointWriter, list_checkpoints, and resuming mid-epoch
+from the per-rank states of a checkpoint, in a single CPU process with gloo.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+
+from tiny_models import TinyTokenizer, make_flamingo, random_images, random_prompt
+
+# train_utils.py is imported the way train.py imports it
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from train_utils import (  # noqa: E402
+    CheckpointWriter,
+    get_resume_position,
+    get_rng_state,
+    list_checkpoints,
+    restore_rank_state,
+    save_checkpoint,
+    train_one_epoch,
+)
+
+NUM_BATCHES = 6
+
+
+@pytest.fixture
+def process_group(tmp_path):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{tmp_path / 'init'}", rank=0, world_size=1
+    )
+    yield
+    dist.destroy_process_group()
+
+
+def make_args(run_name, **kwargs):
+    return argparse.Namespace(
+        **{
+            "run_name": str(run_name),
+            "num_epochs": 2,
+            "precision": "fp32",
+            "fsdp": False,
+            "fsdp_sharded_checkpoint": False,
+            "rank": 0,
+            "world_size": 1,
+            "gradient_accumulation_steps": 1,
+            "loss_chunk_size": None,
+            "checkpoint_every_n_steps": None,
+            "delete_previous_checkpoint": False,
+            "report_to_wandb": False,
+            "save_checkpoints_to_wandb": False,
+            "logging_steps": NUM_BATCHES + 1,
+            **kwargs,
+        }
+    )
+
+
+def make_training():
+    model = make_flamingo("opt")
+    model.requires_grad_(False)
+    model.perceiver.requires_grad_(True)
+    model.lang_encoder.gated_cross_attn_layers.requires_grad_(True)
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=0.1
+    )
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    return model.train(), optimizer, lr_scheduler
+
+
+class ListMixtureLoader:
+    """Yields fixed (source, batch) pairs, like a MixtureLoader over a single MMC4 source, and has a state."""
+
+    def __init__(self, state="initial"):
+        self.sources = [SimpleNamespace(name="mmc4", dataset_type="mmc4")]
+        self.num_batches = NUM_BATCHES
+        self.state = state
+        self.num_yielded = 0
+
+    def __iter__(self):
+        for i in range(self.num_batches):
+            input_ids = torch.stack([random_prompt(10, 2, seed=i)])
+            images = random_images(1, 2, seed=i).squeeze(2)
+            self.num_yielded += 1
+            yield self.sources[0], (
+                images,
+                (input_ids, torch.ones_like(input_ids, dtype=torch.bool), input_ids),
+            )
+
+    def state_dict(self):
+        return {"state": self.state}
+
+    def load_state_dict(self, state_dict):
+        self.state = state_dict["state"]
+
+
+def test_background_checkpoint_holds_snapshot(tmp_path, process_group, monkeypatch):
+    model, optimizer, lr_scheduler = make_training()
+    args = make_args(tmp_path / "run")
+    path = os.path.join(args.run_name, "checkpoint_0_3.pt")
+
+    # hold the writer thread before it serializes the checkpoint, and again before it renames the temporary file
+    torch_save = torch.save
+    started, written = threading.Event(), threading.Event()
+    release_save, release_rename = threading.Event(), threading.Event()
+
+    def blocking_save(obj, f, *args, **kwargs):
+        if f == path + ".tmp":
+            started.set()
+            release_save.wait()
+        torch_save(obj, f, *args, **kwargs)
+        if f == path + ".tmp":
+            written.set()
+            release_rename.wait()
+
+    monkeypatch.setattr(torch, "save", blocking_save)
+    writer = CheckpointWriter(args)
+    save_checkpoint(
+        model,
+        optimizer,
+        lr_scheduler,
+        0,
+        args,
+        step=3,
+        mixture_loader=ListMixtureLoader(),
+        checkpoint_writer=writer,
+    )
+    started.wait()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    # training continues while the checkpoint is written
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(1.0)
+    release_save.set()
+    written.wait()
+    assert os.path.exists(path + ".tmp") and not os.path.exists(path)
+    release_rename.set()
+    writer.wait()
+    assert os.path.exists(path) and not os.path.exists(path + ".tmp")
+
+    checkpoint = torch.load(path, weights_only=False)
+    assert (checkpoint["epoch"], checkpoint["step"]) == (0, 3)
+    assert checkpoint["rank_states"][0]["data"] == {"state": "initial"}
+    assert any("gated_cross_attn" in name for name in checkpoint["model_state_dict"])
+    for name, param in checkpoint["model_state_dict"].items():
+        assert torch.equal(param, expected[name])
+        assert not torch.equal(param, model.state_dict()[name])
+
+
+@pytest.mark.parametrize("delete_previous_checkpoint", [False, True])
+def test_delete_previous_checkpoint(
+    tmp_path, process_group, delete_previous_checkpoint
+):
+    model, optimizer, lr_scheduler = make_training()
+    args = make_args(
+        tmp_path / "run", delete_previous_checkpoint=delete_previous_checkpoint
+    )
+    writer = CheckpointWriter(args)
+    for step in (2, 4, None):
+        save_checkpoint(
+            model, optimizer, lr_scheduler, 0, args, step=step, checkpoint_writer=writer
+        )
+    writer.wait()
+    names = ["checkpoint_0_2.pt", "checkpoint_0_4.pt", "checkpoint_0.pt"]
+    if delete_previous_checkpoint:
+        names = names[-1:]
+    assert sorted(os.listdir(args.run_name)) == sorted(names)
+
+
+def test_list_checkpoints(tmp_path):
+    for name in ["checkpoint_0.pt", "checkpoint_0_10.pt", "checkpoint_0_10.pt.tmp"]:
+        (tmp_path / name).touch()
+    # sharded checkpoints are directories
+    (tmp_path / "checkpoint_1_3").mkdir()
+    (tmp_path / "checkpoint_1_3.tmp").mkdir()
+    assert [os.path.basename(p) for p in list_checkpoints(str(tmp_path))] == [
+        "checkpoint_0_10.pt",
+        "checkpoint_0.pt",
+        "checkpoint_1_3",
+    ]
+
+
+def test_resume_position():
+    assert get_resume_position({"epoch": 2, "step": None}) == (3, 0)
+    assert get_resume_position({"epoch": 2}) == (3, 0)
+    assert get_resume_position({"epoch": 2, "step": 5}) == (2, 5)
+
+
+def rng_draws():
+    return random.random(), np.random.rand(), torch.rand(1).item()
+
+
+def test_restore_rank_state():
+    rank_states = []
+    for rank in range(2):
+        random.seed(rank)
+        np.random.seed(rank)
+        torch.manual_seed(rank)
+        rank_states.append({"rng": get_rng_state(), "data": {"state": rank}})
+    expected = rng_draws()  # of rank 1
+
+    checkpoint = {"rank_states": rank_states}
+    mixture_loader = ListMixtureLoader()
+    assert restore_rank_state(
+        checkpoint, make_args("run", rank=1, world_size=2), mixture_loader
+    )
+    assert mixture_loader.state == 1
+    assert rng_draws() == expected
+
+    # checkpoints written with another world size, or before rank states were saved, restore nothing
+    for checkpoint in [{"rank_states": rank_states}, {}]:
+        mixture_loader = ListMixtureLoader()
+        assert not restore_rank_state(checkpoint, make_args("run"), mixture_loader)
+        assert mixture_loader.state == "initial"
+
+
+def test_train_one_epoch_resumes_at_start_step(tmp_path, process_group):
+    model, optimizer, lr_scheduler = make_training()
+    args = make_args(tmp_path / "run", checkpoint_every_n_steps=2)
+    writer = CheckpointWriter(args)
+    mixture_loader = ListMixtureLoader()
+    train_one_epoch(
+        args=args,
+        model=model,
+        epoch=1,
+        mixture_loader=mixture_loader,
+        tokenizer=TinyTokenizer(),
+        optimizer=optimizer,
+        lr_scheduler=lr_scheduler,
+        device_id="cpu",
+        wandb=None,
+        start_step=3,
+        checkpoint_writer=writer,
+    )
+    writer.wait()
+    # only the steps left in the epoch are run, and step checkpoints are named by their step in the epoch
+    assert mixture_loader.num_yielded == NUM_BATCHES - 3
+    assert os.listdir(args.run_name) == ["checkpoint_1_4.pt"]
+    checkpoint = torch.load(
+        os.path.join(args.run_name, "checkpoint_1_4.pt"), weights_only=False
+    )
+    assert get_resume_position(checkpoint) == (1, 4)
@@ -0,0 +1,52 @@
+"""
+The loss_chunk_size loss, from the base model's hidden states, against the language model's own loss from labels.
+"""
+import pytest
+import torch
+
+from tiny_models import make_flamingo, random_images, random_prompt
+
+
+def make_inputs():
+    """Two prompts of two images each, with some labels masked out as in train_one_epoch."""
+    lang_x = torch.stack([random_prompt(12, 2, seed=0), random_prompt(12, 2, seed=1)])
+    labels = lang_x.clone()
+    labels[:, :3] = -100
+    labels[1, 8:] = -100
+    return (
+        random_images(2, 2),
+        lang_x,
+        torch.ones_like(lang_x, dtype=torch.bool),
+        labels,
+    )
+
+
+def loss_and_grads(model, vision_x, lang_x, attention_mask, labels, loss_chunk_size):
+    model.zero_grad(set_to_none=True)
+    loss = model(
+        vision_x,
+        lang_x,
+        attention_mask=attention_mask,
+        labels=labels,
+        loss_chunk_size=loss_chunk_size,
+    ).loss
+    loss.backward()
+    grads = {
+        name: param.grad.clone()
+        for name, param in model.named_parameters()
+        if param.grad is not None
+    }
+    return loss.detach(), grads
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_chunked_loss_matches_labels_loss(lm):
+    model = make_flamingo(lm)
+    inputs = make_inputs()
+    loss, grads = loss_and_grads(model, *inputs, loss_chunk_size=None)
+    chunked_loss, chunked_grads = loss_and_grads(model, *inputs, loss_chunk_size=3)
+    torch.testing.assert_close(chunked_loss, loss)
+    assert chunked_grads.keys() == grads.keys()
+    assert any("gated_cross_attn_layer" in name for name in grads)
+    for name, grad in grads.items():
+        torch.testing.assert_close(chunked_grads[name], grad, rtol=1e-4, atol=1e-6)
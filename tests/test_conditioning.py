@@ -0,0 +1,123 @@
+"""
+Media conditioning scoped to the current context: threads sharing one model, and pinned conditioning for torch.compile.
+"""
+import threading
+
+import pytest
+import torch
+from einops._torch_specific import allow_ops_in_compiled_graph
+
+from open_flamingo.src.flamingo_lm import conditioning_scope
+from open_flamingo.src.helpers import MediaMask
+from tiny_models import left_pad, make_flamingo, random_images, random_prompt
+
+NUM_THREADS = 8
+NUM_ITERATIONS = 5
+
+
+def run_request(model, seed):
+    """Logits of a forward pass and tokens of a generate() call for a request that depends on seed."""
+    num_images = 1 + seed % 2
+    vision_x = random_images(2, num_images, seed=seed)
+    input_ids, attention_mask = left_pad(
+        [
+            random_prompt(6 + seed % 3, num_images, seed=seed),
+            random_prompt(4, num_images, seed=seed + 100),
+        ]
+    )
+    with torch.no_grad():
+        logits = model(vision_x, input_ids, attention_mask=attention_mask).logits
+        tokens = model.generate(
+            vision_x, input_ids, attention_mask=attention_mask, max_new_tokens=4
+        )
+    return logits, tokens
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_threads_share_one_model(lm):
+    model = make_flamingo(lm)
+    expected = [run_request(model, seed) for seed in range(NUM_THREADS)]
+
+    barrier = threading.Barrier(NUM_THREADS)
+    errors = []
+
+    def worker(seed):
+        try:
+            barrier.wait()
+            for _ in range(NUM_ITERATIONS):
+                logits, tokens = run_request(model, seed)
+                torch.testing.assert_close(logits, expected[seed][0])
+                assert torch.equal(tokens, expected[seed][1])
+        except Exception as e:
+            # exceptions raised in threads do not fail the test, so collect them
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=worker, args=(seed,)) for seed in range(NUM_THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def test_conditioning_scope_isolates_conditioning():
+    model = make_flamingo()
+    layer = model.lang_encoder._get_decoder_layers()[0]
+    vis_x = torch.randn(1, 1, 64, 16)
+    layer.condition_vis_x(vis_x)
+    with conditioning_scope():
+        assert layer.vis_x is None
+        layer.condition_vis_x(torch.randn(1, 1, 64, 16))
+    assert layer.vis_x is vis_x
+
+
+def condition(layer, media_locations, use_cached_media, num_text_tokens):
+    layer.condition_vis_x(torch.randn(2, 2, 64, 16))
+    layer.condition_media_locations(media_locations)
+    layer.condition_use_cached_media(use_cached_media)
+    layer.condition_media_mask(
+        MediaMask(
+            media_locations,
+            use_cached_media=use_cached_media,
+            num_text_tokens=num_text_tokens,
+        )
+    )
+
+
+@pytest.mark.parametrize("use_cached_media", [False, True])
+def test_pinned_conditioning_compiles_without_graph_breaks(use_cached_media):
+    allow_ops_in_compiled_graph()
+    torch.manual_seed(0)
+    model = make_flamingo()
+    lm = model.lang_encoder
+    layer = lm._get_decoder_layers()[0]
+    num_text_tokens = 1 if use_cached_media else 5
+    media_locations = torch.zeros(2, 5, dtype=torch.bool)
+    media_locations[:, [0, 3]] = True
+    condition(layer, media_locations, use_cached_media, num_text_tokens)
+    lang_x = torch.randn(2, num_text_tokens, 32)
+    expected = layer(lang_x)
+
+    try:
+        compiled = torch.compile(layer, fullgraph=True, backend="eager")
+    except RuntimeError as e:  # e.g. torch 2.0 on Python 3.11
+        pytest.skip(f"torch.compile is not available: {e}")
+    with lm.pin_conditioning():
+        # fullgraph=True raises on any graph break
+        out = compiled(lang_x)
+    torch.testing.assert_close(out, expected)
+
+
+def test_pin_conditioning_moves_conditioning_back_to_the_context():
+    model = make_flamingo()
+    lm = model.lang_encoder
+    layer = lm._get_decoder_layers()[0]
+    vis_x = torch.randn(1, 1, 64, 16)
+    layer.condition_vis_x(vis_x)
+    with lm.pin_conditioning():
+        assert layer.pinned_conditioning["vis_x"] is vis_x
+        layer.condition_use_cached_media(True)
+    assert layer.pinned_conditioning is None
+    assert layer.vis_x is vis_x and layer.use_cached_media
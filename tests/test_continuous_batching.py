@@ -0,0 +1,72 @@
+"""
+ContinuousBatchingEngine against Flamingo.generate of each request on its own.
+"""
+import pytest
+import torch
+
+from open_flamingo.src.continuous_batching import ContinuousBatchingEngine
+from tiny_models import make_flamingo, random_images, random_prompt
+
+# (prompt length, number of images, max_new_tokens): requests of different lengths finish at different steps
+REQUESTS = [(7, 1, 6), (12, 2, 3), (5, 1, 8), (9, 2, 2), (6, 1, 5), (10, 1, 4)]
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+@pytest.mark.parametrize("prefix_cache", [False, True])
+def test_matches_generate(lm, prefix_cache):
+    model = make_flamingo(lm)
+    inputs = [
+        (
+            random_images(1, num_images, seed=seed),
+            random_prompt(length, num_images, seed=seed)[None],
+            max_new_tokens,
+        )
+        for seed, (length, num_images, max_new_tokens) in enumerate(REQUESTS)
+    ]
+    with torch.no_grad():
+        expected = [
+            model.generate(vision_x, lang_x, max_new_tokens=max_new_tokens)
+            for vision_x, lang_x, max_new_tokens in inputs
+        ]
+
+    if prefix_cache:
+        model.enable_prefix_cache(2**30)
+    # a small batch, and requests arriving while others run, so that sequences join and leave the batch
+    engine = ContinuousBatchingEngine(model, max_batch_size=3)
+    requests = [engine.add_request(*request) for request in inputs[:4]]
+    engine.step()
+    engine.step()
+    requests += [engine.add_request(*request) for request in inputs[4:]]
+    engine.run()
+
+    for request, expected_sequence in zip(requests, expected):
+        assert request.done
+        assert torch.equal(request.sequence, expected_sequence)
+
+
+@pytest.mark.parametrize("prefix_cache", [False, True])
+def test_model_usable_when_every_request_finishes_at_prefill(prefix_cache):
+    model = make_flamingo("opt")
+    if prefix_cache:
+        model.enable_prefix_cache(2**30)
+    engine = ContinuousBatchingEngine(model, max_batch_size=3)
+    requests = [
+        engine.add_request(
+            random_images(1, 1, seed=seed), random_prompt(8, 1, seed=seed)[None], 1
+        )
+        for seed in range(2)
+    ]
+    engine.run()
+    assert all(request.done for request in requests)
+    assert not model.lang_encoder._use_cached_vision_x
+    assert all(
+        layer.vis_x is None for layer in model.lang_encoder._get_decoder_layers()
+    )
+
+    # a forward pass conditions on its own images again
+    vision_x, lang_x = random_images(1, 1, seed=2), random_prompt(8, 1, seed=2)[None]
+    with torch.no_grad():
+        logits = model(vision_x=vision_x, lang_x=lang_x).logits
+    with torch.no_grad():
+        expected = make_flamingo("opt")(vision_x=vision_x, lang_x=lang_x).logits
+    torch.testing.assert_close(logits, expected)
@@ -0,0 +1,191 @@
+"""
+scripts/convert_mmc4_to_wds.py on synthetic MMC4 zips and images: deterministic keys, resuming from
+progress.jsonl, and the image_member contract with train/data.py.
+"""
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+import numpy as np
+import torch
+import webdataset as wds
+from PIL import Image
+from tokenizers import Tokenizer, models, pre_tokenizers
+from torchvision import transforms
+from transformers import PreTrainedTokenizerFast
+
+# data.py is imported the way train.py imports it
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from data import (  # noqa: E402
+    get_media_token_id,
+    preprocess_interleaved,
+    split_interleaved_sample,
+)
+
+SCRIPT = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "open_flamingo",
+    "scripts",
+    "convert_mmc4_to_wds.py",
+)
+NUM_ZIPS = 3
+NUM_DOCS_PER_ZIP = 2
+NUM_FILES_PER_SHARD = 2
+WORDS = ["a", "b", "c", "d"]
+
+
+def make_mmc4(root):
+    """
+    Write NUM_ZIPS zips of NUM_DOCS_PER_ZIP documents, and their images to image_dir/<zip index>/.
+    Each document has three images, the last of which was not downloaded.
+    """
+    rng = np.random.default_rng(0)
+    zip_dir, image_dir = root / "zips", root / "images"
+    zip_dir.mkdir()
+    for zip_idx in range(NUM_ZIPS):
+        (image_dir / str(zip_idx)).mkdir(parents=True)
+        lines = []
+        for doc_idx in range(NUM_DOCS_PER_ZIP):
+            image_info = []
+            for img_idx in range(3):
+                image_name = f"{doc_idx}_{img_idx}.png"
+                image_info.append({"image_name": image_name})
+                if img_idx < 2:
+                    # noise, so that the PNG is larger than data.py's MIN_KB
+                    pixels = rng.integers(0, 256, (80, 80, 3), dtype=np.uint8)
+                    Image.fromarray(pixels).save(image_dir / str(zip_idx) / image_name)
+            lines.append(
+                json.dumps(
+                    {
+                        "text_list": WORDS,
+                        "image_info": image_info,
+                        "similarity_matrix": np.eye(3, len(WORDS)).tolist(),
+                    }
+                )
+            )
+        with zipfile.ZipFile(zip_dir / f"shard_{zip_idx}.zip", "w") as zip_file:
+            zip_file.writestr(f"shard_{zip_idx}.jsonl", "\n".join(lines) + "\n")
+    return f"{zip_dir}/shard_{{0..{NUM_ZIPS - 1}}}.zip", str(image_dir)
+
+
+def convert(zip_files, image_dir, output_dir):
+    result = subprocess.run(
+        [
+            sys.executable,
+            SCRIPT,
+            f"--zip_files={zip_files}",
+            f"--image_dir={image_dir}",
+            f"--output_dir={output_dir}",
+            f"--num_files_per_shard={NUM_FILES_PER_SHARD}",
+            "--num_workers=2",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout
+
+
+def read_shard(path):
+    return [
+        {k: v for k, v in sample.items() if k != "__url__"}
+        for sample in wds.WebDataset(str(path), shardshuffle=False)
+    ]
+
+
+def make_tokenizer():
+    """A whitespace-level tokenizer with the special tokens of the training tokenizer, without downloading one."""
+    special_tokens = ["<PAD>", "<unk>", "</s>", "<image>", "<|endofchunk|>"]
+    vocab = {token: i for i, token in enumerate(special_tokens + WORDS)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(special_tokens)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<PAD>",
+        unk_token="<unk>",
+        eos_token="</s>",
+        additional_special_tokens=["<image>", "<|endofchunk|>"],
+    )
+
+
+def test_convert_and_resume(tmp_path):
+    zip_files, image_dir = make_mmc4(tmp_path)
+    output_dir = tmp_path / "shards"
+    stdout = convert(zip_files, image_dir, output_dir)
+    assert "Converting 2 of 2 shards" in stdout
+
+    shard_names = ["000000000.tar", "000000001.tar"]
+    assert sorted(os.listdir(output_dir)) == sorted(
+        shard_names + ["progress.jsonl", "sizes.json"]
+    )
+    with open(output_dir / "sizes.json") as f:
+        assert json.load(f) == {"000000000.tar": 4, "000000001.tar": 2}
+    shards = [read_shard(output_dir / name) for name in shard_names]
+    # keys are <zip index>_<line index>, in order
+    assert [sample["__key__"] for sample in shards[0] + shards[1]] == [
+        f"{zip_idx:06d}_{line_idx:06d}"
+        for zip_idx in range(NUM_ZIPS)
+        for line_idx in range(NUM_DOCS_PER_ZIP)
+    ]
+    for sample in shards[0] + shards[1]:
+        info = json.loads(sample["json"])
+        # the missing image has no member
+        assert [i.get("image_member") for i in info["image_info"]] == [
+            "image0.png",
+            "image1.png",
+            None,
+        ]
+        assert sorted(k for k in sample if k.startswith("image")) == [
+            "image0.png",
+            "image1.png",
+        ]
+
+    # a second run has nothing to do
+    assert "Converting 0 of 2 shards" in convert(zip_files, image_dir, output_dir)
+
+    # as if the run had been killed before finishing the second shard
+    os.remove(output_dir / shard_names[1])
+    with open(output_dir / "progress.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    with open(output_dir / "progress.jsonl", "w") as f:
+        for record in records:
+            if record["shard"] != shard_names[1]:
+                f.write(json.dumps(record) + "\n")
+    mtime = os.path.getmtime(output_dir / shard_names[0])
+    assert "Converting 1 of 2 shards" in convert(zip_files, image_dir, output_dir)
+    assert os.path.getmtime(output_dir / shard_names[0]) == mtime
+    assert read_shard(output_dir / shard_names[1]) == shards[1]
+    with open(output_dir / "sizes.json") as f:
+        assert json.load(f) == {"000000000.tar": 4, "000000001.tar": 2}
+
+
+def test_members_load_in_data_pipeline(tmp_path):
+    zip_files, image_dir = make_mmc4(tmp_path)
+    convert(zip_files, image_dir, tmp_path / "shards")
+    tokenizer = make_tokenizer()
+    image_processor = transforms.Compose(
+        [transforms.Resize((8, 8)), transforms.ToTensor()]
+    )
+    samples = read_shard(tmp_path / "shards" / "000000000.tar")
+    for sample in samples:
+        images, (input_ids, attention_mask) = preprocess_interleaved(
+            split_interleaved_sample(sample),
+            tokenizer,
+            image_processor,
+            sim_threshold=0.5,
+            min_num_images=2,
+            max_num_images=3,
+            max_tokens=16,
+        )
+        # the two stored images, then a zero padding image
+        assert images.shape == (3, 3, 8, 8)
+        assert images[:2].flatten(1).any(dim=1).all()
+        assert not images[2].any()
+        assert (input_ids == get_media_token_id(tokenizer)).sum() == 2
+        assert torch.equal(attention_mask.bool(), input_ids != tokenizer.pad_token_id)
@@ -0,0 +1,192 @@
+"""
+Gradient accumulation with no_sync() in train_one_epoch against synchronizing every backward pass,
+on 2 CPU processes with gloo.
+"""
+import argparse
+import os
+import sys
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from tiny_models import TinyTokenizer, make_flamingo, random_images, random_prompt
+
+# train_utils.py is imported the way train.py imports it
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from train_utils import train_one_epoch  # noqa: E402
+
+WORLD_SIZE = 2
+NUM_BATCHES = 6
+GRADIENT_ACCUMULATION_STEPS = 3
+
+
+class ListMixtureLoader:
+    """Yields fixed (source, batch) pairs, like a MixtureLoader over a single MMC4 source."""
+
+    def __init__(self, batches):
+        self.sources = [SimpleNamespace(name="mmc4", dataset_type="mmc4")]
+        self.batches = batches
+        self.num_batches = len(batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield self.sources[0], batch
+
+
+def make_batches(rank):
+    """MMC4 batches as the dataloader yields them, different on every rank."""
+    batches = []
+    for i in range(NUM_BATCHES):
+        seed = 100 * rank + i
+        input_ids = torch.stack(
+            [random_prompt(10, 2, seed=seed), random_prompt(10, 2, seed=seed + 50)]
+        )
+        labels = input_ids.clone()
+        labels[:, 0] = -100
+        images = random_images(2, 2, seed=seed).squeeze(2)  # (b, T_img * F, C, H, W)
+        batches.append(
+            (images, (input_ids, torch.ones_like(input_ids, dtype=torch.bool), labels))
+        )
+    return batches
+
+
+def make_model():
+    model = make_flamingo("opt")
+    # trainable parameters as in create_model_and_transforms
+    model.requires_grad_(False)
+    model.perceiver.requires_grad_(True)
+    model.lang_encoder.gated_cross_attn_layers.requires_grad_(True)
+    return model.train()
+
+
+def make_args(rank):
+    return argparse.Namespace(
+        num_epochs=1,
+        precision="fp32",
+        fsdp=False,
+        rank=rank,
+        world_size=WORLD_SIZE,
+        gradient_accumulation_steps=GRADIENT_ACCUMULATION_STEPS,
+        loss_chunk_size=None,
+        checkpoint_every_n_steps=None,
+        report_to_wandb=False,
+        logging_steps=NUM_BATCHES + 1,
+    )
+
+
+def count_synchronized_backwards(ddp_model):
+    """Count the backward passes of ddp_model that all-reduce the gradients."""
+    counter = {"backwards": 0}
+
+    def hook(state, bucket):
+        # every synchronized backward pass all-reduces bucket 0
+        counter["backwards"] += bucket.index() == 0
+        return (
+            dist.all_reduce(bucket.buffer().div_(WORLD_SIZE), async_op=True)
+            .get_future()
+            .then(lambda fut: fut.value()[0])
+        )
+
+    ddp_model.register_comm_hook(None, hook)
+    return counter
+
+
+def train_with_no_sync(rank, batches):
+    """train_one_epoch, which only synchronizes the gradients of the last micro-step before each optimizer step."""
+    ddp_model = DDP(make_model())
+    counter = count_synchronized_backwards(ddp_model)
+    optimizer = torch.optim.SGD(
+        [p for p in ddp_model.parameters() if p.requires_grad], lr=0.1
+    )
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    train_one_epoch(
+        args=make_args(rank),
+        model=ddp_model,
+        epoch=0,
+        mixture_loader=ListMixtureLoader(batches),
+        tokenizer=TinyTokenizer(),
+        optimizer=optimizer,
+        lr_scheduler=lr_scheduler,
+        device_id="cpu",
+        wandb=None,
+    )
+    return ddp_model.module, counter["backwards"]
+
+
+def train_synchronizing_every_step(batches):
+    """
+    Every backward pass all-reduces the gradients, as before no_sync() was used. The accumulated gradients are
+    clipped before each optimizer step, as in train_one_epoch.
+    """
+    ddp_model = DDP(make_model())
+    counter = count_synchronized_backwards(ddp_model)
+    optimizer = torch.optim.SGD(
+        [p for p in ddp_model.parameters() if p.requires_grad], lr=0.1
+    )
+    for step, (images, (input_ids, attention_mask, labels)) in enumerate(batches):
+        loss = ddp_model(
+            vision_x=images[:, :, None],
+            lang_x=input_ids,
+            attention_mask=attention_mask,
+            labels=labels,
+        )[0]
+        (loss / GRADIENT_ACCUMULATION_STEPS).backward()
+        if (step + 1) % GRADIENT_ACCUMULATION_STEPS == 0:
+            torch.nn.utils.clip_grad_norm_(ddp_model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+    return ddp_model.module, counter["backwards"]
+
+
+def run(rank, init_file, output_dir):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE
+    )
+    torch.set_num_threads(1)
+    batches = make_batches(rank)
+    model, synchronized = train_with_no_sync(rank, batches)
+    reference, reference_synchronized = train_synchronizing_every_step(batches)
+    torch.save(
+        {
+            "params": {n: p.detach() for n, p in model.named_parameters()},
+            "reference_params": {
+                n: p.detach() for n, p in reference.named_parameters()
+            },
+            "synchronized": synchronized,
+            "reference_synchronized": reference_synchronized,
+        },
+        os.path.join(output_dir, f"rank_{rank}.pt"),
+    )
+    dist.destroy_process_group()
+
+
+def test_no_sync_matches_synchronizing_every_step(tmp_path):
+    mp.spawn(
+        run,
+        args=(str(tmp_path / "init"), str(tmp_path)),
+        nprocs=WORLD_SIZE,
+        join=True,
+    )
+    results = [torch.load(tmp_path / f"rank_{rank}.pt") for rank in range(WORLD_SIZE)]
+    initial = dict(make_model().named_parameters())
+    for result in results:
+        # one all-reduce per optimizer step instead of one per backward pass
+        assert result["synchronized"] == NUM_BATCHES // GRADIENT_ACCUMULATION_STEPS
+        assert result["reference_synchronized"] == NUM_BATCHES
+        for name, param in result["params"].items():
+            # same parameters on every rank, and as when synchronizing every step
+            torch.testing.assert_close(param, results[0]["params"][name])
+            torch.testing.assert_close(
+                param, result["reference_params"][name], rtol=1e-5, atol=1e-6
+            )
+    trained = [
+        name
+        for name, param in results[0]["params"].items()
+        if not torch.equal(param, initial[name])
+    ]
+    assert len(trained) > 0
@@ -0,0 +1,62 @@
+"""
+get_interleaved_labels against the per-row loop that train_one_epoch used to build the MMC4 labels with.
+"""
+import os
+import sys
+
+import torch
+
+# data.py is imported the way train.py imports it
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from data import get_interleaved_labels  # noqa: E402
+
+MEDIA_TOKEN_ID = 5
+ENDOFCHUNK_TOKEN_ID = 6
+PAD_TOKEN_ID = 7
+
+
+def per_row_labels(input_ids, media_token_id, endofchunk_token_id, pad_token_id):
+    labels = input_ids.clone()
+    labels[labels == pad_token_id] = -100
+    for i in range(labels.shape[0]):
+        # remove loss for any token before the first <image> token
+        label_idx = 0
+        while label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id:
+            labels[i][label_idx] = -100
+            label_idx += 1
+
+        # get index of all endofchunk tokens in the sequence
+        endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
+        for endofchunk_idx in endofchunk_idxs:
+            token_idx = endofchunk_idx + 1
+            while (
+                token_idx < labels.shape[1] and labels[i][token_idx] != media_token_id
+            ):
+                labels[i][token_idx] = -100
+                token_idx += 1
+
+    labels[labels == media_token_id] = -100
+    return labels
+
+
+def random_batch(generator, batch_size=8, length=24):
+    """
+    Right-padded rows drawn mostly from the special tokens, so that rows without images,
+    consecutive <|endofchunk|> tokens and chunks ending at the padding all occur.
+    """
+    input_ids = torch.randint(
+        0, MEDIA_TOKEN_ID + 2, (batch_size, length), generator=generator
+    )
+    num_tokens = torch.randint(1, length + 1, (batch_size,), generator=generator)
+    input_ids[torch.arange(length) >= num_tokens[:, None]] = PAD_TOKEN_ID
+    return input_ids
+
+
+def test_matches_per_row_loop():
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(500):
+        input_ids = random_batch(generator)
+        args = (input_ids, MEDIA_TOKEN_ID, ENDOFCHUNK_TOKEN_ID, PAD_TOKEN_ID)
+        assert torch.equal(get_interleaved_labels(*args), per_row_labels(*args))
@@ -0,0 +1,149 @@
+"""
+MixtureLoader epochs, with the prefetch threads running ahead of the consumer, and its seeded schedule.
+"""
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+# data.py is imported the way train.py imports it
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from data import MixtureLoader, MixtureSource  # noqa: E402
+
+
+class EpochData:
+    """Stands in for a DataInfo whose batches are (name, epoch, index) tuples."""
+
+    def __init__(self, name, num_batches, started=None, max_delay=0.0):
+        self.name = name
+        self.epoch = None
+        self.dataloader = self
+        self.num_batches = num_batches
+        # if given, batches are only read once the event is set
+        self.started = started
+        # each batch takes a random time of up to max_delay seconds to read
+        self.max_delay = max_delay
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.started is not None:
+            self.started.wait()
+        for index in range(self.num_batches):
+            time.sleep(random.uniform(0, self.max_delay))
+            yield self.name, self.epoch, index
+
+
+def make_loader(epoch=0, b_started=None, seed=0, fallback_timeout=0.05):
+    sources = [
+        MixtureSource("a", "image_text", EpochData("a", 3)),
+        MixtureSource("b", "mmc4", EpochData("b", 2, b_started), weight=0.5),
+    ]
+    return MixtureLoader(
+        sources,
+        epoch=epoch,
+        prefetch=2,
+        seed=seed,
+        fallback_timeout=fallback_timeout,
+    )
+
+
+def make_jittery_loader(seed, fallback_timeout=10.0):
+    """Sources of 20 and 10 batches, which take random times to read."""
+    sources = [
+        MixtureSource("a", "image_text", EpochData("a", 20, max_delay=0.005)),
+        MixtureSource("b", "mmc4", EpochData("b", 10, max_delay=0.005), weight=0.5),
+    ]
+    return MixtureLoader(
+        sources, seed=seed, prefetch=2, fallback_timeout=fallback_timeout
+    )
+
+
+def schedule(loader, num_scheduled):
+    """The first num_scheduled source names of the schedule of a loader that has not been iterated."""
+    for _ in range(num_scheduled):
+        loader._schedule()
+    return loader._pending
+
+
+def test_source_epochs_are_the_epochs_of_the_yielded_batches():
+    loader = make_loader(epoch=4)
+    batches = []
+    for source, batch in loader:
+        # let the prefetch threads fill their queues, possibly with batches of the next epoch
+        time.sleep(0.01)
+        name, epoch, index = batch
+        assert source.name == name
+        assert loader.source_epochs[name] == epoch
+        batches.append(batch)
+    assert len(batches) == loader.num_batches
+    # the prefetch threads have gone on to the next epoch of each source, which was not yielded
+    last_epochs = {name: epoch for name, epoch, _ in batches}
+    assert loader.source_epochs == last_epochs
+
+
+def test_resume_after_the_yielded_batches():
+    b_started = threading.Event()
+    loader = make_loader(epoch=4, b_started=b_started)
+    # only a's batches are ready, and a's thread goes on reading epoch 4
+    ((source, batch),) = itertools.islice(loader, 1)
+    assert batch == ("a", 4, 0)
+    time.sleep(0.01)
+    state_dict = loader.state_dict()
+    b_started.set()
+    # a skips the rest of epoch 4; b has not yielded any batch, so it starts with epoch 4
+    assert state_dict["resume_epochs"] == {"a": 5, "b": 4}
+
+    resumed = make_loader(epoch=4)
+    resumed.load_state_dict(state_dict)
+    assert resumed.state_dict() == state_dict
+    first_batches = {}
+    for source, batch in resumed:
+        first_batches.setdefault(source.name, batch)
+    assert first_batches == {"a": ("a", 5, 0), "b": ("b", 4, 0)}
+
+
+def test_schedule_is_seeded():
+    orders = [
+        [source.name for source, _ in make_jittery_loader(seed)] for seed in (0, 0, 1)
+    ]
+    # the same order regardless of the time the batches take to read, and another order with another seed
+    assert orders[0] == orders[1] == schedule(make_jittery_loader(0), 30)
+    assert orders[2] == schedule(make_jittery_loader(1), 30)
+    assert orders[0] != orders[2]
+    assert set(orders[0]) == {"a", "b"}
+
+
+def test_resume_continues_the_schedule():
+    expected = [source.name for source, _ in make_loader(fallback_timeout=10.0)]
+    loader = make_loader(fallback_timeout=10.0)
+    assert [s.name for s, _ in itertools.islice(loader, 2)] == expected[:2]
+    resumed = make_loader(fallback_timeout=10.0)
+    resumed.load_state_dict(loader.state_dict())
+    names = [source.name for source, _ in itertools.islice(resumed, 3)]
+    assert names == expected[2:]
+
+
+def test_blocked_source_keeps_its_place():
+    b_started = threading.Event()
+    loader = make_jittery_loader(seed=0, fallback_timeout=0.5)
+    loader.sources[1].data.started = b_started
+    iterator = iter(loader)
+    # while b is blocked, the batches come from a, drawing further ahead in the schedule;
+    # b is only waited for once
+    start = time.time()
+    names = [source.name for source, _ in itertools.islice(iterator, 5)]
+    assert time.time() - start < 1.0
+    assert names == ["a"] * 5
+    assert "b" in loader._pending
+    b_started.set()
+    names += [source.name for source, _ in iterator]
+    # b's batches are only delayed: every scheduled source is either yielded or still pending
+    scheduled = schedule(make_jittery_loader(seed=0), loader._num_scheduled)
+    assert sorted(names + loader._pending) == sorted(scheduled)
+    assert names != scheduled[: len(names)]
@@ -0,0 +1,68 @@
+"""
+Skipping the vision encoder on all-zero padding images, against encoding every image.
+"""
+import types
+
+import torch
+from einops import rearrange
+
+from tiny_models import make_flamingo, random_images, random_prompt
+
+
+def encode_all_images(self, vision_x, image_ids=None, repeats=1, vision_features=None):
+    """Flamingo._encode_vision_x before padding images were skipped."""
+    b, T, F = vision_x.shape[:3]
+    vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+    vision_x = self._encode_images(vision_x)
+    vision_x = rearrange(vision_x, "(b T F) n d -> b T (F n) d", b=b, T=T, F=F)
+    for layer in self.lang_encoder._get_decoder_layers():
+        layer.condition_vis_x(vision_x)
+
+
+def make_inputs():
+    vision_x = random_images(3, 3)
+    # the second row has one image, the third none; the padding slots are all zeros
+    vision_x[1, 1:] = 0
+    vision_x[2] = 0
+    lang_x = torch.stack(
+        [
+            random_prompt(12, 3, seed=0),
+            random_prompt(12, 1, seed=1),
+            random_prompt(12, 0, seed=2),
+        ]
+    )
+    return vision_x, lang_x
+
+
+def run(model, vision_x, lang_x):
+    model.zero_grad()
+    output = model(vision_x=vision_x, lang_x=lang_x, labels=lang_x)
+    output.loss.backward()
+    grads = {
+        n: p.grad.clone() for n, p in model.named_parameters() if p.grad is not None
+    }
+    return output.logits.detach(), output.loss.detach(), grads
+
+
+def test_matches_encoding_all_images():
+    model = make_flamingo("opt")  # eval mode: no dropout
+    model.vision_encoder.requires_grad_(False)
+    vision_x, lang_x = make_inputs()
+
+    num_encoded = []
+    model.vision_encoder.register_forward_hook(
+        lambda module, args, output: num_encoded.append(args[0].shape[0])
+    )
+    logits, loss, grads = run(model, vision_x, lang_x)
+    assert num_encoded == [4]
+
+    model._encode_vision_x = types.MethodType(encode_all_images, model)
+    expected_logits, expected_loss, expected_grads = run(model, vision_x, lang_x)
+    assert num_encoded == [4, 9]
+
+    torch.testing.assert_close(logits, expected_logits)
+    torch.testing.assert_close(loss, expected_loss)
+    assert grads.keys() == expected_grads.keys()
+    assert any(name.startswith("perceiver") for name in grads)
+    for name, grad in grads.items():
+        torch.testing.assert_close(grad, expected_grads[name])
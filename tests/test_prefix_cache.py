@@ -0,0 +1,46 @@
+"""
+Generation with the prefix cache against generation without it, for rows reusing cached prefixes of different lengths.
+"""
+import pytest
+import torch
+
+from tiny_models import left_pad, make_flamingo, random_images, random_prompt
+
+
+def make_batch():
+    """Rows with a fully cached demonstration, a partially cached one and an uncached prompt, all of different lengths."""
+    demo = random_prompt(10, 1, seed=1)
+    rows = [
+        torch.cat([demo, random_prompt(4, 0, seed=2)]),
+        torch.cat([demo[:6], random_prompt(3, 0, seed=3)]),
+        random_prompt(5, 1, seed=4),
+    ]
+    warmup = [torch.cat([demo, random_prompt(2, 0, seed=5)])]
+    return rows, warmup
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_generate_with_prefix_cache(lm):
+    model = make_flamingo(lm)
+    rows, warmup = make_batch()
+    vision_x = random_images(1, 1).expand(len(rows), -1, -1, -1, -1, -1)
+    input_ids, attention_mask = left_pad(rows)
+    with torch.no_grad():
+        logits = model(vision_x, input_ids, attention_mask=attention_mask).logits
+        expected = model.generate(
+            vision_x, input_ids, attention_mask=attention_mask, max_new_tokens=6
+        )
+
+        model.enable_prefix_cache(2**30)
+        model.generate(vision_x[:1], *left_pad(warmup), max_new_tokens=1)
+        output = model.generate(
+            vision_x, input_ids, attention_mask=attention_mask, max_new_tokens=6
+        )
+        assert model.prefix_cache.stats()["hits"] >= 2
+        assert torch.equal(output, expected)
+
+        prefill, _ = model.prefill(input_ids, vision_x, attention_mask=attention_mask)
+        model.uncache_media()
+    torch.testing.assert_close(
+        prefill.logits[:, -1], logits[:, -1], rtol=1e-5, atol=1e-4
+    )
@@ -0,0 +1,270 @@
+"""
+Pretokenized shards written by train/pretokenize_shards.py and loaded with --pretokenized, against preprocessing
+the raw MMC4 / ChatGPT and LAION shards, with random flips and single image drops disabled.
+"""
+import base64
+import functools
+import io
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+import torchvision
+import webdataset as wds
+from PIL import Image
+from tokenizers import Tokenizer, models, pre_tokenizers
+from torchvision import transforms
+from transformers import PreTrainedTokenizerFast
+
+# data.py and the script are imported the way train.py imports data.py
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+import data  # noqa: E402
+import pretokenize_shards  # noqa: E402
+from data import (  # noqa: E402
+    get_resize_transform,
+    preprocess_image,
+    preprocess_interleaved,
+    preprocess_interleaved_batch,
+    preprocess_laion_text,
+    preprocess_pretokenized_interleaved,
+    preprocess_pretokenized_laion_images,
+    preprocess_pretokenized_laion_text,
+    split_interleaved_sample,
+)
+
+WORDS = ["a", "b", "c", "d"]
+SIM_THRESHOLD = 0.5
+MIN_NUM_IMAGES = 1
+MAX_NUM_IMAGES = 2
+IMAGE_PROCESSOR = transforms.Compose(
+    [
+        transforms.Resize(8),
+        transforms.CenterCrop(8),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5, 0.4, 0.3), (0.2, 0.3, 0.4)),
+    ]
+)
+
+
+def make_tokenizer():
+    """A whitespace-level tokenizer with the special tokens of the training tokenizer, without downloading one."""
+    special_tokens = ["<PAD>", "<unk>", "</s>", "<image>", "<|endofchunk|>"]
+    vocab = {token: i for i, token in enumerate(special_tokens + WORDS)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(special_tokens)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<PAD>",
+        unk_token="<unk>",
+        eos_token="</s>",
+        additional_special_tokens=["<image>", "<|endofchunk|>"],
+    )
+
+
+def image_bytes(rng, size):
+    # noise, so that the PNG is larger than data.py's MIN_KB
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def sentence(num_words, offset=0):
+    return " ".join(WORDS[(offset + i) % len(WORDS)] for i in range(num_words))
+
+
+def write_interleaved_shard(path):
+    """
+    MMC4 samples with image members, and a ChatGPT sample with base64 images:
+    more images than MAX_NUM_IMAGES and text longer than 256 tokens, a single image,
+    a missing image member, and no image above SIM_THRESHOLD (rejected by both paths).
+    """
+    rng = np.random.default_rng(0)
+    mmc4_samples = [
+        (3, [sentence(80, i) for i in range(4)], np.eye(3, 4)),
+        (1, [sentence(5), sentence(3)], [[0.1, 0.9]]),
+        (2, [sentence(4), sentence(6)], [[0.9, 0.0], [0.0, 0.8]]),
+        (1, [sentence(4)], [[0.1]]),
+    ]
+    with wds.TarWriter(str(path)) as sink:
+        for key, (num_images, text_list, similarity_matrix) in enumerate(mmc4_samples):
+            sample = {"__key__": f"{key:06d}"}
+            image_info = []
+            for i in range(num_images):
+                image_info.append({"image_member": f"image{i}.png"})
+                # the last image of the third sample was not downloaded
+                if key != 2 or i == 0:
+                    sample[f"image{i}.png"] = image_bytes(rng, (80, 96))
+            sample["json"] = {
+                "text_list": text_list,
+                "image_info": image_info,
+                "similarity_matrix": np.asarray(similarity_matrix).tolist(),
+            }
+            sink.write(sample)
+        image_map = {
+            f"_!_IMAGE{i}_!_": {
+                "base64_image": base64.b64encode(image_bytes(rng, (40, 30))).decode()
+            }
+            for i in (1, 2)
+        }
+        sink.write(
+            {
+                "__key__": "gpt",
+                "json": {
+                    "is_gpt": True,
+                    "example": f"_!_IMAGE1_!_ {sentence(6)} _!_IMAGE2_!_ {sentence(3)}",
+                    "image_map": image_map,
+                },
+            }
+        )
+
+
+def write_laion_shard(path):
+    """Captions of different lengths, one longer than 32 tokens, and a sample without an image."""
+    rng = np.random.default_rng(1)
+    with wds.TarWriter(str(path)) as sink:
+        for key, num_words in enumerate([3, 40, 1, 7]):
+            sample = {"__key__": f"{key:06d}", "txt": sentence(num_words, key)}
+            if key != 2:
+                sample["png"] = image_bytes(rng, (64, 48))
+            sink.write(sample)
+
+
+def pretokenize(monkeypatch, tmp_path, name, pretokenize_fn):
+    output_dir = tmp_path / "pretokenized"
+    output_dir.mkdir(exist_ok=True)
+    monkeypatch.setattr(pretokenize_shards, "_pretokenize_fn", pretokenize_fn)
+    return pretokenize_shards.pretokenize_shard(str(tmp_path / name), str(output_dir))
+
+
+def read_shard(path):
+    return list(wds.WebDataset(str(path), shardshuffle=False))
+
+
+@pytest.fixture
+def no_random_augmentations(monkeypatch):
+    monkeypatch.setattr(
+        torchvision.transforms, "RandomHorizontalFlip", lambda p: (lambda x: x)
+    )
+    # single image MMC4 sequences are always kept
+    monkeypatch.setattr(data.random, "random", lambda: 1.0)
+
+
+def test_interleaved_matches_raw_shards(monkeypatch, tmp_path, no_random_augmentations):
+    tokenizer = make_tokenizer()
+    write_interleaved_shard(tmp_path / "mmc4.tar")
+    name, num_samples = pretokenize(
+        monkeypatch,
+        tmp_path,
+        "mmc4.tar",
+        functools.partial(
+            pretokenize_shards.pretokenize_interleaved,
+            tokenizer=tokenizer,
+            resize=get_resize_transform(IMAGE_PROCESSOR),
+            sim_threshold=SIM_THRESHOLD,
+            min_num_images=MIN_NUM_IMAGES,
+            max_num_images=MAX_NUM_IMAGES,
+        ),
+    )
+    assert (name, num_samples) == ("mmc4.tar", 4)
+
+    expected = []
+    for sample in read_shard(tmp_path / "mmc4.tar"):
+        try:
+            expected.append(
+                preprocess_interleaved(
+                    split_interleaved_sample(sample),
+                    tokenizer,
+                    IMAGE_PROCESSOR,
+                    SIM_THRESHOLD,
+                    MIN_NUM_IMAGES,
+                    MAX_NUM_IMAGES,
+                )
+            )
+        except ValueError:
+            assert sample["__key__"] == "000003"
+    pretokenized = [
+        preprocess_pretokenized_interleaved(
+            (sample["input_ids.npy"], sample["images.npy"], sample["json"]),
+            tokenizer,
+            IMAGE_PROCESSOR,
+            MIN_NUM_IMAGES,
+            MAX_NUM_IMAGES,
+        )
+        for sample in read_shard(tmp_path / "pretokenized" / "mmc4.tar")
+    ]
+    assert len(pretokenized) == len(expected) == 4
+
+    # the first sample is truncated to 256 tokens and MAX_NUM_IMAGES images
+    assert expected[0][1][1].sum() == 256
+    for (images, text), (expected_images, expected_text) in zip(pretokenized, expected):
+        assert images.shape == expected_images.shape == (MAX_NUM_IMAGES, 3, 8, 8)
+        torch.testing.assert_close(images, expected_images)
+        assert torch.equal(text[0], expected_text[0])
+        assert torch.equal(text[1], expected_text[1])
+
+    # labels are built from the stacked batch
+    images, (input_ids, attention_mask, labels) = preprocess_interleaved_batch(
+        tuple(zip(*pretokenized)), tokenizer
+    )
+    _, (
+        expected_input_ids,
+        expected_attention_mask,
+        expected_labels,
+    ) = preprocess_interleaved_batch(tuple(zip(*expected)), tokenizer)
+    assert torch.equal(input_ids, expected_input_ids)
+    assert torch.equal(attention_mask, expected_attention_mask)
+    assert torch.equal(labels, expected_labels)
+
+
+def test_laion_matches_raw_shards(monkeypatch, tmp_path, no_random_augmentations):
+    tokenizer = make_tokenizer()
+    write_laion_shard(tmp_path / "laion.tar")
+    name, num_samples = pretokenize(
+        monkeypatch,
+        tmp_path,
+        "laion.tar",
+        functools.partial(
+            pretokenize_shards.pretokenize_laion,
+            tokenizer=tokenizer,
+            resize=get_resize_transform(IMAGE_PROCESSOR),
+        ),
+    )
+    assert (name, num_samples) == ("laion.tar", 3)
+
+    # as get_laion_dataset reads the raw and the pretokenized shards
+    raw = wds.DataPipeline(
+        wds.SimpleShardList(str(tmp_path / "laion.tar")),
+        wds.tarfile_to_samples(),
+        wds.select(data.filter_no_caption_or_no_image),
+        wds.decode("pilrgb"),
+        wds.to_tuple("jpg;png;jpeg", "txt"),
+    )
+    raw_images, captions = zip(*raw)
+    expected_images = preprocess_image(raw_images, IMAGE_PROCESSOR)
+    expected_input_ids, expected_attention_mask = preprocess_laion_text(
+        captions, tokenizer
+    )
+    pretokenized = [
+        (sample["images.npy"], sample["input_ids.npy"])
+        for sample in read_shard(tmp_path / "pretokenized" / "laion.tar")
+    ]
+    images = preprocess_pretokenized_laion_images(
+        [s[0] for s in pretokenized], IMAGE_PROCESSOR
+    )
+    input_ids, attention_mask = preprocess_pretokenized_laion_text(
+        [s[1] for s in pretokenized], tokenizer
+    )
+
+    assert images.shape == expected_images.shape == (3, 3, 8, 8)
+    torch.testing.assert_close(images, expected_images)
+    # the long caption is truncated to 32 tokens, the others padded to it
+    assert input_ids.shape == (3, 32)
+    assert torch.equal(input_ids, expected_input_ids)
+    assert torch.equal(attention_mask, expected_attention_mask)
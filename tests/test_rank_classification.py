@@ -0,0 +1,78 @@
+"""
+Rank classification over a class name trie against the per-class loop, with an EvalModel around a tiny model.
+"""
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import open_flamingo.eval.models.open_flamingo as open_flamingo_eval
+from tiny_models import IMAGE_SIZE, TinyTokenizer, make_flamingo
+
+# character-level tokens, so class names share prefixes of several tokens
+CLASS_NAMES = ["cat", "car", "cart", "carton", "dog", "do", "dot", "eel", "x"]
+
+
+def image_processor(image):
+    return torch.from_numpy(np.asarray(image, dtype=np.float32) / 255).permute(2, 0, 1)
+
+
+def random_image(seed):
+    pixels = np.random.RandomState(seed).randint(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3))
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def make_eval_model(monkeypatch, lm, **model_args):
+    model = make_flamingo(lm)
+    monkeypatch.setattr(
+        open_flamingo_eval,
+        "create_model_and_transforms",
+        lambda *args, **kwargs: (model, image_processor, TinyTokenizer()),
+    )
+    monkeypatch.setattr(open_flamingo_eval.torch, "load", lambda *args, **kwargs: {})
+    return open_flamingo_eval.EvalModel(
+        {
+            "vision_encoder_path": None,
+            "vision_encoder_pretrained": None,
+            "lm_path": "tiny",
+            "lm_tokenizer_path": None,
+            "checkpoint_path": None,
+            "cross_attn_every_n_layers": 1,
+            "precision": "fp32",
+            **model_args,
+        }
+    )
+
+
+def make_batch(eval_model):
+    batch_text = [
+        eval_model.get_imagenet_prompt("dog") + "\n" + eval_model.get_imagenet_prompt(),
+        eval_model.get_imagenet_prompt(),
+    ]
+    batch_images = [[random_image(0), random_image(1)], [random_image(2)]]
+    return batch_text, batch_images
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+@pytest.mark.parametrize("prefix_cache", [False, True])
+@pytest.mark.parametrize("normalize_length", [False, True])
+def test_trie_matches_per_class_loop(monkeypatch, lm, prefix_cache, normalize_length):
+    model_args = {"classification_batch_size": "4"}  # several forwards per trie level
+    if prefix_cache:
+        model_args["prefix_cache_mb"] = "1024"
+    loop_model = make_eval_model(monkeypatch, lm, **model_args)
+    trie_model = make_eval_model(
+        monkeypatch, lm, use_class_name_trie="True", **model_args
+    )
+    assert not loop_model.use_class_name_trie and trie_model.use_class_name_trie
+
+    batch_text, batch_images = make_batch(trie_model)
+    expected = loop_model.get_rank_classifications(
+        batch_text, batch_images, CLASS_NAMES, True, normalize_length
+    )
+    for _ in range(2):  # the second time, the trie is reused
+        logprobs = trie_model.get_rank_classifications(
+            batch_text, batch_images, CLASS_NAMES, True, normalize_length
+        )
+        assert logprobs.shape == (len(batch_text), len(CLASS_NAMES))
+        torch.testing.assert_close(logprobs, expected, rtol=1e-5, atol=1e-4)
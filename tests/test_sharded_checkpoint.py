@@ -0,0 +1,160 @@
+"""
+Sharded FSDP checkpoints: saved by 2 CPU processes with gloo, reloaded by 1, and consolidated into the
+single-file checkpoint format by scripts/consolidate_fsdp_checkpoint.py.
+"""
+import argparse
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+from tiny_models import make_flamingo, random_images, random_prompt
+
+# train_utils.py and the script are imported the way train.py imports train_utils.py
+for directory in ("train", "scripts"):
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", directory)
+    )
+import consolidate_fsdp_checkpoint  # noqa: E402
+from train_utils import load_sharded_checkpoint, save_sharded_checkpoint  # noqa: E402
+
+EPOCH, STEP = 1, 3
+
+
+def make_args(rank, world_size, run_name):
+    return argparse.Namespace(
+        rank=rank,
+        world_size=world_size,
+        run_name=run_name,
+        fsdp=True,
+        fsdp_sharded_checkpoint=True,
+        fsdp_use_orig_params=False,
+        delete_previous_checkpoint=False,
+        report_to_wandb=False,
+        save_checkpoints_to_wandb=False,
+    )
+
+
+def make_training(seed):
+    # a single FSDP unit, so every parameter is trainable
+    model = FSDP(make_flamingo("opt", seed=seed).train(), device_id=torch.device("cpu"))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.1)
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    return model, optimizer, lr_scheduler
+
+
+def full_params(model):
+    with FSDP.summon_full_params(model):
+        return {n: p.detach().clone() for n, p in model.named_parameters()}
+
+
+def optimizer_state_keys(optimizer):
+    return sorted(sorted(state) for state in optimizer.state.values())
+
+
+def run(rank, world_size, init_file, run_name, output_path):
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    torch.set_num_threads(1)
+    args = make_args(rank, world_size, run_name)
+    if world_size == 2:
+        # train a step, so that the optimizer has states, then save
+        model, optimizer, lr_scheduler = make_training(seed=0)
+        input_ids = random_prompt(10, 2, seed=rank)[None]
+        loss = model(
+            vision_x=random_images(1, 2, seed=rank), lang_x=input_ids, labels=input_ids
+        )[0]
+        loss.backward()
+        optimizer.step()
+        lr_scheduler.step()
+        save_sharded_checkpoint(model, optimizer, lr_scheduler, EPOCH, args, step=STEP)
+        extra_state = None
+    else:
+        model, optimizer, lr_scheduler = make_training(seed=1)
+        extra_state = load_sharded_checkpoint(
+            model, optimizer, os.path.join(run_name, f"checkpoint_{EPOCH}_{STEP}"), args
+        )
+    result = {
+        "params": full_params(model),
+        "optimizer_state_keys": optimizer_state_keys(optimizer),
+        "extra_state": extra_state,
+    }
+    if rank == 0:
+        torch.save(result, output_path)
+    dist.destroy_process_group()
+
+
+def spawn(world_size, tmp_path, output_name):
+    mp.spawn(
+        run,
+        args=(
+            world_size,
+            str(tmp_path / f"init_{world_size}"),
+            str(tmp_path / "run"),
+            str(tmp_path / output_name),
+        ),
+        nprocs=world_size,
+        join=True,
+    )
+    return torch.load(tmp_path / output_name, weights_only=False)
+
+
+def test_save_at_2_ranks_load_at_1(tmp_path, monkeypatch):
+    saved = spawn(2, tmp_path, "saved.pt")
+    path = tmp_path / "run" / f"checkpoint_{EPOCH}_{STEP}"
+    assert os.listdir(tmp_path / "run") == [path.name]
+
+    loaded = spawn(1, tmp_path, "loaded.pt")
+    assert loaded["extra_state"]["epoch"] == EPOCH
+    assert loaded["extra_state"]["step"] == STEP
+    assert len(loaded["extra_state"]["rank_states"]) == 2
+    assert loaded["optimizer_state_keys"] == saved["optimizer_state_keys"]
+    assert len(saved["optimizer_state_keys"]) > 0
+    assert loaded["params"].keys() == saved["params"].keys()
+    for name, param in saved["params"].items():
+        torch.testing.assert_close(loaded["params"][name], param, rtol=0, atol=0)
+
+    # consolidated into the single-file format
+    state_dict = consolidate_fsdp_checkpoint.load_full_state_dict(str(path))
+    # the state dict also holds the aliases of the cross attention and decoder layers
+    assert set(saved["params"]) <= set(state_dict["model"])
+    for name, param in saved["params"].items():
+        torch.testing.assert_close(state_dict["model"][name], param, rtol=0, atol=0)
+
+    output = tmp_path / "checkpoint.pt"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "consolidate_fsdp_checkpoint.py",
+            f"--checkpoint={path}",
+            f"--output={output}",
+        ],
+    )
+    consolidate_fsdp_checkpoint.main()
+    checkpoint = torch.load(output, weights_only=False)
+    assert set(checkpoint) == {
+        "epoch",
+        "step",
+        "model_state_dict",
+        "optimizer_state_dict",
+        "lr_scheduler_state_dict",
+        "rank_states",
+    }
+    assert (checkpoint["epoch"], checkpoint["step"]) == (EPOCH, STEP)
+    # loads into an unwrapped model, as the single-file checkpoints of train.py do
+    model = make_flamingo("opt", seed=1)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    for name, param in model.named_parameters():
+        torch.testing.assert_close(param, saved["params"][name], rtol=0, atol=0)
+    # optimizer states keyed by parameter name, as FSDP.optim_state_dict writes them
+    optim_state = checkpoint["optimizer_state_dict"]
+    assert set(optim_state) == {"state", "param_groups"}
+    assert set(optim_state["state"]) == set(saved["params"])
+    for name, state in optim_state["state"].items():
+        assert sorted(state) == ["exp_avg", "exp_avg_sq", "step"]
+        assert state["exp_avg"].shape == saved["params"][name].shape
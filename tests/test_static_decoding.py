@@ -0,0 +1,73 @@
+"""
+StaticCacheDecoder against Flamingo.generate, eager and compiled.
+"""
+import pytest
+import torch
+
+from open_flamingo.src.static_decoding import StaticCacheDecoder
+from tiny_models import (
+    EOC_TOKEN_ID,
+    left_pad,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+MAX_NEW_TOKENS = 12
+
+
+def make_inputs():
+    rows = [random_prompt(9, 2, seed=0), random_prompt(5, 1, seed=1)]
+    rows[1][0] = rows[0][0]  # both rows start with a media token
+    return random_images(2, 2), *left_pad(rows)
+
+
+def expected_output(model, vision_x, input_ids, attention_mask):
+    with torch.no_grad():
+        # Flamingo.generate pads finished sequences with pad_token_id, StaticCacheDecoder with eos
+        return model.generate(
+            vision_x,
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=EOC_TOKEN_ID,
+        )
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+@pytest.mark.parametrize("prefix_cache", [False, True])
+def test_matches_generate(lm, prefix_cache):
+    model = make_flamingo(lm)
+    inputs = make_inputs()
+    expected = expected_output(model, *inputs)
+    if prefix_cache:
+        model.enable_prefix_cache(2**30)
+    # small buckets, so that decoding crosses several of them
+    decoder = StaticCacheDecoder(model, max_length=32, bucket_size=4)
+    for _ in range(2):  # the second time, prompts are in the prefix cache
+        output = decoder.generate(*inputs, max_new_tokens=MAX_NEW_TOKENS)
+        assert torch.equal(output, expected)
+    # the decoder's attention mixins leave the model's own forward unchanged
+    assert torch.equal(expected_output(model, *inputs), expected)
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_compiled_step_has_no_graph_breaks(lm):
+    model = make_flamingo(lm)
+    inputs = make_inputs()
+    expected = expected_output(model, *inputs)
+    try:
+        decoder = StaticCacheDecoder(
+            model,
+            max_length=32,
+            bucket_size=8,
+            compile=True,
+            backend="eager",
+            fullgraph=True,
+        )
+    except RuntimeError as e:  # e.g. torch 2.0 on Python 3.11
+        pytest.skip(f"torch.compile is not available: {e}")
+
+    # fullgraph=True makes any graph break in the decode step an error
+    output = decoder.generate(*inputs, max_new_tokens=MAX_NEW_TOKENS)
+    assert torch.equal(output, expected)
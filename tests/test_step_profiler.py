@@ -0,0 +1,187 @@
+"""
+StepProfiler's JSONL records and torch.profiler window on CPU, estimate_flops on the tiny model,
+and the data time of train_one_epoch under gradient accumulation.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from tiny_models import TinyTokenizer, make_flamingo, random_images, random_prompt
+
+# step_profiler.py and train_utils.py are imported the way train.py imports them
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", "train")
+)
+from step_profiler import StepProfiler, estimate_flops  # noqa: E402
+from train_utils import train_one_epoch  # noqa: E402
+
+DATA_TIME = 0.05
+FORWARD_TIME = 0.2
+
+
+def read_records(output_dir, rank=0):
+    with open(os.path.join(output_dir, f"rank_{rank}.jsonl")) as f:
+        return [json.loads(line) for line in f]
+
+
+def run_step(profiler, global_step):
+    with profiler.phase("forward_backward"):
+        time.sleep(0.01)
+    with profiler.phase("forward_backward"):
+        time.sleep(0.01)
+    profiler.add_time("data", 0.5)
+    profiler.count("mmc4", tokens=100, images=4, samples=2)
+    profiler.count("mmc4", tokens=50, images=2, samples=1)
+    profiler.count("laion", tokens=30, images=3, samples=3)
+    profiler.end_step(global_step, epoch=1)
+
+
+def test_records(tmp_path):
+    profiler = StepProfiler(
+        output_dir=str(tmp_path), rank=3, flops_per_token=10, flops_per_image=100
+    )
+    for global_step in range(2):
+        run_step(profiler, global_step)
+    profiler.close()
+
+    records = read_records(tmp_path, rank=3)
+    assert [r["global_step"] for r in records] == [0, 1]
+    for record in records:
+        assert record["rank"] == 3
+        assert record["epoch"] == 1
+        assert set(record["phases"]) == {"forward_backward", "data"}
+        # both forward_backward phases add up, and so do the counts of a dataset
+        assert record["phases"]["forward_backward"] >= 0.02
+        assert record["phases"]["data"] == 0.5
+        assert record["datasets"] == {
+            "mmc4": {"tokens": 150, "images": 6, "samples": 3},
+            "laion": {"tokens": 30, "images": 3, "samples": 3},
+        }
+        step_time = record["step_time"]
+        assert step_time >= 0.02
+        assert record["tokens_per_second"] == pytest.approx(180 / step_time)
+        assert record["images_per_second"] == pytest.approx(9 / step_time)
+        assert record["model_flops_per_second"] == pytest.approx(
+            (180 * 10 + 9 * 100) / step_time
+        )
+        # without the peak FLOP/s of the device, there is no utilization
+        assert "mfu" not in record
+
+
+def test_mfu(tmp_path):
+    profiler = StepProfiler(
+        output_dir=str(tmp_path),
+        flops_per_token=10,
+        flops_per_image=100,
+        peak_flops=1e3,
+    )
+    run_step(profiler, 0)
+    profiler.close()
+    (record,) = read_records(tmp_path)
+    assert record["mfu"] == pytest.approx(record["model_flops_per_second"] / 1e3)
+
+
+def test_disabled_profiler_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    profiler = StepProfiler(flops_per_token=10, torch_profiler_schedule=(1, 1, 1))
+    assert not profiler.enabled
+    run_step(profiler, 0)
+    profiler.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_torch_profiler_window(tmp_path):
+    profiler = StepProfiler(output_dir=str(tmp_path), torch_profiler_schedule=(1, 1, 1))
+    for global_step in range(4):
+        run_step(profiler, global_step)
+    profiler.close()
+    assert len(read_records(tmp_path)) == 4
+    traces = os.listdir(tmp_path / "torch_profiler")
+    assert len(traces) == 1 and traces[0].startswith("rank_0")
+
+
+def test_estimate_flops():
+    model = make_flamingo("opt")
+    model.requires_grad_(False)
+    model.perceiver.requires_grad_(True)
+    model.lang_encoder.gated_cross_attn_layers.requires_grad_(True)
+
+    lm_params = sum(p.numel() for p in model.lang_encoder.parameters())
+    trainable_params = sum(
+        p.numel()
+        for module in (model.perceiver, model.lang_encoder.gated_cross_attn_layers)
+        for p in module.parameters()
+    )
+    vision_params = sum(p.numel() for p in model.vision_encoder.parameters())
+    num_patches = 4  # 8x8 images, 4x4 patches
+
+    flops_per_token, flops_per_image = estimate_flops(model)
+    assert flops_per_token == 4 * lm_params + 2 * trainable_params
+    assert flops_per_image == 2 * vision_params * num_patches
+    # with precomputed vision features, the vision encoder does not run
+    assert estimate_flops(model, vision_features=True) == (flops_per_token, 0)
+
+
+class SlowMixtureLoader:
+    """Yields MMC4 batches like a MixtureLoader over a single source, each after waiting DATA_TIME seconds."""
+
+    def __init__(self, num_batches):
+        self.sources = [SimpleNamespace(name="mmc4", dataset_type="mmc4")]
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        for i in range(self.num_batches):
+            time.sleep(DATA_TIME)
+            input_ids = random_prompt(10, 2, seed=i)[None]
+            images = random_images(1, 2, seed=i).squeeze(2)  # (b, T_img * F, C, H, W)
+            mask = torch.ones_like(input_ids, dtype=torch.bool)
+            yield self.sources[0], (images, (input_ids, mask, input_ids.clone()))
+
+
+def test_data_time_excludes_earlier_micro_steps(tmp_path):
+    model = make_flamingo("opt").train()
+    model.no_sync = contextlib.nullcontext  # a single process, as if wrapped in DDP
+    model.register_forward_hook(lambda *args: time.sleep(FORWARD_TIME))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    logs = []
+    profiler = StepProfiler(output_dir=str(tmp_path))
+    train_one_epoch(
+        args=argparse.Namespace(
+            num_epochs=1,
+            precision="fp32",
+            fsdp=False,
+            rank=0,
+            world_size=1,
+            gradient_accumulation_steps=3,
+            loss_chunk_size=None,
+            checkpoint_every_n_steps=None,
+            report_to_wandb=True,
+            logging_steps=100,
+        ),
+        model=model,
+        epoch=0,
+        mixture_loader=SlowMixtureLoader(6),
+        tokenizer=TinyTokenizer(),
+        optimizer=optimizer,
+        lr_scheduler=torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0),
+        device_id="cpu",
+        wandb=SimpleNamespace(log=lambda log, commit: logs.append(log)),
+        profiler=profiler,
+    )
+    profiler.close()
+
+    records = read_records(tmp_path)
+    assert len(records) == len(logs) == 2
+    for record, log in zip(records, logs):
+        # the 3 batches of the optimizer step, without the forward passes between them
+        assert 3 * DATA_TIME <= record["phases"]["data"] < 3 * DATA_TIME + FORWARD_TIME
+        assert DATA_TIME <= log["data_time"] < DATA_TIME + FORWARD_TIME / 3
+        assert record["step_time"] >= 3 * (DATA_TIME + FORWARD_TIME)
+        assert log["step_time"] >= 3 * (DATA_TIME + FORWARD_TIME)
@@ -0,0 +1,94 @@
+"""
+StopSequencesLogitsProcessor on its own, and Flamingo.generate with stop token sequences and stop strings.
+"""
+import pytest
+import torch
+
+from open_flamingo.src.stopping import StopSequencesLogitsProcessor
+from tiny_models import (
+    EOC_TOKEN_ID,
+    PAD_TOKEN_ID,
+    VOCAB_SIZE,
+    TinyTokenizer,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+MAX_NEW_TOKENS = 10
+
+
+def forced_eos(scores):
+    return (scores[:, EOC_TOKEN_ID] == 0) & (
+        scores.isinf().sum(dim=1) == VOCAB_SIZE - 1
+    )
+
+
+@pytest.mark.parametrize("stop", ["token_sequences", "strings"])
+def test_prompt_is_excluded(stop):
+    tokenizer = TinyTokenizer()
+    if stop == "token_sequences":
+        processor = StopSequencesLogitsProcessor(
+            EOC_TOKEN_ID, stop_token_sequences=[[1, 2]]
+        )
+    else:
+        processor = StopSequencesLogitsProcessor(
+            EOC_TOKEN_ID, stop_strings=[tokenizer.decode([1, 2])], tokenizer=tokenizer
+        )
+    # the prompt of both rows ends with the stop sequence
+    input_ids = torch.tensor([[5, 1, 2], [7, 1, 2]])
+    # only the generated tokens of the first row end up ending with the stop sequence
+    for next_tokens, stopped in [
+        (None, [False, False]),
+        ([1, 1], [False, False]),
+        ([2, 3], [True, False]),
+    ]:
+        if next_tokens is not None:
+            input_ids = torch.cat([input_ids, torch.tensor(next_tokens)[:, None]], 1)
+        scores = processor(input_ids, torch.zeros(2, VOCAB_SIZE))
+        assert processor.prompt_length == 3
+        assert forced_eos(scores).tolist() == stopped
+    assert torch.equal(scores[1], torch.zeros(VOCAB_SIZE))
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_generate_stops_after_stop_sequences(num_beams):
+    model = make_flamingo("opt")
+    tokenizer = TinyTokenizer()
+    vision_x = random_images(2, 1)
+    lang_x = torch.stack([random_prompt(8, 1, seed=0), random_prompt(8, 1, seed=1)])
+    prompt_length = lang_x.shape[1]
+    with torch.no_grad():
+        reference = model.generate(
+            vision_x,
+            lang_x,
+            num_beams=num_beams,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=PAD_TOKEN_ID,
+        )[:, prompt_length:]
+    assert reference.shape[1] == MAX_NEW_TOKENS
+
+    # the first row stops after its 3rd generated token, the second row after its 5th; both prompts
+    # contain a stop sequence, which does not stop generation
+    stop_token_sequences = [reference[0, 1:3].tolist(), lang_x[0, -2:].tolist()]
+    stop_strings = [
+        tokenizer.decode(reference[1, 4:5]),
+        tokenizer.decode(lang_x[1, -2:]),
+    ]
+    with torch.no_grad():
+        output = model.generate(
+            vision_x,
+            lang_x,
+            num_beams=num_beams,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=PAD_TOKEN_ID,
+            stop_token_sequences=stop_token_sequences,
+            stop_strings=stop_strings,
+            tokenizer=tokenizer,
+        )
+    assert torch.equal(output[:, :prompt_length], lang_x)
+    # generation returns once both rows are finished, before MAX_NEW_TOKENS
+    assert output[:, prompt_length:].tolist() == [
+        reference[0, :3].tolist() + [EOC_TOKEN_ID, PAD_TOKEN_ID, PAD_TOKEN_ID],
+        reference[1, :5].tolist() + [EOC_TOKEN_ID],
+    ]
@@ -0,0 +1,105 @@
+"""
+TrainableTokenEmbedding against training the full, tied, input embeddings, for an output head tied by weight (OPT)
+and an output head that is the input embedding module itself (MPT); and the masked gradients of the full input
+embeddings of a language model without an output head module (MPT-1B).
+"""
+import pytest
+import torch
+
+from tiny_models import (
+    EOC_TOKEN_ID,
+    MEDIA_TOKEN_ID,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+TOKEN_IDS = [EOC_TOKEN_ID, MEDIA_TOKEN_ID]
+
+
+def make_models(lm):
+    """The same model with the rows of TOKEN_IDS changed in its full embeddings, and in a TrainableTokenEmbedding."""
+    generator = torch.Generator().manual_seed(3)
+    rows = torch.randn(len(TOKEN_IDS), 32, generator=generator)
+    reference = make_flamingo(lm)
+    with torch.no_grad():
+        reference.lang_encoder.get_input_embeddings().weight[TOKEN_IDS] = rows
+    model = make_flamingo(lm)
+    model.lang_encoder.init_trainable_token_embeddings(TOKEN_IDS)
+    with torch.no_grad():
+        model.lang_encoder.get_input_embeddings().trainable.weight.copy_(rows)
+    return model, reference
+
+
+def make_inputs():
+    lang_x = torch.stack([random_prompt(12, 2, seed=0), random_prompt(12, 2, seed=1)])
+    lang_x[:, -1] = EOC_TOKEN_ID
+    return random_images(2, 2), lang_x, torch.ones_like(lang_x, dtype=torch.bool)
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+def test_logits_match_full_embeddings(lm):
+    model, reference = make_models(lm)
+    vision_x, lang_x, attention_mask = make_inputs()
+    with torch.no_grad():
+        logits = model(vision_x, lang_x, attention_mask=attention_mask).logits
+        reference_logits = reference(
+            vision_x, lang_x, attention_mask=attention_mask
+        ).logits
+    torch.testing.assert_close(logits, reference_logits)
+
+
+@pytest.mark.parametrize("lm", ["opt", "mpt"])
+@pytest.mark.parametrize("loss_chunk_size", [None, 5])
+def test_gradients_match_full_embeddings(lm, loss_chunk_size):
+    model, reference = make_models(lm)
+    vision_x, lang_x, attention_mask = make_inputs()
+    losses = [
+        m(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            labels=lang_x,
+            loss_chunk_size=loss_chunk_size,
+        ).loss
+        for m in [model, reference]
+    ]
+    torch.testing.assert_close(losses[0], losses[1])
+    for loss in losses:
+        loss.backward()
+    embedding = model.lang_encoder.get_input_embeddings()
+    grad = reference.lang_encoder.get_input_embeddings().weight.grad
+    torch.testing.assert_close(
+        embedding.trainable.weight.grad, grad[TOKEN_IDS], rtol=1e-4, atol=1e-6
+    )
+
+
+def test_only_token_rows_change_without_output_head():
+    model = make_flamingo("mpt1b")
+    model.requires_grad_(False)
+    model.lang_encoder.init_trainable_token_embeddings(TOKEN_IDS)
+    reference = make_flamingo("mpt1b")
+    reference.requires_grad_(False)
+    reference.lang_encoder.get_input_embeddings().requires_grad_(True)
+    vision_x, lang_x, attention_mask = make_inputs()
+    for m in [model, reference]:
+        m(
+            vision_x, lang_x, attention_mask=attention_mask, labels=lang_x
+        ).loss.backward()
+
+    weight = model.lang_encoder.get_input_embeddings().weight
+    assert [n for n, p in model.named_parameters() if p.requires_grad] == [
+        "lang_encoder.transformer.wte.weight"
+    ]
+    # the rows of TOKEN_IDS have the gradients of the full embeddings, the others none
+    reference_grad = reference.lang_encoder.get_input_embeddings().weight.grad
+    assert reference_grad.abs().sum(dim=1).gt(0).sum() > len(TOKEN_IDS)
+    torch.testing.assert_close(weight.grad[TOKEN_IDS], reference_grad[TOKEN_IDS])
+    assert weight.grad.abs().sum(dim=1).gt(0).nonzero().flatten().tolist() == TOKEN_IDS
+
+    initial = weight.detach().clone()
+    # train.py does not decay the embeddings
+    optimizer = torch.optim.AdamW([weight], lr=0.1, weight_decay=0.0)
+    optimizer.step()
+    changed = (weight != initial).any(dim=1)
+    assert changed.nonzero().flatten().tolist() == TOKEN_IDS
@@ -0,0 +1,103 @@
+"""
+Flamingo's opt-in vision feature cache against encoding every image.
+"""
+import torch
+
+from tiny_models import make_flamingo, random_images, random_prompt
+
+# bytes of the float32 patch tokens of one image: 4 patches of width 16
+PATCH_TOKENS_BYTES = 4 * 16 * 4
+
+
+def count_encoded_images(model):
+    """Count the images passed through the vision encoder."""
+    counter = {"images": 0}
+
+    def hook(module, args, output):
+        counter["images"] += args[0].shape[0]
+
+    model.vision_encoder.register_forward_hook(hook)
+    return counter
+
+
+def make_inputs():
+    vision_x = random_images(2, 2)
+    vision_x[1, 0] = vision_x[0, 0]  # the same demonstration image in both rows
+    lang_x = torch.stack([random_prompt(10, 2, seed=0), random_prompt(10, 2, seed=1)])
+    return vision_x, lang_x
+
+
+def test_logits_match_without_cache():
+    model = make_flamingo("opt")
+    vision_x, lang_x = make_inputs()
+    with torch.no_grad():
+        expected = model(vision_x=vision_x, lang_x=lang_x).logits
+    for cache_latents in [False, True]:
+        model.enable_vision_cache(2**20, cache_latents=cache_latents)
+        for _ in range(2):  # the second time, every image is cached
+            with torch.no_grad():
+                logits = model(vision_x=vision_x, lang_x=lang_x).logits
+            torch.testing.assert_close(logits, expected)
+        model.disable_vision_cache()
+
+
+def test_counters_and_in_batch_dedup():
+    model = make_flamingo("opt")
+    counter = count_encoded_images(model)
+    cache = model.enable_vision_cache(2**20)
+    vision_x, lang_x = make_inputs()
+    with torch.no_grad():
+        model(vision_x=vision_x, lang_x=lang_x)
+    # the repeated image is encoded once
+    assert counter["images"] == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["num_entries"]) == (0, 4, 3)
+
+    with torch.no_grad():
+        model(vision_x=vision_x, lang_x=lang_x)
+    assert counter["images"] == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (4, 4)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_latents_are_not_cached_while_the_perceiver_trains():
+    model = make_flamingo("opt")
+    cache = model.enable_vision_cache(2**20, cache_latents=True)
+    vision_x, lang_x = make_inputs()
+
+    loss = model(vision_x=vision_x, lang_x=lang_x, labels=lang_x).loss
+    loss.backward()
+    assert {kind for kind, _ in cache._features} == {"patch_tokens"}
+    assert all(p.grad is not None for p in model.perceiver.parameters())
+
+    cache.clear()
+    model.perceiver.requires_grad_(False)
+    with torch.no_grad():
+        model(vision_x=vision_x, lang_x=lang_x)
+    assert {kind for kind, _ in cache._features} == {"latents"}
+
+
+def test_byte_budget_evicts_least_recently_used():
+    model = make_flamingo("opt")
+    counter = count_encoded_images(model)
+    cache = model.enable_vision_cache(2 * PATCH_TOKENS_BYTES)
+    images = random_images(3, 1)
+    lang_x = random_prompt(6, 1)[None]
+
+    def encode(i):
+        with torch.no_grad():
+            model(vision_x=images[i : i + 1], lang_x=lang_x)
+
+    for i in range(3):
+        encode(i)
+    stats = cache.stats()
+    assert (stats["evictions"], stats["num_entries"]) == (1, 2)
+    assert stats["num_bytes"] == 2 * PATCH_TOKENS_BYTES
+
+    # image 0 was evicted, image 2 is still cached
+    encode(2)
+    assert counter["images"] == 3
+    encode(0)
+    assert counter["images"] == 4
+    assert cache.stats()["evictions"] == 2
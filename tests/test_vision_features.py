@@ -0,0 +1,147 @@
+"""
+Training from precomputed vision encoder patch tokens: Flamingo's vision_features path, the PCA compression
+of scripts/precompute_vision_features.py, and the feature_index lookup of the interleaved samples.
+"""
+import io
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from einops import rearrange
+from PIL import Image
+from torchvision import transforms
+
+from tiny_models import (
+    IMAGE_SIZE,
+    TinyVisionEncoder,
+    make_flamingo,
+    random_images,
+    random_prompt,
+)
+
+# data.py and the script are imported the way train.py imports data.py
+for directory in ("train", "scripts"):
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(__file__), "..", "open_flamingo", directory)
+    )
+from data import (  # noqa: E402
+    interleave_gpt,
+    interleave_mmc4,
+    load_vision_features,
+    load_vision_features_pca,
+)
+from precompute_vision_features import PatchTokenEncoder  # noqa: E402
+
+TOKENIZER = SimpleNamespace(eos_token="</s>")
+
+
+def test_vision_features_match_vision_x():
+    model = make_flamingo("opt")
+    vision_x = random_images(2, 2)
+    lang_x = torch.stack([random_prompt(10, 2, seed=0), random_prompt(10, 2, seed=1)])
+    with torch.no_grad():
+        patch_tokens = model.vision_encoder(
+            rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+        )[1]
+        vision_features = rearrange(
+            patch_tokens, "(b T F) v d -> b T F v d", b=2, T=2, F=1
+        )
+        expected = model(vision_x=vision_x, lang_x=lang_x).logits
+        logits = model(
+            vision_x=None, lang_x=lang_x, vision_features=vision_features
+        ).logits
+    torch.testing.assert_close(logits, expected)
+
+
+def make_patch_token_encoder():
+    """A PatchTokenEncoder around the tiny vision encoder, without loading open_clip weights."""
+    torch.manual_seed(0)
+    encoder = PatchTokenEncoder.__new__(PatchTokenEncoder)
+    encoder.vision_encoder = TinyVisionEncoder().eval()
+    encoder.image_processor = transforms.Compose(
+        [transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)), transforms.ToTensor()]
+    )
+    encoder.device = "cpu"
+    encoder.batch_size = 3
+    encoder.pca = None
+    return encoder
+
+
+def test_full_rank_pca_round_trip(tmp_path):
+    encoder = make_patch_token_encoder()
+    rng = np.random.default_rng(0)
+    images = [
+        Image.fromarray(rng.integers(0, 256, (12, 12, 3), dtype=np.uint8))
+        for _ in range(8)
+    ]
+    features = encoder.encode(images)
+    num_images, v, d = features.shape
+    assert (num_images, v) == (8, (IMAGE_SIZE // 4) ** 2)
+
+    # without a PCA, the patch tokens are stored as they are
+    buffer = io.BytesIO()
+    np.save(buffer, encoder.compress(features))
+    torch.testing.assert_close(
+        load_vision_features(buffer.getvalue()).float(), features, rtol=1e-3, atol=1e-3
+    )
+
+    # with a full rank PCA, projecting the stored tokens back reconstructs them
+    encoder.fit_pca(images, pca_dim=d)
+    np.savez(
+        tmp_path / "pca.npz", **{k: v.cpu().numpy() for k, v in encoder.pca.items()}
+    )
+    compressed = encoder.compress(features)
+    assert compressed.shape == (num_images, v, d) and compressed.dtype == np.float16
+    buffer = io.BytesIO()
+    np.save(buffer, compressed)
+    pca = load_vision_features_pca(tmp_path / "pca.npz")
+    reconstructed = load_vision_features(buffer.getvalue(), pca)
+    assert reconstructed.dtype == torch.float16
+    torch.testing.assert_close(reconstructed.float(), features, rtol=1e-2, atol=1e-2)
+
+
+def test_interleave_mmc4_picks_rows_by_feature_index():
+    # row i of the features is filled with i
+    vision_features = torch.arange(3.0)[:, None, None].expand(3, 4, 2)
+    info = {
+        "text_list": ["a", "b", "c", "d"],
+        "image_info": [
+            {"feature_index": 2},
+            {},  # filtered out when the features were computed
+            {"feature_index": 0},
+            {"feature_index": 1},
+        ],
+        "similarity_matrix": [
+            [0.9, 0.0, 0.0, 0.0],
+            [0.0, 0.0, 0.9, 0.0],
+            [0.0, 0.0, 0.9, 0.0],
+            [0.0, 0.1, 0.0, 0.0],  # below sim_threshold
+        ],
+    }
+    images, text = interleave_mmc4(
+        info, TOKENIZER, 0.5, 5, vision_features=vision_features
+    )
+    # the first image goes with sentence "a", the third with sentence "c"
+    assert text == "<image>a b<|endofchunk|><image>c d<|endofchunk|></s>"
+    assert images.shape == (2, 4, 2)
+    assert images[:, 0, 0].tolist() == [2.0, 0.0]
+
+
+def test_interleave_gpt_picks_rows_by_feature_index():
+    vision_features = torch.arange(3.0)[:, None, None].expand(3, 4, 2)
+    info = {
+        "is_gpt": True,
+        "example": "_!_IMAGE1_!_ a _!_IMAGE2_!_ b _!_IMAGE3_!_ c",
+        "image_map": {
+            "_!_IMAGE1_!_": {"feature_index": 1},
+            "_!_IMAGE2_!_": {"feature_index": 2},
+            "_!_IMAGE3_!_": {"feature_index": 0},
+        },
+    }
+    images, text = interleave_gpt(info, TOKENIZER, 3, vision_features=vision_features)
+    assert (
+        text == "<image>a<|endofchunk|><image>b<|endofchunk|><image>c<|endofchunk|></s>"
+    )
+    assert images[:, 0, 0].tolist() == [1.0, 2.0, 0.0]
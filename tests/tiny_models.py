@@ -0,0 +1,379 @@
+"""
+Tiny randomly initialized Flamingo models for the tests, which do not download any weights.
+
+Two language models are available:
+    - "opt": Hugging Face OPTForCausalLM, with learned positions and (batch, heads, seq, head_dim) keys / values
+    - "mpt": a minimal copy of the structure of MosaicML's MPT remote code (used by OpenFlamingo-9B):
+      ALiBi instead of positions, keys cached as (batch, heads, head_dim, seq), values as
+      (batch, heads, seq, head_dim), and logits from the input embedding, which get_output_embeddings() returns
+    - "mpt1b": "mpt" without an output head module, computing its logits from the input embedding weight like
+      MPT-1B; for training only, since its keys are not in the layout _infer_kv_seq_dims expects of this class name
+"""
+import math
+import re
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+from torch import nn
+from transformers import OPTConfig, OPTForCausalLM, PretrainedConfig, PreTrainedModel
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+from open_flamingo.src.factory import (
+    _infer_decoder_layers_attr_name,
+    _infer_kv_seq_dims,
+)
+from open_flamingo.src.flamingo import Flamingo
+from open_flamingo.src.flamingo_lm import FlamingoLMMixin
+from open_flamingo.src.utils import extend_instance
+
+VOCAB_SIZE = 64
+PAD_TOKEN_ID = 61
+EOC_TOKEN_ID = 62
+MEDIA_TOKEN_ID = 63
+IMAGE_SIZE = 8
+
+
+class MPTConfig(PretrainedConfig):
+    model_type = "mpt"
+
+    def __init__(
+        self, vocab_size=VOCAB_SIZE, d_model=32, n_heads=4, n_layers=2, **kwargs
+    ):
+        self.vocab_size = vocab_size
+        self.d_model = d_model
+        self.n_heads = n_heads
+        self.n_layers = n_layers
+        super().__init__(**kwargs)
+
+
+class SharedEmbedding(nn.Embedding):
+    def forward(self, input, unembed=False):
+        if unembed:
+            return F.linear(input, self.weight)
+        return super().forward(input)
+
+
+class MultiheadAttention(nn.Module):
+    def __init__(self, d_model, n_heads):
+        super().__init__()
+        self.n_heads = n_heads
+        self.softmax_scale = 1 / math.sqrt(d_model // n_heads)
+        self.Wqkv = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+    def forward(
+        self,
+        x,
+        past_key_value=None,
+        attn_bias=None,
+        attention_mask=None,
+        is_causal=True,
+        needs_weights=False,
+    ):
+        q, k, v = self.Wqkv(x).chunk(3, dim=2)
+        q = rearrange(q, "b s (h d) -> b h s d", h=self.n_heads)
+        k = rearrange(k, "b s (h d) -> b h d s", h=self.n_heads)
+        v = rearrange(v, "b s (h d) -> b h s d", h=self.n_heads)
+        if past_key_value is not None:
+            k = torch.cat([past_key_value[0], k], dim=3)
+            v = torch.cat([past_key_value[1], v], dim=2)
+        s_q, s_k = q.shape[2], k.shape[3]
+
+        attn_weight = q.matmul(k) * self.softmax_scale
+        attn_weight = attn_weight + attn_bias[:, :, :, -s_k:]
+        min_val = torch.finfo(q.dtype).min
+        if attention_mask is not None:
+            attn_weight = attn_weight.masked_fill(
+                ~attention_mask.bool()[:, None, None, -s_k:], min_val
+            )
+        causal = torch.ones(s_q, s_k, dtype=torch.bool, device=x.device).tril(s_k - s_q)
+        attn_weight = attn_weight.masked_fill(~causal, min_val).softmax(dim=-1)
+        out = rearrange(attn_weight.matmul(v), "b h s d -> b s (h d)")
+        return self.out_proj(out), None, (k, v)
+
+
+class MPTBlock(nn.Module):
+    def __init__(self, d_model, n_heads):
+        super().__init__()
+        self.norm_1 = nn.LayerNorm(d_model)
+        self.attn = MultiheadAttention(d_model, n_heads)
+        self.norm_2 = nn.LayerNorm(d_model)
+        self.ffn = nn.Sequential(
+            nn.Linear(d_model, 4 * d_model), nn.GELU(), nn.Linear(4 * d_model, d_model)
+        )
+
+    def forward(self, x, past_key_value=None, attn_bias=None, attention_mask=None):
+        a, _, past_key_value = self.attn(
+            self.norm_1(x),
+            past_key_value=past_key_value,
+            attn_bias=attn_bias,
+            attention_mask=attention_mask,
+        )
+        x = x + a
+        return x + self.ffn(self.norm_2(x)), past_key_value
+
+
+class MPTModel(nn.Module):
+    def __init__(self, config):
+        super().__init__()
+        self.n_heads = config.n_heads
+        self.wte = SharedEmbedding(config.vocab_size, config.d_model)
+        self.blocks = nn.ModuleList(
+            MPTBlock(config.d_model, config.n_heads) for _ in range(config.n_layers)
+        )
+        self.norm_f = nn.LayerNorm(config.d_model)
+
+    def alibi_bias(self, seq_len, device):
+        m = torch.arange(1, self.n_heads + 1, device=device) * (8 / self.n_heads)
+        slopes = 1.0 / torch.pow(2, m)
+        positions = torch.arange(1 - seq_len, 1, device=device)
+        return (slopes[:, None] * positions).view(1, self.n_heads, 1, seq_len)
+
+    def forward(
+        self, input_ids, past_key_values=None, attention_mask=None, use_cache=None
+    ):
+        x = self.wte(input_ids)
+        past_len = 0 if past_key_values is None else past_key_values[0][0].shape[3]
+        attn_bias = self.alibi_bias(past_len + input_ids.shape[1], x.device)
+        presents = []
+        for i, block in enumerate(self.blocks):
+            x, present = block(
+                x,
+                past_key_value=None if past_key_values is None else past_key_values[i],
+                attn_bias=attn_bias,
+                attention_mask=attention_mask,
+            )
+            presents.append(present)
+        return self.norm_f(x), tuple(presents)
+
+
+class MPTForCausalLM(PreTrainedModel):
+    config_class = MPTConfig
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.transformer = MPTModel(config)
+
+    def get_input_embeddings(self):
+        return self.transformer.wte
+
+    def set_input_embeddings(self, value):
+        self.transformer.wte = value
+
+    def get_output_embeddings(self):
+        return self.transformer.wte
+
+    def forward(
+        self,
+        input_ids=None,
+        past_key_values=None,
+        attention_mask=None,
+        labels=None,
+        use_cache=None,
+        return_dict=None,
+        output_attentions=None,
+        output_hidden_states=None,
+    ):
+        hidden_states, presents = self.transformer(
+            input_ids, past_key_values=past_key_values, attention_mask=attention_mask
+        )
+        logits = self.transformer.wte(hidden_states, True)
+        loss = None
+        if labels is not None:
+            loss = F.cross_entropy(
+                logits[:, :-1].flatten(0, 1), labels[:, 1:].flatten(), ignore_index=-100
+            )
+        return CausalLMOutputWithPast(
+            loss=loss,
+            logits=logits,
+            past_key_values=presents if use_cache else None,
+            hidden_states=(hidden_states,) if output_hidden_states else None,
+        )
+
+    def prepare_inputs_for_generation(
+        self, input_ids, past_key_values=None, attention_mask=None, **kwargs
+    ):
+        if past_key_values is not None:
+            input_ids = input_ids[:, -1:]
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "past_key_values": past_key_values,
+            "use_cache": kwargs.get("use_cache", True),
+        }
+
+    @staticmethod
+    def _reorder_cache(past_key_values, beam_idx):
+        return tuple(
+            tuple(t.index_select(0, beam_idx) for t in layer_past)
+            for layer_past in past_key_values
+        )
+
+
+class MosaicGPT(MPTForCausalLM):
+    def get_output_embeddings(self):
+        return None
+
+    def forward(self, input_ids=None, labels=None, output_hidden_states=None, **kwargs):
+        output = super().forward(
+            input_ids=input_ids, output_hidden_states=True, **kwargs
+        )
+        output.logits = F.linear(output.hidden_states[0], self.transformer.wte.weight)
+        if labels is not None:
+            output.loss = F.cross_entropy(
+                output.logits[:, :-1].flatten(0, 1),
+                labels[:, 1:].flatten(),
+                ignore_index=-100,
+            )
+        output.hidden_states = None
+        return output
+
+
+def make_lang_encoder(lm="opt"):
+    if lm == "opt":
+        lang_encoder = OPTForCausalLM(
+            OPTConfig(
+                vocab_size=VOCAB_SIZE,
+                hidden_size=32,
+                num_hidden_layers=2,
+                ffn_dim=64,
+                num_attention_heads=4,
+                max_position_embeddings=128,
+                word_embed_proj_dim=32,
+                pad_token_id=PAD_TOKEN_ID,
+            )
+        )
+    elif lm == "mpt":
+        lang_encoder = MPTForCausalLM(MPTConfig())
+    else:
+        lang_encoder = MosaicGPT(MPTConfig())
+    # with the usual small init, greedy decoding mostly repeats one token, which makes comparing
+    # generated tokens a weak test
+    with torch.no_grad():
+        for p in lang_encoder.parameters():
+            if p.ndim == 2:
+                p.normal_(0, 1.0)
+    return lang_encoder
+
+
+class TinyVisionEncoder(nn.Module):
+    """Stands in for open_clip's visual encoder: returns (pooled, patch tokens)."""
+
+    def __init__(self, dim=16, patch_size=4):
+        super().__init__()
+        self.conv = nn.Conv2d(3, dim, patch_size, stride=patch_size)
+        self.positional_embedding = nn.Parameter(
+            torch.zeros((IMAGE_SIZE // patch_size) ** 2, dim)
+        )
+
+    def forward(self, x):
+        tokens = rearrange(self.conv(x), "b d h w -> b (h w) d")
+        tokens = tokens + self.positional_embedding
+        return tokens.mean(dim=1), tokens
+
+
+class TinyCLIP(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.visual = TinyVisionEncoder()
+
+
+def make_flamingo(lm="opt", seed=0, **flamingo_kwargs):
+    """
+    A randomly initialized Flamingo model with a tiny language model (see the module docstring), in eval mode.
+    The gates of the cross attention layers are opened, so that the images affect the outputs.
+    """
+    torch.manual_seed(seed)
+    lang_encoder = make_lang_encoder(lm)
+    extend_instance(lang_encoder, FlamingoLMMixin)
+    lang_encoder.set_decoder_layers_attr_name(
+        _infer_decoder_layers_attr_name(lang_encoder)
+    )
+    lang_encoder.set_kv_seq_dims(_infer_kv_seq_dims(lang_encoder))
+    model = Flamingo(
+        TinyCLIP(),
+        lang_encoder,
+        EOC_TOKEN_ID,
+        MEDIA_TOKEN_ID,
+        vis_dim=16,
+        cross_attn_every_n_layers=1,
+        **flamingo_kwargs,
+    )
+    with torch.no_grad():
+        for layer in model.lang_encoder.gated_cross_attn_layers:
+            layer.attn_gate.fill_(1.0)
+            layer.ff_gate.fill_(1.0)
+    return model.eval()
+
+
+def random_images(batch_size, num_images, seed=0):
+    """vision_x of shape (B, T_img, 1, 3, H, W)"""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(
+        batch_size, num_images, 1, 3, IMAGE_SIZE, IMAGE_SIZE, generator=generator
+    )
+
+
+def random_prompt(length, num_images, seed=0):
+    """Token ids of a prompt with num_images media tokens, each followed by some text."""
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(0, PAD_TOKEN_ID, (length,), generator=generator)
+    for i in range(num_images):
+        tokens[i * (length // num_images)] = MEDIA_TOKEN_ID
+    return tokens
+
+
+def left_pad(rows):
+    """Left-pad a list of 1D token tensors, returning (input_ids, attention_mask)."""
+    length = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), length), PAD_TOKEN_ID)
+    attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+    for i, row in enumerate(rows):
+        input_ids[i, length - len(row) :] = row
+        attention_mask[i, length - len(row) :] = 1
+    return input_ids, attention_mask
+
+
+class TinyTokenizer:
+    """
+    Character-level stand-in for a Hugging Face tokenizer, with the media and end of chunk tokens.
+    Pads on the left, as the eval models set padding_side="left".
+    """
+
+    padding_side = "left"
+    pad_token_id = PAD_TOKEN_ID
+
+    special_tokens = {"<image>": MEDIA_TOKEN_ID, "<|endofchunk|>": EOC_TOKEN_ID}
+
+    def encode(self, text):
+        pieces = re.findall(r"<image>|<\|endofchunk\|>|.", text, re.DOTALL)
+        return [
+            self.special_tokens[p] if len(p) > 1 else ord(p) % PAD_TOKEN_ID
+            for p in pieces
+        ]
+
+    def __call__(self, text, return_tensors=None, add_special_tokens=True, **kwargs):
+        if isinstance(text, str):
+            input_ids = self.encode(text)
+            if return_tensors == "pt":
+                input_ids = torch.tensor([input_ids])
+            return {"input_ids": input_ids}
+        input_ids, attention_mask = left_pad(
+            [torch.tensor(self.encode(t), dtype=torch.long) for t in text]
+        )
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        """Token i < PAD_TOKEN_ID decodes to chr(i + PAD_TOKEN_ID), a character that encodes back to i."""
+        special_tokens = {i: p for p, i in self.special_tokens.items()}
+        special_tokens[PAD_TOKEN_ID] = "<pad>"
+        return "".join(
+            ("" if skip_special_tokens else special_tokens[i])
+            if i in special_tokens
+            else chr(i + PAD_TOKEN_ID)
+            for i in map(int, token_ids)
+        )
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(s, skip_special_tokens) for s in sequences]